@@ -1,15 +1,159 @@
-import requests
 import concurrent.futures
+import logging
+import threading
+import time
+from collections import deque
 from typing import Dict, Any, Optional, List
+
+import requests
+from django.conf import settings
 from django.http import JsonResponse
 
+from common.http_session import get_shared_session
+
+logger = logging.getLogger(__name__)
+
+
+class EndpointHealth:
+    """单个API端点的延迟统计和熔断状态（按URL在进程内共享）"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, url: str, window: int = 100, failure_threshold: int = 5, cooldown: float = 30):
+        self.url = url
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._latencies = deque(maxlen=window)  # 最近成功请求的耗时（秒）
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self.requests = 0
+        self.failures = 0
+
+    def percentile(self, pct: float) -> Optional[float]:
+        with self._lock:
+            if not self._latencies:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+    @property
+    def samples(self) -> int:
+        return len(self._latencies)
+
+    def allow_request(self) -> bool:
+        """熔断打开时拒绝请求，冷却结束后只放行一个试探请求"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self, latency: float):
+        with self._lock:
+            self.requests += 1
+            self._latencies.append(latency)
+            self.consecutive_failures = 0
+            if self.state != self.CLOSED:
+                logger.info(f"API端点 {self.url} 恢复，关闭熔断")
+            self.state = self.CLOSED
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.requests += 1
+            self.failures += 1
+            self.consecutive_failures += 1
+            self._trial_in_flight = False
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"API端点 {self.url} 连续失败 {self.consecutive_failures} 次，熔断 {self.cooldown} 秒")
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+    def release_trial(self):
+        """试探请求被取消（未得到结果）时允许下一次试探"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def stats(self) -> Dict:
+        return {
+            'url': self.url,
+            'state': self.state,
+            'requests': self.requests,
+            'failures': self.failures,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+        }
+
+
+class EndpointRegistry:
+    def __init__(self):
+        self._endpoints: Dict[str, EndpointHealth] = {}
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> EndpointHealth:
+        with self._lock:
+            endpoint = self._endpoints.get(url)
+            if endpoint is None:
+                endpoint = EndpointHealth(
+                    url,
+                    window=getattr(settings, 'API_LATENCY_WINDOW', 100),
+                    failure_threshold=getattr(settings, 'API_BREAKER_FAILURE_THRESHOLD', 5),
+                    cooldown=getattr(settings, 'API_BREAKER_COOLDOWN', 30),
+                )
+                self._endpoints[url] = endpoint
+            return endpoint
+
+    def stats(self) -> List[Dict]:
+        with self._lock:
+            endpoints = list(self._endpoints.values())
+        return [endpoint.stats() for endpoint in endpoints]
+
+
+# 创建全局端点统计实例和请求线程池（所有APIRoundRobin实例共享）
+# 线程池按预计同时进行的请求数设置：并发调用数 × 每次调用同时进行的端点请求数，
+# 再加一倍余量给已落败但仍在等待上游响应的请求，避免新请求在线程池中排队
+endpoint_registry = EndpointRegistry()
+_request_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=getattr(settings, 'API_REQUEST_CONCURRENCY', 16) * getattr(settings, 'API_HEDGE_MAX_IN_FLIGHT', 2) * 2,
+    thread_name_prefix='api-round-robin'
+)
+
+
+class _Attempt:
+    """
+    一次发往某个端点的请求，cancelled后尚未发出的不再发出，已返回的响应不再读取响应体直接关闭；
+    已经发出的请求仍会在上游执行完（并照常计费），取消只释放本地的线程和连接
+    """
+
+    def __init__(self, api: Dict):
+        self.api = api
+        self.cancelled = threading.Event()
+        self.future: Optional[concurrent.futures.Future] = None
+        self.started_at = 0.0  # 在工作线程中开始执行的时间，0表示仍在线程池中排队
+
 
 class APIRoundRobin:
     def __init__(self, api_configs: List[Dict[str, Any]]):
         """
         支持模型覆盖的API轮询工具类
+        先请求优先级最高的可用端点，请求开始后超过其p95延迟仍未返回时才向下一个端点发起备份请求（对冲），
+        先成功的结果胜出，其余请求不再等待；连续失败的端点熔断一段时间
+        备份请求会让上游多执行一次请求，同时进行的端点请求数不超过API_HEDGE_MAX_IN_FLIGHT
+        每个配置可选 hedge_delay（秒）指定固定的对冲等待时间
         """
         self.api_configs = api_configs
+        self.session = get_shared_session('api_round_robin')
 
     def _build_headers(self, api_key: str, custom_headers: Optional[Dict] = None) -> Dict:
         """构建请求头"""
@@ -21,9 +165,20 @@ class APIRoundRobin:
             headers.update(custom_headers)
         return headers
 
+    @staticmethod
+    def _hedge_delay(api: Dict) -> float:
+        """发起备份请求前的等待时间：端点最近的p95延迟，样本不足时使用超时时间的一半"""
+        if api.get('hedge_delay') is not None:
+            return api['hedge_delay']
+        endpoint = endpoint_registry.get(api['url'])
+        p95 = endpoint.percentile(95)
+        if p95 is not None and endpoint.samples >= getattr(settings, 'API_HEDGE_MIN_SAMPLES', 5):
+            return max(p95, getattr(settings, 'API_HEDGE_MIN_DELAY', 0.5))
+        return api.get('timeout', 2) / 2
+
     def _send_single_request(
             self,
-            api: Dict,
+            attempt: _Attempt,
             method: str,
             url: str,
             params: Dict,
@@ -32,31 +187,74 @@ class APIRoundRobin:
             custom_headers: Dict,
             model_override: Optional[str] = None
     ) -> Optional[JsonResponse]:
-        """发送单个API请求（支持模型覆盖）"""
-        try:
-            # 使用API配置中的模型，除非有覆盖
-            final_model = model_override if model_override else api.get('model')
+        """发送单个API请求（支持模型覆盖），失败或被取消时返回None"""
+        api = attempt.api
+        endpoint = endpoint_registry.get(url)
+        # 使用API配置中的模型，除非有覆盖
+        final_model = model_override if model_override else api.get('model')
+        attempt.started_at = time.time()
+        if attempt.cancelled.is_set() or not final_model:
             if not final_model:
-                raise ValueError("API配置中未指定模型且未提供模型覆盖")
-
+                logger.error(f"API端点 {url} 的配置中未指定模型且未提供模型覆盖")
+            endpoint.release_trial()
+            return None
+        try:
             # 构建最终payload
-            final_payload = {**json_payload, "model": final_model}
+            final_payload = {**(json_payload or {}), "model": final_model}
 
             headers = self._build_headers(api['key'], custom_headers)
-            response = requests.request(
+            response = self.session.request(
                 method=method,
                 url=url,
                 headers=headers,
                 params=params,
                 data=data,
                 json=final_payload,
-                timeout=api.get('timeout', 2)
+                timeout=api.get('timeout', 2),
+                stream=True
             )
-            response.raise_for_status()
-            return JsonResponse(response.json())
-        except requests.exceptions.RequestException:
+            if attempt.cancelled.is_set():
+                # 其他端点已经返回，不再读取响应体，关闭连接
+                response.close()
+                endpoint.release_trial()
+                return None
+            with response:
+                response.raise_for_status()
+                result = response.json()
+            endpoint.record_success(time.time() - attempt.started_at)
+            return JsonResponse(result)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            if attempt.cancelled.is_set():
+                endpoint.release_trial()
+                return None
+            endpoint.record_failure()
+            logger.warning(f"API端点 {url} 请求失败: {str(e)}")
             return None
 
+    def _launch(self, api: Dict, method, params, data, json_payload, custom_headers, model_override) -> _Attempt:
+        attempt = _Attempt(api)
+        attempt.future = _request_executor.submit(
+            self._send_single_request,
+            attempt=attempt,
+            method=method,
+            url=api['url'],
+            params=params,
+            data=data,
+            json_payload=json_payload,
+            custom_headers=custom_headers,
+            model_override=model_override
+        )
+        return attempt
+
+    @staticmethod
+    def _next_available(pending: deque) -> Optional[Dict]:
+        """按配置顺序取出下一个熔断未打开的端点"""
+        while pending:
+            api = pending.popleft()
+            if endpoint_registry.get(api['url']).allow_request():
+                return api
+        return None
+
     def send_request(
             self,
             method: str = 'GET',
@@ -82,7 +280,7 @@ class APIRoundRobin:
 
                 final_payload = {**json, "model": final_model}
                 headers = self._build_headers(api['key'], custom_headers)
-                response = requests.request(
+                response = self.session.request(
                     method=method,
                     url=full_url,
                     headers=headers,
@@ -99,31 +297,57 @@ class APIRoundRobin:
                     status=503
                 )
 
-        # 并发请求
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = []
-            for api in self.api_configs:
-                future = executor.submit(
-                    self._send_single_request,
-                    api=api,
-                    method=method,
-                    url=api['url'],
-                    params=params,
-                    data=data,
-                    json_payload=json,
-                    custom_headers=custom_headers,
-                    model_override=model_override
-                )
-                futures.append(future)
+        # 对冲请求：先请求首选端点，请求开始后超过对冲等待时间或失败后才请求下一个端点
+        pending = deque(self.api_configs)
+        attempts: List[_Attempt] = []
+        hedge_delay = 0.0
+        max_in_flight = getattr(settings, 'API_HEDGE_MAX_IN_FLIGHT', 2)
+        try:
+            while True:
+                running = [attempt for attempt in attempts if not attempt.future.done()]
+                # 对冲计时从最近一个请求在工作线程中真正开始时算起，不包括在线程池中排队的时间
+                latest = attempts[-1] if attempts else None
+                hedge_at = latest.started_at + hedge_delay if latest and latest.started_at else None
+                if pending and (not running or (
+                        len(running) < max_in_flight and hedge_at is not None and time.time() >= hedge_at)):
+                    api = self._next_available(pending)
+                    if api is None and not attempts:
+                        # 所有端点都已熔断，仍尝试首选端点
+                        api = self.api_configs[0]
+                    if api is not None:
+                        if attempts:
+                            logger.info(f"首选端点未在对冲等待时间内成功，向备用端点 {api['url']} 发起请求")
+                        attempts.append(self._launch(api, method, params, data, json, custom_headers, model_override))
+                        hedge_delay = self._hedge_delay(api)
+                        running = [attempt for attempt in attempts if not attempt.future.done()]
+                if not running:
+                    break
 
-            for future in concurrent.futures.as_completed(futures):
-                result = future.result()
-                if result is not None:
-                    for f in futures:
-                        f.cancel()
-                    return result
+                if not pending or len(running) >= max_in_flight:
+                    wait_timeout = None
+                elif attempts[-1].started_at:
+                    wait_timeout = max(attempts[-1].started_at + hedge_delay - time.time(), 0.01)
+                else:
+                    # 请求仍在线程池中排队，稍后再检查是否已开始
+                    wait_timeout = 0.05
+                done, _ = concurrent.futures.wait(
+                    [attempt.future for attempt in running],
+                    timeout=wait_timeout,
+                    return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    result = future.result()
+                    if result is not None:
+                        return result
+        finally:
+            # 不再等待其他请求：未发出的不再发出，已发出的只在返回后关闭连接
+            for attempt in attempts:
+                attempt.cancelled.set()
+                if attempt.future.cancel():
+                    # 请求尚未发出，归还熔断试探名额
+                    endpoint_registry.get(attempt.api['url']).release_trial()
 
         return JsonResponse(
             {'error': 'All API endpoints failed'},
             status=503
-        )
\ No newline at end of file
+        )
@@ -0,0 +1,101 @@
+"""
+Server-Sent Events 支持
+EventSource 客户端发送 Accept: text/event-stream 且无法设置 Authorization 请求头，
+这里提供对应的渲染器、查询参数JWT认证，以及限制单个进程同时保持的推送连接数
+"""
+import json
+import threading
+from typing import Iterator
+
+from rest_framework.renderers import BaseRenderer
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    text/event-stream 渲染器：让内容协商接受EventSource请求；
+    事件流本身由StreamingHttpResponse返回，这里只渲染错误响应（作为error事件）
+    """
+    media_type = 'text/event-stream'
+    format = 'event-stream'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if isinstance(data, bytes):
+            return data
+        if isinstance(data, str):
+            return data.encode(self.charset)
+        payload = json.dumps(data, ensure_ascii=False, default=str)
+        return f"event: error\ndata: {payload}\n\n".encode(self.charset)
+
+
+class QueryParamJWTAuthentication(JWTAuthentication):
+    """从查询参数token读取JWT（EventSource无法设置Authorization请求头）"""
+
+    def authenticate(self, request):
+        raw_token = request.query_params.get('token')
+        if not raw_token:
+            return None
+        validated_token = self.get_validated_token(raw_token)
+        return self.get_user(validated_token), validated_token
+
+
+class _LeasedStream:
+    """包装事件流，流结束或连接关闭时归还名额"""
+
+    def __init__(self, stream: Iterator, limiter: 'StreamLimiter'):
+        self._stream = stream
+        self._limiter = limiter
+        self._released = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._stream)
+        except BaseException:
+            self._release()
+            raise
+
+    def close(self):
+        try:
+            close = getattr(self._stream, 'close', None)
+            if close:
+                close()
+        finally:
+            self._release()
+
+    def _release(self):
+        if not self._released:
+            self._released = True
+            self._limiter.release()
+
+
+class StreamLimiter:
+    """
+    限制单个进程同时保持的推送连接数
+    每个连接在同步worker中占用一个线程直到关闭，应配合gthread/gevent等worker使用
+    """
+
+    def __init__(self, max_streams: int):
+        self.max_streams = max_streams
+        self.active = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.active >= self.max_streams:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.active = max(self.active - 1, 0)
+
+    def lease(self, stream: Iterator) -> Iterator:
+        """包装已获取名额的事件流"""
+        return _LeasedStream(stream, self)
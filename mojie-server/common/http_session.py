@@ -0,0 +1,42 @@
+"""
+进程内共享的HTTP会话
+按名称复用带连接池的requests会话，同一上游的请求复用TCP/TLS连接，不再每次请求重新握手
+"""
+import threading
+from typing import Dict, Optional
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+_sessions: Dict[str, requests.Session] = {}
+_lock = threading.Lock()
+
+
+def get_shared_session(name: str = 'default', pool_size: Optional[int] = None) -> requests.Session:
+    """
+    获取共享的HTTP会话（线程安全，连接池按主机划分）
+    :param name: 会话名称，不同用途（如不同的认证头）使用不同名称
+    :param pool_size: 每个主机的最大连接数，默认使用HTTP_POOL_SIZE
+    """
+    session = _sessions.get(name)
+    if session is None:
+        with _lock:
+            session = _sessions.get(name)
+            if session is None:
+                size = pool_size or getattr(settings, 'HTTP_POOL_SIZE', 20)
+                session = requests.Session()
+                # 不自动重试，失败后由调用方决定是否换端点重试
+                adapter = HTTPAdapter(pool_connections=10, pool_maxsize=size, max_retries=0)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _sessions[name] = session
+    return session
+
+
+def close_shared_sessions():
+    with _lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        session.close()
@@ -1,61 +1,246 @@
 import configparser
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Iterable, Iterator, Optional, Union
+
 import tos
-from typing import Optional
+from tos.models2 import UploadedPart
+
+
+class _IterReader:
+    """将字节块迭代器包装为只读文件对象，按需读取，不缓存整个内容"""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks: Iterator[bytes] = iter(chunks)
+        self._buffer = b''
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def _read_full(reader, size: int) -> bytes:
+    """从文件对象读取最多size字节（兼容单次read返回不足size的流）"""
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = reader.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
 
 class VolcengineTOSUtils:
+    # 进程内共享的配置和 TOS 客户端（客户端内部维护连接池，线程安全），避免每次实例化都读取配置文件和新建客户端
+    _shared_config = None
+    _shared_client = None
+    _shared_lock = threading.Lock()
+
     def __init__(self):
-        # 读取配置文件
-        config = configparser.ConfigParser()
-        config.read('config/config.ini')
+        config, self.client = self._get_shared_client()
 
         # 获取配置信息
-        self.access_key_id = config.get('oss', 'access_key_id')
-        self.access_key_secret = config.get('oss', 'access_key_secret')
-        self.endpoint = config.get('oss', 'endpoint')
-        self.region = config.get('oss', 'region')
-        self.bucket_name = config.get('oss', 'bucket_name')
-
-        # 初始化 TOS 客户端
-        self.client = tos.TosClientV2(
-            ak=self.access_key_id,
-            sk=self.access_key_secret,
-            endpoint=self.endpoint,
-            region=self.region
-        )
-
-    def upload_image(self, object_name: str, file_path: Optional[str] = None, file_data: Optional[bytes] = None) -> str:
+        self.access_key_id = config['access_key_id']
+        self.access_key_secret = config['access_key_secret']
+        self.endpoint = config['endpoint']
+        self.region = config['region']
+        self.bucket_name = config['bucket_name']
+        self.multipart_threshold = config['multipart_threshold']
+        self.part_size = config['part_size']
+        self.upload_concurrency = config['upload_concurrency']
+        self.part_retries = config['part_retries']
+
+    @classmethod
+    def _get_shared_client(cls):
+        """获取共享的配置和 TOS 客户端，首次调用时读取配置文件并初始化"""
+        if cls._shared_client is None:
+            with cls._shared_lock:
+                if cls._shared_client is None:
+                    # 读取配置文件
+                    config = configparser.ConfigParser()
+                    config.read('config/config.ini')
+                    shared_config = {
+                        key: config.get('oss', key)
+                        for key in ('access_key_id', 'access_key_secret', 'endpoint', 'region', 'bucket_name')
+                    }
+
+                    # 初始化 TOS 客户端
+                    cls._shared_client = tos.TosClientV2(
+                        ak=shared_config['access_key_id'],
+                        sk=shared_config['access_key_secret'],
+                        endpoint=shared_config['endpoint'],
+                        region=shared_config['region']
+                    )
+                    # 流式上传参数（可选配置项）
+                    shared_config['multipart_threshold'] = config.getint(
+                        'oss', 'multipart_threshold', fallback=16 * 1024 * 1024)
+                    # TOS要求除最后一个分片外每个分片不小于5MB
+                    shared_config['part_size'] = max(config.getint('oss', 'part_size', fallback=8 * 1024 * 1024),
+                                                     5 * 1024 * 1024)
+                    shared_config['upload_concurrency'] = config.getint('oss', 'upload_concurrency', fallback=4)
+                    shared_config['part_retries'] = config.getint('oss', 'part_retries', fallback=3)
+                    cls._shared_config = shared_config
+        return cls._shared_config, cls._shared_client
+
+    @staticmethod
+    def _content_index():
+        """获取内容去重索引，未启用或不在 Django 环境中时返回 None"""
+        try:
+            # 延迟导入，common 模块不直接依赖 Django 应用
+            from templateImage.content_index import content_hash_index
+            return content_hash_index if content_hash_index.enabled else None
+        except Exception:
+            return None
+
+    def upload_image(self, object_name: str, file_path: Optional[str] = None, file_data: Optional[Union[bytes, BinaryIO]] = None,
+                     dedup: bool = True) -> str:
         """
         上传图片到火山引擎 TOS
         :param object_name: 对象名称（在 TOS 中的存储路径和文件名）
         :param file_path: 本地文件路径
-        :param file_data: 文件字节数据
+        :param file_data: 文件字节数据，或可读的文件对象（按流读取上传）
+        :param dedup: 同一目录下已有相同内容的对象时直接返回其 URL，不再上传
         :return: 图片的访问 URL
         """
         try:
+            index = self._content_index() if dedup else None
+            content_hash = None
+            if index:
+                try:
+                    content_hash = index.compute(data=file_data, file_path=file_path)
+                    existing = index.acquire(content_hash[0], index.folder_of(object_name)) if content_hash else None
+                    if existing:
+                        print(f"内容已存在，复用对象 {existing}，跳过上传 {content_hash[1] // 1024}KB")
+                        return self.get_object_url(existing)
+                except Exception as e:
+                    print(f"查询内容索引失败，按普通上传处理: {e}")
+                    content_hash = None
+
             if file_path:
-                # 从文件路径上传
-                self.client.put_object_from_file(
-                    bucket=self.bucket_name,
-                    key=object_name,
-                    file_path=file_path
-                )
+                # 从文件路径上传，大文件分片并发上传
+                if os.path.getsize(file_path) > self.multipart_threshold:
+                    with open(file_path, 'rb') as f:
+                        self.upload_stream(object_name, f)
+                else:
+                    self.client.put_object_from_file(
+                        bucket=self.bucket_name,
+                        key=object_name,
+                        file_path=file_path
+                    )
             elif file_data:
-                # 从字节数据上传
-                self.client.put_object(
-                    bucket=self.bucket_name,
-                    key=object_name,
-                    content=file_data
-                )
+                # 从字节数据或文件对象上传，超过阈值时自动改为分片上传
+                self.upload_stream(object_name, file_data)
             else:
                 raise ValueError("必须提供 file_path 或 file_data 之一")
 
+            if content_hash:
+                try:
+                    index.record(content_hash[0], object_name, content_hash[1])
+                except Exception as e:
+                    print(f"记录内容索引失败: {e}")
+
             # 生成图片的访问 URL
-            image_url = f"https://{self.bucket_name}.{self.endpoint.replace('https://', '')}/{object_name}"
-            return image_url
+            return self.get_object_url(object_name)
         except Exception as e:
             print(f"上传图片失败: {e}")
             return ""
             
+    def get_object_url(self, object_name: str) -> str:
+        """生成对象的访问 URL"""
+        return f"https://{self.bucket_name}.{self.endpoint.replace('https://', '')}/{object_name}"
+
+    def upload_stream(self, object_name: str, data: Union[bytes, BinaryIO, Iterable[bytes]]) -> str:
+        """
+        流式上传到火山引擎 TOS：不超过 multipart_threshold 的内容单次上传，
+        更大的内容按 part_size 分片并发上传，内存中最多同时保留 upload_concurrency 个分片
+        :param object_name: 对象名称
+        :param data: 字节数据、可读的文件对象或字节块迭代器
+        :return: 对象的访问 URL，失败时抛出异常
+        """
+        if isinstance(data, (bytes, bytearray)):
+            if len(data) <= self.multipart_threshold:
+                self.client.put_object(bucket=self.bucket_name, key=object_name, content=data)
+                return self.get_object_url(object_name)
+            reader = _IterReader([bytes(data)])
+        elif hasattr(data, 'read'):
+            reader = data
+        else:
+            reader = _IterReader(data)
+
+        # 先读取阈值大小的内容，小文件无需分片
+        head = _read_full(reader, self.multipart_threshold + 1)
+        if len(head) <= self.multipart_threshold:
+            self.client.put_object(bucket=self.bucket_name, key=object_name, content=head)
+            return self.get_object_url(object_name)
+
+        self._multipart_upload(object_name, head, reader)
+        return self.get_object_url(object_name)
+
+    def _upload_part(self, object_name: str, upload_id: str, part_number: int, content: bytes) -> UploadedPart:
+        """上传单个分片，失败时按指数退避重试，只重传该分片"""
+        for attempt in range(self.part_retries + 1):
+            try:
+                result = self.client.upload_part(self.bucket_name, object_name, upload_id, part_number,
+                                                 content=content)
+                return UploadedPart(part_number, result.etag)
+            except Exception as e:
+                if attempt >= self.part_retries:
+                    raise
+                print(f"分片 {part_number} 上传失败，第 {attempt + 1} 次重试: {e}")
+                time.sleep(0.5 * (2 ** attempt))
+
+    def _multipart_upload(self, object_name: str, head: bytes, reader):
+        """分片上传：head 为已读取的开头内容，其余内容继续从 reader 读取"""
+        upload_id = self.client.create_multipart_upload(self.bucket_name, object_name).upload_id
+        # 在途分片数量受信号量限制，读取速度不会超过上传速度太多
+        slots = threading.BoundedSemaphore(self.upload_concurrency)
+        futures = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.upload_concurrency) as executor:
+                def submit(part_number: int, content: bytes):
+                    slots.acquire()
+                    future = executor.submit(self._upload_part, object_name, upload_id, part_number, content)
+                    future.add_done_callback(lambda _: slots.release())
+                    futures.append(future)
+
+                part_number = 1
+                pending = head
+                while True:
+                    while len(pending) >= self.part_size:
+                        submit(part_number, pending[:self.part_size])
+                        pending = pending[self.part_size:]
+                        part_number += 1
+                    # 有分片失败时停止读取，尽快中止上传
+                    if any(future.done() and future.exception() for future in futures):
+                        break
+                    chunk = _read_full(reader, self.part_size - len(pending))
+                    if not chunk:
+                        break
+                    pending += chunk
+                if pending:
+                    submit(part_number, pending)
+                parts = [future.result() for future in futures]
+
+            self.client.complete_multipart_upload(self.bucket_name, object_name, upload_id, parts)
+        except Exception:
+            try:
+                self.client.abort_multipart_upload(self.bucket_name, object_name, upload_id)
+            except Exception as abort_error:
+                print(f"中止分片上传失败: {abort_error}")
+            raise
+
     def delete_object(self, full_object_name: str) -> bool:
         """
         删除火山引擎 TOS 中的对象
@@ -63,6 +248,16 @@ class VolcengineTOSUtils:
         :return: 删除是否成功
         """
         try:
+            # 去重复用的对象可能被多条记录引用，只有最后一个引用被删除时才删除对象
+            index = self._content_index()
+            if index:
+                try:
+                    if not index.release(full_object_name):
+                        print(f"对象仍被其他记录引用，只减少引用次数: {full_object_name}")
+                        return True
+                except Exception as e:
+                    print(f"减少对象引用次数失败，保留对象: {e}")
+                    return False
             # 删除指定桶下的指定对象
             resp = self.client.delete_object(self.bucket_name, full_object_name)
             print(f"删除对象成功: {full_object_name}")
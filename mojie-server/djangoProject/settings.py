@@ -355,6 +355,72 @@ COMFYUI_SERVER_ADDRESS = '127.0.0.1:1004'
 REDIS_HOST = '127.0.0.1'
 REDIS_PORT = 6379
 
+# 任务队列后端：'zset' 为有序集合队列，'stream' 为 Redis Streams 消费组（阻塞读取、显式确认、崩溃回收，需 Redis >= 6.2）
+COMFYUI_QUEUE_BACKEND = 'zset'
+COMFYUI_STREAM_BLOCK_MS = 60000  # 空闲时单次阻塞等待时长（毫秒）
+COMFYUI_STREAM_CLAIM_IDLE_MS = 600000  # 已投递未确认的任务超过该时长无心跳，视为工作进程失效并回收（毫秒）
+
+# ComfyUI 多后端调度：可互相替代的服务器列表（需部署相同的模型和工作流），为空时只使用任务配置的服务器
+COMFYUI_BACKENDS = []
+COMFYUI_BACKEND_MAX_CONCURRENCY = 1  # 每个后端同时处理的任务数
+COMFYUI_BACKEND_CONCURRENCY = {}  # 按后端单独配置并发上限，如 {'127.0.0.1:8188': 2}
+COMFYUI_DISPATCH_WAIT_TIMEOUT = 600  # 等待空闲后端的最长时间（秒），超时后强制派发到负载最低的后端
+COMFYUI_BACKEND_HEALTH_TTL = 30  # 后端健康检查结果的复用时间（秒）
+COMFYUI_BACKEND_DOWN_COOLDOWN = 60  # 不健康后端的冷却时间（秒）
+COMFYUI_BACKEND_LEASE_TTL = 1800  # 后端占用超过该时间未释放视为泄漏并自动回收（秒）
+
+# 任务执行器：每个进程共享的有界线程池，处理中和排队的任务总数达到上限后拒绝新任务
+COMFYUI_TASK_EXECUTOR_WORKERS = 8  # 工作线程数
+COMFYUI_TASK_EXECUTOR_QUEUE = 200  # 等待队列容量
+COMFYUI_TASK_WAIT_FALLBACK_INTERVAL = 30  # 等待中的任务在没有任务事件时的兜底检查间隔（秒）
+COMFYUI_STATUS_FLUSH_INTERVAL = 5  # 任务中间状态（进度等）批量写回MySQL的间隔（秒），终态立即写入
+COMFYUI_STATUS_RECONCILE_INTERVAL = 10  # 后台修正任务状态的间隔（秒），状态查询接口本身不再写库
+COMFYUI_LONG_POLL_MAX_WAIT = 30  # 任务状态长轮询（wait参数）的最长等待时间（秒）
+COMFYUI_SSE_HEARTBEAT = 15  # 任务状态推送（SSE）的心跳间隔（秒）
+COMFYUI_SSE_MAX_DURATION = 300  # 单个SSE连接的最长保持时间（秒），到期后由客户端自动重连
+COMFYUI_SSE_MAX_STREAMS = 50  # 单个进程同时保持的SSE连接数上限；每个连接占用一个worker线程，需使用gthread/gevent等worker
+COMFYUI_RECOVERY_CHUNK_SIZE = 500  # 启动恢复和状态一致性扫描时每批处理的任务数
+COMFYUI_WORKFLOW_CACHE_CHECK_INTERVAL = 5  # 工作流模板缓存检查文件修改时间的最小间隔（秒）
+COMFYUI_WS_MAX_RECONNECT_DELAY = 30  # ComfyUI共享WebSocket连接断线重连的最大退避时间（秒）
+COMFYUI_WS_PING_INTERVAL = 30  # ComfyUI共享WebSocket连接空闲多久后发送ping保活（秒）
+COMFYUI_HTTP_POOL_SIZE = 10  # 每个ComfyUI服务器的HTTP连接池大小
+COMFYUI_HTTP_CONNECT_TIMEOUT = 5  # ComfyUI HTTP请求的连接超时（秒）
+COMFYUI_HTTP_READ_TIMEOUT = 60  # ComfyUI HTTP请求的读取超时（秒）
+COMFYUI_VIEW_SPOOL_MAX_SIZE = 8 * 1024 * 1024  # 流式下载输出图像时保留在内存中的最大字节数，超过后写入临时文件
+COMFYUI_GPU_CLEANUP_EVERY_N_TASKS = 20  # 同一ComfyUI服务器累计执行多少个任务后释放一次显存，0表示不按任务数清理
+COMFYUI_GPU_CLEANUP_VRAM_THRESHOLD = 0.9  # 任务结束后显存占用比例超过该值时释放显存，0表示不检查
+COMFYUI_GPU_CLEANUP_ON_MODEL_CHANGE = True  # 下一个工作流使用不同模型时是否先释放显存
+COMFYUI_UPLOAD_CONCURRENCY = 4  # 任务输出图像并发上传到TOS的线程数（进程内共享）
+COMFYUI_UPLOAD_RETRIES = 2  # 单张图像上传TOS失败后的重试次数
+CONTENT_DEDUP_ENABLED = True  # 上传到TOS时按内容SHA-256去重，同一目录下相同内容复用已有对象
+CONTENT_DEDUP_CACHE_TTL = 7 * 24 * 3600  # 内容索引在Redis中的缓存时间（秒），过期后从数据库回填
+COMFYUI_ENGINE_MAX_CONCURRENCY = None  # 执行引擎中每个服务器同时执行的工作流数（图像和视频共用），None表示与COMFYUI_BACKEND_MAX_CONCURRENCY一致
+COMFYUI_ENGINE_CONCURRENCY = {}  # 按服务器单独配置执行引擎并发数，如 {'127.0.0.1:8188': 2}
+HTTP_POOL_SIZE = 20  # 共享HTTP会话每个主机的最大连接数
+API_REQUEST_CONCURRENCY = 16  # 每个进程预计同时进行的APIRoundRobin调用数，用于确定共享请求线程池大小
+API_HEDGE_MAX_IN_FLIGHT = 2  # 单次调用同时进行的端点请求数上限（含对冲请求）
+API_HEDGE_MIN_SAMPLES = 5  # 端点累计多少个成功样本后按p95延迟决定对冲等待时间
+API_HEDGE_MIN_DELAY = 0.5  # 对冲等待时间下限（秒）
+API_LATENCY_WINDOW = 100  # 每个端点保留的最近延迟样本数
+API_BREAKER_FAILURE_THRESHOLD = 5  # 端点连续失败多少次后熔断
+API_BREAKER_COOLDOWN = 30  # 熔断持续时间（秒），之后放行一个试探请求
+IMAGE_PAYLOAD_CACHE_MEMORY_MB = 128  # 内存LRU缓存上限（MB）
+IMAGE_PAYLOAD_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'image_payloads')  # 磁盘缓存目录，为空时只使用内存缓存
+IMAGE_PAYLOAD_CACHE_DISK_MB = 1024  # 磁盘缓存上限（MB），超过后删除最久未使用的文件
+IMAGE_PAYLOAD_CACHE_REVALIDATE = 86400  # 缓存超过该时间（秒）后用ETag向源站确认是否变化
+FLUX_POLL_INITIAL_INTERVAL = 0.5  # Flux任务首次轮询前的等待时间（秒）
+FLUX_POLL_MAX_INTERVAL = 5  # Flux轮询间隔上限（秒），间隔每次乘以FLUX_POLL_BACKOFF
+FLUX_POLL_BACKOFF = 1.5  # Flux轮询间隔的放大倍数
+FLUX_POLL_TIMEOUT = 150  # 单个Flux任务的最长等待时间（秒）
+FLUX_POLL_MAX_CONCURRENT_REQUESTS = 50  # 同时发出的Flux轮询请求数上限
+FLUX_RESULT_WORKERS = 8  # Flux结果下载、存储线程数
+FLUX_INPUT_MAX_PIXELS = 1024 * 1024  # Flux输入图片（含网格拼接结果）的最大像素数，超过时先缩小再编码
+FLUX_INPUT_FORMAT = 'JPEG'  # Flux输入图片的编码格式（JPEG/PNG）
+FLUX_INPUT_JPEG_QUALITY = 90  # Flux输入图片的JPEG质量
+FLUX_INPUT_PNG_COMPRESS_LEVEL = 1  # FLUX_INPUT_FORMAT为PNG时的压缩级别（0-9）
+FLUX_INPUT_CACHE_SIZE = 32  # 按输入图片内容缓存的编码结果数量
+IMAGE_IO_WORKERS = 8  # ChatGPT图像编辑输入图片并发下载、解码的线程数
+
 WHITE_SERVER_ADDRESS = "http://127.0.0.1:8000/segment"
 
 FLUX_KONEXT_PRO_API_KEY = "38"
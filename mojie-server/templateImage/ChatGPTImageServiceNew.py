@@ -3,11 +3,11 @@ import base64
 import logging
 import uuid
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional, Tuple
 from io import BytesIO
 from PIL import Image
 from django.conf import settings
-import tempfile
 import os
 import time
 import openai
@@ -17,6 +17,7 @@ import numpy as np
 from django.db import transaction
 
 from common.ErrorCode import ErrorCode
+from common.http_session import get_shared_session
 from common.volcengine_tos_utils import VolcengineTOSUtils
 from exception.business_exception import BusinessException
 from templateImage.ImagesRequest import ImageUploadManager
@@ -24,6 +25,12 @@ from templateImage.ImagesRequest import ImageUploadManager
 
 logger = logging.getLogger(__name__)
 
+# 输入图片下载和解码的共享线程池
+_image_io_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'IMAGE_IO_WORKERS', 8),
+    thread_name_prefix='image-io'
+)
+
 class ChatGPTImageServiceNew:
     """支持新的GPT图像生成API的服务类"""
 
@@ -239,35 +246,37 @@ class ChatGPTImageServiceNew:
                 'logs': self.log_messages
             }
 
-    def _download_image(self, url):
+    def _download_image(self, url) -> bytes:
         """
-        从URL下载图片到临时文件
-        
+        从URL下载图片到内存
+
         Args:
             url (str): 图片URL
-            
+
         Returns:
-            str: 临时文件路径
+            bytes: 图片二进制数据
         """
         try:
-            response = requests.get(url, stream=True)
+            response = get_shared_session('image_download').get(url, timeout=60)
             response.raise_for_status()
-            
-            # 创建临时文件
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.png')
-            temp_path = temp_file.name
-            
-            # 保存图片
-            with open(temp_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-            
-            return temp_path
+            return response.content
         except Exception as e:
             logger.error(f"下载图片失败: {str(e)}")
             raise BusinessException(error_code=ErrorCode.FAIL, data='', errors=f"下载图片失败: {str(e)}")
 
+    def _read_image(self, path) -> bytes:
+        """读取图片数据，URL下载到内存，本地路径直接读取"""
+        if self._is_url(path):
+            return self._download_image(path)
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _read_images(self, paths: List[str]) -> List[bytes]:
+        """并发读取多张图片，总耗时取决于最慢的一张，返回顺序与paths一致"""
+        if len(paths) == 1:
+            return [self._read_image(paths[0])]
+        return list(_image_io_executor.map(self._read_image, paths))
+
     def _is_url(self, path):
         """
         判断是否为URL
@@ -313,10 +322,6 @@ class ChatGPTImageServiceNew:
         Returns:
             Dict: 包含处理结果的字典
         """
-        temp_files = []
-        retry_count = 0
-        max_retries = 3
-        base_delay = 2  # 基础延迟时间（秒）
         seed = self._generate_random_seed()  # 生成随机种子，仅用于数据库记录
 
         # 根据操作类型选择合适的处理方法
@@ -352,182 +357,153 @@ class ChatGPTImageServiceNew:
                 )
 
         # 以下为单图编辑模式（可能带遮罩）
-        while retry_count < max_retries:
-            try:
-                self.log(f"开始图像编辑流程, 操作类型: {operation_type}")
-
-                # 处理图片路径
-                processed_image_paths = []
-                if image_paths:
-                    for path in image_paths:
-                        if self._is_url(path):
-                            temp_path = self._download_image(path)
-                            temp_files.append(temp_path)
-                            processed_image_paths.append(temp_path)
-                        else:
-                            processed_image_paths.append(path)
-                
-                # 确保至少有一张输入图片
-                if not processed_image_paths:
-                    error_msg = "单图编辑模式需要提供至少一张图片"
-                    self.log(error_msg)
-                    return {
-                        'success': False,
-                        'error': error_msg,
-                        'message': '图像编辑失败',
-                        'logs': self.log_messages
-                    }
-
-                # 处理遮罩图片
-                processed_mask_path = None
-                if operation_type == "mask_edit" and mask_path:
-                    if self._is_url(mask_path):
-                        temp_path = self._download_image(mask_path)
-                        temp_files.append(temp_path)
-                        processed_mask_path = temp_path
-                    else:
-                        processed_mask_path = mask_path
-
-                # 打开图片文件 - 只使用第一张图片
-                image_file = open(processed_image_paths[0], "rb")
-                mask_file = None
-                
-                # 只有在mask_edit模式下才打开遮罩文件
-                if operation_type == "mask_edit" and processed_mask_path:
-                    try:
-                        mask_file = open(processed_mask_path, "rb")
-                    except Exception as e:
-                        self.log(f"打开遮罩文件失败: {str(e)}")
-                        # 关闭已打开的文件
-                        image_file.close()
-                        return {
-                            'success': False,
-                            'error': f"打开遮罩文件失败: {str(e)}",
-                            'message': '图像编辑失败',
-                            'logs': self.log_messages
-                        }
-
-                try:
-                    # 根据操作类型和参数调用不同的API
-                    if operation_type == "mask_edit" and mask_file:
-                        # 带遮罩的编辑模式
-                        self.log("使用带遮罩的编辑模式")
-                        result = self.client.images.edit(
-                            model=settings.CHATGPT_CONFIG_OPENAI['MODEL'],
-                            image=image_file,
-                            mask=mask_file,
-                            prompt=prompt,
-                            size=size
-                        )
-                    else:
-                        # 不带遮罩的编辑模式
-                        self.log("使用不带遮罩的编辑模式")
-                        result = self.client.images.edit(
-                            model=settings.CHATGPT_CONFIG_OPENAI['MODEL'],
-                            image=image_file,
-                            prompt=prompt,
-                            size=size
-                        )
-
-                    # 处理返回结果
-                    if not result.data:
-                        raise ValueError("API未返回图像数据")
-
-                    image_data = result.data[0]
-                    image_base64 = image_data.b64_json
-                    image_url = image_data.url
-
-                    # 获取图像数据
-                    if image_base64:
-                        img_data = base64.b64decode(image_base64)
-                    elif image_url:
-                        response = requests.get(image_url)
-                        response.raise_for_status()
-                        img_data = response.content
-                    else:
-                        raise ValueError("API未返回有效的图像数据")
-
-                    # 存储到OSS
-                    oss_url, filename = self._store_to_oss(img_data, upload_record_id)
-                    self.log(f"编辑后的图像已存储到OSS: {oss_url}")
-
-                    
-
-                    # 更新数据库记录
-                    if upload_record_id:
-                        self._update_database_record(
-                            upload_record_id=upload_record_id,
-                            image_url=oss_url,
-                            image_name=filename,
-                            prompt=prompt,
-                            user_id=user_id,
-                            conversation_id=conversation_id,
-                            seed=seed,
-                            image_paths=image_paths
-                        )
-
-                    return {
-                        'success': True,
-                        'image_url': oss_url,
-                        'image_name': filename,
-                        'prompt': prompt,
-                        'model_used': settings.CHATGPT_CONFIG_OPENAI['MODEL'],
-                        'seed_used': seed,  # 在返回结果中包含使用的种子
-                        'operation_type': operation_type,
-                        'size': size,
-                        'logs': self.log_messages
-                    }
-
-                except Exception as e:
-                    error_msg = f"图像编辑失败: {str(e)}"
-                    self.log(error_msg)
-                    logger.error(error_msg, exc_info=True)
-                    
-                    # 如果是连接错误，进行重试
-                    # if isinstance(e, (openai.APIConnectionError, httpx.RemoteProtocolError)):
-                    #     retry_count += 1
-                    #     if retry_count < max_retries:
-                    #         delay = base_delay * (2 ** (retry_count - 1))  # 指数退避
-                    #         self.log(f"连接错误，{delay}秒后进行第{retry_count + 1}次重试")
-                    #         time.sleep(delay)
-                    #         continue
-                    
-                    return {
-                        'success': False,
-                        'error': str(e),
-                        'message': '图像编辑失败',
-                        'operation_type': operation_type,
-                        'size': size,
-                        'logs': self.log_messages
-                    }
-                finally:
-                    # 关闭所有打开的文件
-                    if image_file:
-                        image_file.close()
-                    if mask_file:
-                        mask_file.close()
+        try:
+            self.log(f"开始图像编辑流程, 操作类型: {operation_type}")
 
-            except Exception as e:
-                error_msg = f"图像编辑失败: {str(e)}"
+            # 确保至少有一张输入图片
+            if not image_paths:
+                error_msg = "单图编辑模式需要提供至少一张图片"
                 self.log(error_msg)
-                logger.error(error_msg, exc_info=True)
                 return {
                     'success': False,
-                    'error': str(e),
+                    'error': error_msg,
                     'message': '图像编辑失败',
-                    'operation_type': operation_type,
-                    'size': size,
                     'logs': self.log_messages
                 }
-            finally:
-                # 清理临时文件
-                for temp_file in temp_files:
-                    try:
-                        if os.path.exists(temp_file):
-                            os.remove(temp_file)
-                    except Exception as e:
-                        self.log(f"清理临时文件失败: {str(e)}")
-                        pass
+
+            # 只使用第一张图片，遮罩与图片同时下载
+            if operation_type == "mask_edit" and mask_path:
+                image_data, mask_data = self._read_images([image_paths[0], mask_path])
+            else:
+                image_data, mask_data = self._read_image(image_paths[0]), None
+        except Exception as e:
+            error_msg = f"图像编辑失败: {str(e)}"
+            self.log(error_msg)
+            logger.error(error_msg, exc_info=True)
+            return {
+                'success': False,
+                'error': str(e),
+                'message': '图像编辑失败',
+                'operation_type': operation_type,
+                'size': size,
+                'logs': self.log_messages
+            }
+
+        return self._edit_image_data(
+            prompt=prompt,
+            image_data=image_data,
+            mask_data=mask_data,
+            image_paths=image_paths,
+            user_id=user_id,
+            conversation_id=conversation_id,
+            upload_record_id=upload_record_id,
+            operation_type=operation_type,
+            size=size,
+            seed=seed
+        )
+
+    def _edit_image_data(
+            self,
+            prompt: str,
+            image_data: bytes,
+            mask_data: Optional[bytes],
+            image_paths: List[str],
+            user_id: int,
+            conversation_id: int,
+            upload_record_id: int,
+            operation_type: str,
+            size: str,
+            seed: int
+    ) -> Dict:
+        """
+        使用内存中的图片数据调用编辑API，存储结果并更新数据库
+
+        Args:
+            image_data: 输入图片数据
+            mask_data: 遮罩图片数据（仅用于mask_edit模式）
+            image_paths: 原始图片路径列表，用于数据库记录
+        """
+        try:
+            # 根据操作类型和参数调用不同的API
+            if operation_type == "mask_edit" and mask_data:
+                # 带遮罩的编辑模式
+                self.log("使用带遮罩的编辑模式")
+                result = self.client.images.edit(
+                    model=settings.CHATGPT_CONFIG_OPENAI['MODEL'],
+                    image=("image.png", image_data, "image/png"),
+                    mask=("mask.png", mask_data, "image/png"),
+                    prompt=prompt,
+                    size=size
+                )
+            else:
+                # 不带遮罩的编辑模式
+                self.log("使用不带遮罩的编辑模式")
+                result = self.client.images.edit(
+                    model=settings.CHATGPT_CONFIG_OPENAI['MODEL'],
+                    image=("image.png", image_data, "image/png"),
+                    prompt=prompt,
+                    size=size
+                )
+
+            # 处理返回结果
+            if not result.data:
+                raise ValueError("API未返回图像数据")
+
+            image_data = result.data[0]
+            image_base64 = image_data.b64_json
+            image_url = image_data.url
+
+            # 获取图像数据
+            if image_base64:
+                img_data = base64.b64decode(image_base64)
+            elif image_url:
+                response = requests.get(image_url)
+                response.raise_for_status()
+                img_data = response.content
+            else:
+                raise ValueError("API未返回有效的图像数据")
+
+            # 存储到OSS
+            oss_url, filename = self._store_to_oss(img_data, upload_record_id)
+            self.log(f"编辑后的图像已存储到OSS: {oss_url}")
+
+            # 更新数据库记录
+            if upload_record_id:
+                self._update_database_record(
+                    upload_record_id=upload_record_id,
+                    image_url=oss_url,
+                    image_name=filename,
+                    prompt=prompt,
+                    user_id=user_id,
+                    conversation_id=conversation_id,
+                    seed=seed,
+                    image_paths=image_paths
+                )
+
+            return {
+                'success': True,
+                'image_url': oss_url,
+                'image_name': filename,
+                'prompt': prompt,
+                'model_used': settings.CHATGPT_CONFIG_OPENAI['MODEL'],
+                'seed_used': seed,  # 在返回结果中包含使用的种子
+                'operation_type': operation_type,
+                'size': size,
+                'logs': self.log_messages
+            }
+
+        except Exception as e:
+            error_msg = f"图像编辑失败: {str(e)}"
+            self.log(error_msg)
+            logger.error(error_msg, exc_info=True)
+            return {
+                'success': False,
+                'error': str(e),
+                'message': '图像编辑失败',
+                'operation_type': operation_type,
+                'size': size,
+                'logs': self.log_messages
+            }
 
     def _store_to_oss(self, image_data: bytes, upload_record_id: int = None) -> Tuple[str, str]:
         """存储图像到OSS"""
@@ -622,85 +598,30 @@ class ChatGPTImageServiceNew:
 
     def merge_images(self, prompt, image_paths, user_id, conversation_id=None, upload_record_id=None, size: str = "1024x1024"):
         """
-        合并多张图片并进行编辑
-        
+        合并多张图片并进行编辑（全程在内存中处理，不写临时文件）
+
         Args:
             prompt (str): 图片生成提示词
             image_paths (list): 图片路径列表
             user_id (int): 用户ID
             conversation_id (int, optional): 会话ID
             upload_record_id (int, optional): 上传记录ID
-            
+
         Returns:
             dict: 包含处理结果的字典
         """
-        temp_files = []
         seed = self._generate_random_seed()  # 生成随机种子
         original_paths = image_paths.copy()  # 保存原始路径，用于数据库记录
-        
+
         try:
             self.log(f"开始合并图片流程，图片数量: {len(image_paths)}")
-            
-            # 处理图片路径
-            processed_image_paths = []
-            for path in image_paths:
-                if self._is_url(path):
-                    temp_path = self._download_image(path)
-                    temp_files.append(temp_path)
-                    processed_image_paths.append(temp_path)
-                else:
-                    processed_image_paths.append(path)
-
-            # 读取所有图片
-            images = []
-            for path in processed_image_paths:
-                try:
-                    image = Image.open(path)
-                    # 确保所有图片都转换为RGB模式
-                    image = image.convert('RGB')
-                    images.append(image)
-                except Exception as e:
-                    error_msg = f"读取图片失败: {str(e)}"
-                    self.log(error_msg)
-                    logger.error(error_msg)
-                    return {
-                        'success': False,
-                        'error': error_msg,
-                        'message': '合并图片失败',
-                        'operation_type': 'edit',
-                        'size': size,
-                        'logs': self.log_messages
-                    }
-
-            # 确保所有图片尺寸一致
-            base_size = images[0].size
-            for i in range(1, len(images)):
-                if images[i].size != base_size:
-                    self.log(f"调整图片 {i+1} 尺寸从 {images[i].size} 到 {base_size}")
-                    images[i] = images[i].resize(base_size, Image.Resampling.LANCZOS)
-
-            # 创建合并后的图片
-            merged_image = Image.new('RGB', base_size)
-            
-            # 计算每张图片的权重
-            weight = 1.0 / len(images)
-            
-            # 合并图片
-            try:
-                # 将图片转换为numpy数组
-                merged_array = None
-                for i, image in enumerate(images):
-                    img_array = np.array(image)
-                    # 应用权重
-                    img_array = img_array * weight
-                    # 添加到合并图片
-                    if i == 0:
-                        merged_array = img_array
-                    else:
-                        merged_array += img_array
 
-                # 将numpy数组转回PIL图片
-                merged_image = Image.fromarray(merged_array.astype(np.uint8))
+            # 并发下载所有图片
+            image_datas = self._read_images(image_paths)
+
+            # 按平均权重合并图片
+            try:
+                merged_image = self._blend_images(image_datas)
             except Exception as e:
                 error_msg = f"合并图片时出错: {str(e)}"
                 self.log(error_msg)
@@ -714,41 +635,27 @@ class ChatGPTImageServiceNew:
                     'logs': self.log_messages
                 }
 
-            # 保存合并后的图片
-            temp_merged_path = f"temp_merged_{upload_record_id if upload_record_id else uuid.uuid4()}.png"
-            merged_image.save(temp_merged_path)
-            temp_files.append(temp_merged_path)
-            self.log(f"已创建合并图片: {temp_merged_path}")
+            buffered = BytesIO()
+            merged_image.save(buffered, format='PNG')
+            self.log(f"已创建合并图片: {merged_image.size[0]}x{merged_image.size[1]}")
 
-            # 使用合并后的图片进行编辑（不带遮罩）
+            # 使用合并后的图片进行编辑（不带遮罩），数据库记录原始图片路径
             self.log("使用合并图片进行编辑")
-            # 调用edit_image方法，但传递原始图片路径列表用于数据库记录
-            edit_result = self.edit_image(
+            edit_result = self._edit_image_data(
                 prompt=prompt,
-                image_paths=[temp_merged_path],
+                image_data=buffered.getvalue(),
+                mask_data=None,
+                image_paths=original_paths,
                 user_id=user_id,
                 conversation_id=conversation_id,
                 upload_record_id=upload_record_id,
                 operation_type="edit",  # 强制使用edit模式
-                size=size
+                size=size,
+                seed=seed
             )
-            
-            # 如果编辑成功，手动更新数据库记录中的image_list字段
-            if edit_result['success'] and upload_record_id:
-                try:
-                    # 将原始图片路径保存到数据库
-                    image_list = ",".join(original_paths)
-                    ImageUploadManager.update_record_by_id(
-                        record_id=upload_record_id,
-                        image_list=image_list
-                    )
-                    self.log(f"已更新数据库中的图片列表: {image_list}")
-                except Exception as e:
-                    self.log(f"更新图片列表失败: {str(e)}")
 
-            # 确保结果中包含使用的种子和原始图片路径
+            # 确保结果中包含原始图片路径
             if edit_result['success']:
-                edit_result['seed_used'] = seed
                 edit_result['merged_image'] = True  # 标记为合并图片结果
                 edit_result['original_image_paths'] = original_paths  # 记录原始图片路径
 
@@ -766,13 +673,26 @@ class ChatGPTImageServiceNew:
                 'size': size,
                 'logs': self.log_messages
             }
-        finally:
-            # 清理临时文件
-            for temp_file in temp_files:
-                try:
-                    if os.path.exists(temp_file):
-                        os.remove(temp_file)
-                        self.log(f"已删除临时文件: {temp_file}")
-                except Exception as e:
-                    self.log(f"清理临时文件失败: {str(e)}")
-                    pass 
\ No newline at end of file
+
+    def _blend_images(self, image_datas: List[bytes]) -> Image.Image:
+        """
+        按平均权重合并图片：以第一张图片的尺寸为准，各图片并发解码到预先分配的数组中，一次计算加权和；
+        与逐张乘以权重后累加的原实现一样使用float64并按图片顺序求和，输出不变
+        """
+        base_size = Image.open(BytesIO(image_datas[0])).size
+        width, height = base_size
+        stack = np.empty((len(image_datas), height, width, 3), dtype=np.uint8)
+
+        def decode(index):
+            image = Image.open(BytesIO(image_datas[index]))
+            # 确保所有图片都转换为RGB模式，尺寸与第一张一致
+            image = image.convert('RGB')
+            if image.size != base_size:
+                self.log(f"调整图片 {index + 1} 尺寸从 {image.size} 到 {base_size}")
+                image = image.resize(base_size, Image.Resampling.LANCZOS)
+            stack[index] = np.asarray(image)
+
+        # PIL解码和缩放时释放GIL，多张图片可以并行处理
+        list(_image_io_executor.map(decode, range(len(image_datas))))
+        merged_array = (stack * (1.0 / len(image_datas))).sum(axis=0)
+        return Image.fromarray(merged_array.astype(np.uint8))
@@ -1,13 +1,13 @@
-import base64
 import logging
 import uuid
 import requests
-import time
 import json
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import List, Dict, Optional, Tuple
 from io import BytesIO
 from PIL import Image
 from django.conf import settings
+from django.db import close_old_connections
 import numpy as np
 
 from common.BaiduTranslateService import BaiduTranslateService
@@ -15,9 +15,17 @@ from common.ErrorCode import ErrorCode
 from common.volcengine_tos_utils import VolcengineTOSUtils
 from exception.business_exception import BusinessException
 from templateImage.ImagesRequest import ImageUploadManager
+from templateImage.flux_input import flux_input_preparer
+from templateImage.flux_polling import flux_polling_scheduler
 
 logger = logging.getLogger(__name__)
 
+# 轮询结束后下载、存储结果的共享线程池（只在结果就绪后短暂占用线程）
+_result_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'FLUX_RESULT_WORKERS', 8),
+    thread_name_prefix='flux-result'
+)
+
 class FluxKontextProService:
     """Flux Kontext Pro API 图像生成服务"""
 
@@ -25,7 +33,6 @@ class FluxKontextProService:
         self.log_messages = []
         self.api_url = settings.FLUX_KONEXT_PRO_URL
         self.max_retries = 3
-        self.polling_interval = 2  # 轮询间隔（秒）
 
     def log(self, message: str):
         """记录处理日志"""
@@ -142,39 +149,6 @@ class FluxKontextProService:
                 self.log(f"标记失败状态也失败: {str(db_error)}")
             raise ValueError(f"数据库更新失败: {str(e)}")
 
-    def _poll_result(self, polling_url: str, max_retries: int = 60) -> Dict:
-        """轮询获取结果"""
-        retry_count = 0
-        self.log(f"polling_url结果: {polling_url}")
-        while retry_count < max_retries:
-            try:
-                response = requests.get(polling_url, timeout=10)  # 设置单次请求超时
-                response.raise_for_status()
-                result = response.json()
-                
-                if result.get('status') == 'Ready':
-                    return result
-                elif result.get('status') == 'Failed':
-                    raise ValueError(f"任务处理失败: {result.get('details', '未知错误')}")
-                
-                # 等待后继续轮询
-                time.sleep(self.polling_interval)
-                retry_count += 1
-                
-            except requests.exceptions.Timeout:
-                self.log(f"轮询请求超时，重试中... ({retry_count + 1}/{max_retries})")
-                retry_count += 1
-                continue
-            except requests.exceptions.RequestException as e:
-                self.log(f"轮询请求异常: {str(e)}，重试中... ({retry_count + 1}/{max_retries})")
-                retry_count += 1
-                continue
-            except Exception as e:
-                self.log(f"轮询失败: {str(e)}")
-                raise ValueError(f"获取结果失败: {str(e)}")
-        
-        raise ValueError("轮询超时，请稍后重试")
-
     def generate_image(
             self,
             prompt: str,
@@ -189,8 +163,38 @@ class FluxKontextProService:
             safety_tolerance: int = 2
     ) -> Dict:
         """
-        生成或编辑图像
-        
+        生成或编辑图像（同步等待结果，参数和返回值见 start_generation）
+        """
+        return self.start_generation(
+            prompt=prompt,
+            image_urls=image_urls,
+            user_id=user_id,
+            conversation_id=conversation_id,
+            upload_record_id=upload_record_id,
+            seed=seed,
+            aspect_ratio=aspect_ratio,
+            output_format=output_format,
+            prompt_upsampling=prompt_upsampling,
+            safety_tolerance=safety_tolerance
+        ).result()
+
+    def start_generation(
+            self,
+            prompt: str,
+            image_urls: List[str] = None,
+            user_id: int = None,
+            conversation_id: int = None,
+            upload_record_id: int = None,
+            seed: int = None,
+            aspect_ratio: str = None,
+            output_format: str = "png",
+            prompt_upsampling: bool = False,
+            safety_tolerance: int = 2
+    ) -> Future:
+        """
+        提交图像生成或编辑请求，提交成功后立即返回
+        结果在共享轮询调度器上等待，不占用调用线程；就绪后在结果处理线程池中下载、存储并更新数据库
+
         Args:
             prompt: 生成提示词
             image_urls: 输入图片URL列表（可选）
@@ -202,66 +206,123 @@ class FluxKontextProService:
             output_format: 输出格式（png/jpeg）
             prompt_upsampling: 是否进行提示词上采样
             safety_tolerance: 安全容忍度（0-6）
-            
+
         Returns:
-            Dict: 包含处理结果的字典
+            Future: 结果为包含处理结果的字典
         """
         self.log_messages = []  # 重置日志
+        result_future = Future()
         try:
             self.log("开始图像生成流程")
-
-            translate_service = BaiduTranslateService()
-            result = translate_service.translate(prompt)
-
-            # 准备请求数据
-            payload = {
-                "prompt": result,
-                "input_image": None,  # 初始化为None，后续如果有图片再设置
-                "seed": seed,
-                "aspect_ratio": aspect_ratio if aspect_ratio else None,
-                "output_format": output_format,
-                "prompt_upsampling": prompt_upsampling,
-                "safety_tolerance": safety_tolerance
-            }
-
-            # 处理输入图片
-            if image_urls:
-                # 下载并合并图片
-                image_data = self._process_input_images(image_urls)
-                if image_data:
-                    payload["input_image"] = image_data
-
-            # 移除值为None的键
-            payload = {k: v for k, v in payload.items() if v is not None}
-
-            # 记录构建的payload（隐藏图片数据）
-            log_payload = payload.copy()
-            if "input_image" in log_payload:
-                log_payload["input_image"] = "<base64_image_data>"
-            self.log(f"构建的请求payload: {json.dumps(log_payload, indent=2)}")
-
-            # 发送请求
-            headers = {
-                "x-key": settings.FLUX_KONEXT_PRO_API_KEY,
-                "Content-Type": "application/json"
-            }
-
-            response = requests.post(
-                self.api_url,
-                json=payload,
-                headers=headers,
-                timeout=120  # 设置初始请求超时
+            polling_url = self._submit_request(
+                prompt=prompt,
+                image_urls=image_urls,
+                seed=seed,
+                aspect_ratio=aspect_ratio,
+                output_format=output_format,
+                prompt_upsampling=prompt_upsampling,
+                safety_tolerance=safety_tolerance
             )
-            response.raise_for_status()
-            result = response.json()
-
-            # 检查响应
-            if not result.get('polling_url'):
-                raise ValueError("API未返回轮询URL")
+        except Exception as e:
+            result_future.set_result(self._failure_result(e, upload_record_id))
+            return result_future
 
-            # 轮询获取结果
+        # 轮询获取结果
+        self.log(f"polling_url结果: {polling_url}")
+        poll_future = flux_polling_scheduler.watch(polling_url)
+        poll_future.add_done_callback(lambda f: _result_executor.submit(
+            self._complete_generation,
+            poll_future=f,
+            result_future=result_future,
+            prompt=prompt,
+            image_urls=image_urls,
+            user_id=user_id,
+            conversation_id=conversation_id,
+            upload_record_id=upload_record_id,
+            seed=seed
+        ))
+        return result_future
+
+    def _submit_request(
+            self,
+            prompt: str,
+            image_urls: Optional[List[str]],
+            seed: Optional[int],
+            aspect_ratio: Optional[str],
+            output_format: str,
+            prompt_upsampling: bool,
+            safety_tolerance: int
+    ) -> str:
+        """构建payload并提交生成请求，返回轮询URL"""
+        translate_service = BaiduTranslateService()
+        result = translate_service.translate(prompt)
+
+        # 准备请求数据
+        payload = {
+            "prompt": result,
+            "input_image": None,  # 初始化为None，后续如果有图片再设置
+            "seed": seed,
+            "aspect_ratio": aspect_ratio if aspect_ratio else None,
+            "output_format": output_format,
+            "prompt_upsampling": prompt_upsampling,
+            "safety_tolerance": safety_tolerance
+        }
+
+        # 处理输入图片
+        if image_urls:
+            # 下载并合并图片
+            image_data = self._process_input_images(image_urls)
+            if image_data:
+                payload["input_image"] = image_data
+
+        # 移除值为None的键
+        payload = {k: v for k, v in payload.items() if v is not None}
+
+        # 记录构建的payload（隐藏图片数据）
+        log_payload = payload.copy()
+        if "input_image" in log_payload:
+            log_payload["input_image"] = "<base64_image_data>"
+        self.log(f"构建的请求payload: {json.dumps(log_payload, indent=2)}")
+
+        # 发送请求
+        headers = {
+            "x-key": settings.FLUX_KONEXT_PRO_API_KEY,
+            "Content-Type": "application/json"
+        }
+
+        response = requests.post(
+            self.api_url,
+            json=payload,
+            headers=headers,
+            timeout=120  # 设置初始请求超时
+        )
+        response.raise_for_status()
+        result = response.json()
+
+        # 检查响应
+        if not result.get('polling_url'):
+            raise ValueError("API未返回轮询URL")
+        return result['polling_url']
+
+    def _complete_generation(
+            self,
+            poll_future: Future,
+            result_future: Future,
+            prompt: str,
+            image_urls: Optional[List[str]],
+            user_id: Optional[int],
+            conversation_id: Optional[int],
+            upload_record_id: Optional[int],
+            seed: Optional[int]
+    ):
+        """
+        轮询结束后下载生成的图片、存储到OSS并更新数据库，结果写入result_future
+        在共享线程池中执行，不经过请求周期，前后自行清理失效或超时的数据库连接
+        """
+        close_old_connections()
+        try:
             try:
-                final_result = self._poll_result(result['polling_url'])
+                final_result = poll_future.result()
             except ValueError as e:
                 if "轮询超时" in str(e):
                     # 如果轮询超时，检查是否已经有结果
@@ -269,7 +330,7 @@ class FluxKontextProService:
                         record = ImageUploadManager.get_record_by_id(upload_record_id)
                         if record and record.image_url and record.image_url != "pending":
                             self.log("检测到已有生成结果，使用已有结果")
-                            return {
+                            result_future.set_result({
                                 'success': True,
                                 'image_url': record.image_url,
                                 'image_name': record.image_name,
@@ -277,7 +338,8 @@ class FluxKontextProService:
                                 'seed_used': seed,
                                 'model_used': 'flux_kontext_pro',
                                 'logs': self.log_messages
-                            }
+                            })
+                            return
                 raise e
 
             if not final_result.get('result', {}).get('sample'):
@@ -308,7 +370,7 @@ class FluxKontextProService:
                     image_paths=image_urls
                 )
 
-            return {
+            result_future.set_result({
                 'success': True,
                 'image_url': oss_url,
                 'image_name': filename,
@@ -316,110 +378,50 @@ class FluxKontextProService:
                 'seed_used': seed,
                 'model_used': 'flux_kontext_pro',
                 'logs': self.log_messages
-            }
+            })
 
         except Exception as e:
-            error_msg = f"图像生成失败: {str(e)}"
-            self.log(error_msg)
-            logger.error(error_msg, exc_info=True)
-            
-            if upload_record_id:
-                try:
-                    ImageUploadManager.mark_as_failed(
-                        record_id=upload_record_id,
-                        error_message=error_msg
-                    )
-                except Exception as db_error:
-                    self.log(f"更新失败状态也失败: {str(db_error)}")
-            
-            return {
-                'success': False,
-                'error': str(e),
-                'message': '图像生成失败',
-                'logs': self.log_messages
-            }
+            result_future.set_result(self._failure_result(e, upload_record_id))
+        finally:
+            close_old_connections()
+
+    def _failure_result(self, error: Exception, upload_record_id: Optional[int]) -> Dict:
+        """记录失败并构建失败结果"""
+        error_msg = f"图像生成失败: {str(error)}"
+        self.log(error_msg)
+        logger.error(error_msg, exc_info=error)
+
+        if upload_record_id:
+            try:
+                ImageUploadManager.mark_as_failed(
+                    record_id=upload_record_id,
+                    error_message=error_msg
+                )
+            except Exception as db_error:
+                self.log(f"更新失败状态也失败: {str(db_error)}")
+
+        return {
+            'success': False,
+            'error': str(error),
+            'message': '图像生成失败',
+            'logs': self.log_messages
+        }
 
     def _process_input_images(self, image_urls: List[str]) -> Optional[str]:
-        """处理输入图片，返回base64编码的图片数据"""
+        """处理输入图片，返回base64编码的图片数据（多张时拼接为网格）"""
         try:
             if not image_urls:
                 return None
 
-            # 如果只有一张图片，直接处理并返回
-            if len(image_urls) == 1:
-                img_data = self._download_image(image_urls[0])
-                img = Image.open(BytesIO(img_data))
-                # 确保图片为RGB模式
-                img = img.convert('RGB')
-                
-                # 转换为base64
-                img_byte_arr = BytesIO()
-                img.save(img_byte_arr, format='PNG')
-                img_byte_arr = img_byte_arr.getvalue()
-                
-                return base64.b64encode(img_byte_arr).decode('utf-8')
-
-            # 多张图片的情况，进行网格拼接处理
-            self.log(f"处理多张图片，数量: {len(image_urls)}")
-            images = []
-            for url in image_urls:
-                img_data = self._download_image(url)
-                img = Image.open(BytesIO(img_data))
-                # 确保所有图片都转换为RGB模式
-                img = img.convert('RGB')
-                images.append(img)
-
-            # 计算网格布局
-            num_images = len(images)
-            # 计算网格的行数和列数
-            if num_images <= 2:
-                rows, cols = 1, num_images
-            elif num_images <= 4:
-                rows, cols = 2, 2
-            elif num_images <= 6:
-                rows, cols = 2, 3
-            elif num_images <= 9:
-                rows, cols = 3, 3
-            else:
-                rows, cols = 3, 4
-
-            self.log(f"使用 {rows}x{cols} 网格布局")
-
-            # 计算单个图片的目标尺寸
-            # 使用第一张图片的尺寸作为基准
-            base_width, base_height = images[0].size
-            target_width = base_width
-            target_height = base_height
-
-            # 创建空白画布
-            canvas_width = target_width * cols
-            canvas_height = target_height * rows
-            merged_image = Image.new('RGB', (canvas_width, canvas_height))
-
-            # 在网格中放置图片
-            for idx, img in enumerate(images):
-                if idx >= rows * cols:
-                    break  # 如果图片数量超过网格容量，停止处理
-                
-                # 调整图片大小
-                img = img.resize((target_width, target_height), Image.Resampling.LANCZOS)
-                
-                # 计算图片在网格中的位置
-                row = idx // cols
-                col = idx % cols
-                x = col * target_width
-                y = row * target_height
-                
-                # 将图片粘贴到对应位置
-                merged_image.paste(img, (x, y))
+            if len(image_urls) > 1:
+                self.log(f"处理多张图片，数量: {len(image_urls)}")
+                rows, cols = flux_input_preparer.grid_shape(len(image_urls))
+                self.log(f"使用 {rows}x{cols} 网格布局")
 
-            # 转换为base64
-            img_byte_arr = BytesIO()
-            merged_image.save(img_byte_arr, format='PNG')
-            img_byte_arr = img_byte_arr.getvalue()
-            
-            return base64.b64encode(img_byte_arr).decode('utf-8')
+            # 超过网格容量的图片不参与拼接，无需下载
+            images = [self._download_image(url) for url in image_urls[:flux_input_preparer.capacity(len(image_urls))]]
+            return flux_input_preparer.prepare(images)
 
         except Exception as e:
             self.log(f"处理输入图片失败: {str(e)}")
-            raise ValueError(f"处理输入图片失败: {str(e)}") 
\ No newline at end of file
+            raise ValueError(f"处理输入图片失败: {str(e)}")
@@ -7,7 +7,6 @@ import logging
 import requests
 from io import BytesIO
 from typing import List, Dict, Optional, Tuple
-from PIL import Image
 from rest_framework.generics import get_object_or_404
 from django.utils import timezone
 from translate import Translator
@@ -18,6 +17,7 @@ from common.volcengine_tos_utils import VolcengineTOSUtils
 from djangoProject import settings
 from exception.business_exception import BusinessException
 from templateImage.ImagesRequest import ImageUploadManager
+from templateImage.image_payload_cache import image_payload_cache
 from templateImage.models import templateImage , ImageUploadRecord, ConversationList
 from user.models import SysUser
 
@@ -660,17 +660,8 @@ class GeminiImageService:
         return prompt_templates.get(aspect_ratio, prompt_templates["Free (自由比例)"])
 
     def _download_image(self, url: str) -> bytes:
-        """下载图像并返回二进制数据"""
-        response = requests.get(url, timeout=30)
-        response.raise_for_status()
-
-        # 验证图像格式并转换为PNG
-        img = Image.open(BytesIO(response.content))
-        if img.format != 'PNG':
-            buffered = BytesIO()
-            img.save(buffered, format="PNG")
-            return buffered.getvalue()
-        return response.content
+        """下载图像并返回PNG二进制数据（经内存/磁盘缓存，会话历史中的图像不再重复下载和转码）"""
+        return image_payload_cache.get_png(url)
 
     def _call_gemini_api(
             self,
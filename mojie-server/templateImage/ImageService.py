@@ -1121,7 +1121,7 @@ class ImageService:
                 "object_name": object_name
             }
             
-            # 删除对象存储中的对象
+            # 删除对象存储中的对象（去重复用的对象由delete_object按引用次数决定是否真正删除）
             if object_name:
                 try:
                     tos_utils = VolcengineTOSUtils()
@@ -1705,9 +1705,9 @@ class FluxKontextProImageView(APIView):
             )
 
     def _process_request_async(self, service, validated_data, conversation_request_id, request_obj, is_stream, user):
-        """异步处理请求的方法"""
+        """异步处理请求的方法：提交生成请求后立即返回，结果轮询不占用线程，就绪后由回调更新请求状态"""
         try:
-            result = service.generate_image(
+            future = service.start_generation(
                 prompt=validated_data['prompt'],
                 image_urls=validated_data.get('image_paths', []),
                 user_id=user.id,
@@ -1719,6 +1719,16 @@ class FluxKontextProImageView(APIView):
                 prompt_upsampling=validated_data.get('prompt_upsampling', False),
                 safety_tolerance=validated_data.get('safety_tolerance', 2)
             )
+            future.add_done_callback(lambda f: self._handle_generation_result(
+                f, validated_data, conversation_request_id, request_obj
+            ))
+        except Exception as e:
+            self._mark_request_failed(e, conversation_request_id, request_obj)
+
+    def _handle_generation_result(self, future, validated_data, conversation_request_id, request_obj):
+        """生成结束后更新请求状态"""
+        try:
+            result = future.result()
 
             if result['success']:
                 RequestManager.update_request_status(
@@ -1747,17 +1757,20 @@ class FluxKontextProImageView(APIView):
                 )
 
         except Exception as e:
-            logger.error(f"异步处理请求失败: {str(e)}", exc_info=True)
-            # 确保在异常情况下也更新ImageUploadRecord状态
-            ImageUploadManager.mark_as_failed(
-                record_id=conversation_request_id,
-                error_message=f"异步处理请求失败: {str(e)}"
-            )
-            RequestManager.update_request_status(
-                request_obj.id,
-                RequestStatus.FAILED,
-                error_message=str(e)
-            )
+            self._mark_request_failed(e, conversation_request_id, request_obj)
+
+    def _mark_request_failed(self, error, conversation_request_id, request_obj):
+        logger.error(f"异步处理请求失败: {str(error)}", exc_info=error)
+        # 确保在异常情况下也更新ImageUploadRecord状态
+        ImageUploadManager.mark_as_failed(
+            record_id=conversation_request_id,
+            error_message=f"异步处理请求失败: {str(error)}"
+        )
+        RequestManager.update_request_status(
+            request_obj.id,
+            RequestStatus.FAILED,
+            error_message=str(error)
+        )
 
     def _parse_request_data(self, request):
         """统一解析请求数据"""
@@ -1976,9 +1989,9 @@ class FluxKontextProImageFluxView(APIView):
             )
 
     def _process_request_async(self, service, validated_data, conversation_request_id, request_obj, is_stream, user):
-        """异步处理请求的方法"""
+        """异步处理请求的方法：提交生成请求后立即返回，结果轮询不占用线程，就绪后由回调更新请求状态"""
         try:
-            result = service.generate_image(
+            future = service.start_generation(
                 prompt=validated_data['prompt'],
                 image_urls=validated_data.get('image_paths', []),
                 user_id=user.id,
@@ -1990,6 +2003,16 @@ class FluxKontextProImageFluxView(APIView):
                 prompt_upsampling=validated_data.get('prompt_upsampling', False),
                 safety_tolerance=validated_data.get('safety_tolerance', 2)
             )
+            future.add_done_callback(lambda f: self._handle_generation_result(
+                f, validated_data, conversation_request_id, request_obj
+            ))
+        except Exception as e:
+            self._mark_request_failed(e, conversation_request_id, request_obj)
+
+    def _handle_generation_result(self, future, validated_data, conversation_request_id, request_obj):
+        """生成结束后更新请求状态"""
+        try:
+            result = future.result()
 
             if result['success']:
                 RequestManager.update_request_status(
@@ -2018,17 +2041,20 @@ class FluxKontextProImageFluxView(APIView):
                 )
 
         except Exception as e:
-            logger.error(f"异步处理请求失败: {str(e)}", exc_info=True)
-            # 确保在异常情况下也更新ImageUploadRecord状态
-            ImageUploadManager.mark_as_failed(
-                record_id=conversation_request_id,
-                error_message=f"异步处理请求失败: {str(e)}"
-            )
-            RequestManager.update_request_status(
-                request_obj.id,
-                RequestStatus.FAILED,
-                error_message=str(e)
-            )
+            self._mark_request_failed(e, conversation_request_id, request_obj)
+
+    def _mark_request_failed(self, error, conversation_request_id, request_obj):
+        logger.error(f"异步处理请求失败: {str(error)}", exc_info=error)
+        # 确保在异常情况下也更新ImageUploadRecord状态
+        ImageUploadManager.mark_as_failed(
+            record_id=conversation_request_id,
+            error_message=f"异步处理请求失败: {str(error)}"
+        )
+        RequestManager.update_request_status(
+            request_obj.id,
+            RequestStatus.FAILED,
+            error_message=str(error)
+        )
 
     def _parse_request_data(self, request):
         """统一解析请求数据"""
@@ -9,8 +9,8 @@ import traceback
 from io import BytesIO
 from typing import Dict, List
 from threading import Event, Thread
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import urllib.parse
 import redis
 
 from django.conf import settings
@@ -19,7 +19,10 @@ from django.utils import timezone
 from common.volcengine_tos_utils import VolcengineTOSUtils
 from templateImage.models import ComfyUITask, SysUser, ImageUploadRecord
 from templateImage.workflowUtils import ComfyUIHelper
+from templateImage.comfyui_http import comfyui_http
 from templateImage.task_utils import TaskUtils, queue_service
+from templateImage.task_events import task_event_bus
+from templateImage.task_status_buffer import task_status_buffer
 
 
 class ComfyUIConsumer:
@@ -48,6 +51,7 @@ class ComfyUIConsumer:
         self.active_helpers = {}  # 当前活跃的helper实例
         self.processing_tasks = set()  # 当前正在处理的任务ID集合
         self.task_heartbeat_intervals = {}  # 存储每个任务的心跳间隔
+        self.task_progress = {}  # 每个任务最近一次上报的进度
         self.last_response_time = time.time()  # 添加最后响应时间
 
         # 初始化Redis客户端
@@ -76,8 +80,12 @@ class ComfyUIConsumer:
         # 确保默认工作流文件存在
         self._ensure_default_workflow_file()
         
-        # 初始化TOS工具
+        # 初始化TOS工具（进程内共享客户端）和结果上传线程池
         self.tos_utils = VolcengineTOSUtils()
+        self.upload_executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'COMFYUI_UPLOAD_CONCURRENCY', 4),
+            thread_name_prefix='comfyui-upload'
+        )
         
         # 最后设置consumer
         queue_service.set_consumer(self)
@@ -202,6 +210,8 @@ class ComfyUIConsumer:
                     username=username,
                     password=password
                 )
+                # 输出图像流式下载到临时文件后直接上传，不在内存中保留完整图像
+                helper.stream_images = True
                 self.helper_cache[cache_key] = helper
                 self.logger.info(f"[DEBUG] ComfyUIHelper实例创建成功: {helper}")
                 return helper
@@ -213,25 +223,104 @@ class ComfyUIConsumer:
             self.logger.info(f"[DEBUG] 使用缓存的helper实例 (cache_key={cache_key})")
             return self.helper_cache[cache_key]
 
-    def _upload_to_oss(self, image_data: bytes) -> str:
-        """上传图片到OSS并返回URL"""
-        if not isinstance(image_data, bytes):
-            self.logger.error(f"上传失败：数据类型错误，期望bytes，实际是{type(image_data)}")
-            raise ValueError("上传数据必须是bytes类型")
+    def _report_progress(self, task_id: str, progress: float):
+        """
+        上报任务进度：更新Redis中的任务状态，MySQL写入由状态缓冲合并后批量完成
+        同一任务的进度变化不足1%时不重复上报
+        """
+        progress = round(min(progress, 100), 1)
+        last_progress = self.task_progress.get(task_id)
+        if last_progress is not None and progress - last_progress < 1 and progress < 100:
+            return
+        self.task_progress[task_id] = progress
+        try:
+            if self.redis_client:
+                status_raw = self.redis_client.hget('comfyui_task_status', task_id)
+                status_data = json.loads(status_raw) if status_raw else {'task_id': task_id, 'status': 'processing'}
+                status_data['progress'] = progress
+                status_data['timestamp'] = time.time()
+                self.redis_client.hset('comfyui_task_status', task_id, json.dumps(status_data))
+            task_status_buffer.record(task_id, progress=progress)
+            task_event_bus.publish_progress(task_id, progress)
+        except Exception as e:
+            self.logger.error(f"上报任务 {task_id} 进度失败: {str(e)}")
+
+    def check_backend(self, server_address: str) -> bool:
+        """
+        检查ComfyUI后端是否可连接，复用该服务器已缓存的helper连接
+        :param server_address: 服务器地址
+        :return: 是否可用，尚无缓存helper时视为可用
+        """
+        for helper in list(self.helper_cache.values()):
+            if helper.server_address != server_address:
+                continue
+            # 达到最大重连次数后helper不再尝试连接，健康检查时重新开始计数
+            if helper.reconnect_attempts >= helper.max_reconnect_attempts:
+                helper.reconnect_attempts = 0
+            return helper._ensure_connection()
+        return True
+
+    def _upload_to_oss(self, image_data) -> str:
+        """
+        上传图片到OSS并返回URL
+        :param image_data: 图片字节数据，或流式下载得到的文件对象（上传后关闭）
+        """
+        is_file = hasattr(image_data, 'read')
+        if not is_file and not isinstance(image_data, bytes):
+            self.logger.error(f"上传失败：数据类型错误，期望bytes或文件对象，实际是{type(image_data)}")
+            raise ValueError("上传数据必须是bytes类型或文件对象")
             
         img_name = f"{uuid.uuid4()}.png"
         try:
-            img_size_kb = len(image_data) // 1024
+            if is_file:
+                image_data.seek(0, os.SEEK_END)
+                img_size_kb = image_data.tell() // 1024
+                image_data.seek(0)
+            else:
+                img_size_kb = len(image_data) // 1024
             self.logger.info(f"开始上传图片到OSS: {img_name}, 大小: {img_size_kb}KB")
-            img_url = self.tos_utils.upload_image(
-                object_name=img_name,
-                file_data=image_data
-            )
-            self.logger.info(f"图片 {img_name} 上传成功，URL: {img_url}")
-            return img_url
+            retries = getattr(settings, 'COMFYUI_UPLOAD_RETRIES', 2)
+            for attempt in range(retries + 1):
+                if is_file:
+                    image_data.seek(0)
+                img_url = self.tos_utils.upload_image(
+                    object_name=img_name,
+                    file_data=image_data
+                )
+                if img_url:
+                    self.logger.info(f"图片 {img_name} 上传成功，URL: {img_url}")
+                    return img_url
+                if attempt < retries:
+                    self.logger.warning(f"图片 {img_name} 上传失败，第 {attempt + 1} 次重试")
+                    time.sleep(0.5 * (2 ** attempt))
+            raise Exception(f"已重试 {retries} 次仍然失败")
         except Exception as e:
             self.logger.error(f"图片 {img_name} 上传失败: {str(e)}")
             raise
+        finally:
+            if is_file:
+                image_data.close()
+
+    def _upload_images_to_oss(self, images: list, task_id: str = None, keep_failed: bool = False) -> List[str]:
+        """
+        并发上传一个任务的所有输出图像，结果保持输入顺序
+        :param images: 图像字节数据/文件对象，或返回它们的无参函数（在上传线程中下载）
+        :param task_id: 任务ID（用于日志）
+        :param keep_failed: 为True时上传失败的位置保留为None，否则跳过
+        :return: 图片URL列表
+        """
+        def upload(item):
+            try:
+                return self._upload_to_oss(item() if callable(item) else item)
+            except Exception as e:
+                self.logger.error(f"任务 {task_id} 的图像上传失败: {str(e)}")
+                return None
+
+        if len(images) <= 1:
+            urls = [upload(item) for item in images]
+        else:
+            urls = list(self.upload_executor.map(upload, images))
+        return urls if keep_failed else [url for url in urls if url]
 
     def _cleanup_task_resources(self, task_id: str):
         """清理任务相关的所有资源"""
@@ -241,6 +330,8 @@ class ComfyUIConsumer:
                 del self.active_helpers[task_id]
                 self.logger.info(f"已从活动任务列表中移除任务 {task_id}")
             
+            self.task_progress.pop(task_id, None)
+
             # 从心跳间隔映射中移除
             if task_id in self.task_heartbeat_intervals:
                 del self.task_heartbeat_intervals[task_id]
@@ -277,6 +368,14 @@ class ComfyUIConsumer:
                         'timestamp': time.time(),
                         'from_source': 'consumer'
                     }
+
+                    # 保留快照中不随状态变化的字段，状态查询无需再回查数据库
+                    previous_raw = self.redis_client.hget('comfyui_task_status', task_id)
+                    if previous_raw:
+                        previous = json.loads(previous_raw)
+                        for key in ('priority', 'created_at', 'input_data'):
+                            if key in previous:
+                                status_data[key] = previous[key]
                     
                     if image_urls:
                         status_data['image_urls'] = image_urls
@@ -290,6 +389,10 @@ class ComfyUIConsumer:
                 except Exception as e:
                     self.logger.error(f"更新Redis状态失败: {str(e)}")
 
+            # 通知等待中的任务重新检查，并将任务移出待处理排名索引
+            task_event_bus.publish(task_id, status)
+            queue_service.untrack_pending_rank(task_id)
+
             # 2. 同步更新MySQL状态
             try:
                 task_obj = ComfyUITask.objects.filter(task_id=task_id).first()
@@ -605,14 +708,11 @@ class ComfyUIConsumer:
             workflow_file = helper.workflow_file
             self.logger.info(f"使用工作流文件: {workflow_file}")
             
-            # 获取工作流（从helper实例缓存或文件读取）
-            workflow = helper.load_workflow(workflow_file)
+            # 基于缓存的工作流模板和预编译补丁计划构建提示词，不读取文件
+            workflow = helper.build_prompt(prompt_updates, workflow_file)
             if not workflow:
                 raise ValueError(f"无法加载工作流: {workflow_file}")
-            
-            # 更新提示词
             if prompt_updates:
-                workflow = helper.update_workflow(workflow, prompt_updates)
                 self.logger.info(f"已更新工作流提示词")
                 
             # 准备事件和结果容器
@@ -641,30 +741,19 @@ class ComfyUIConsumer:
                         if 'data' in message:
                             images_data = message['data']
                             if isinstance(images_data, list):
-                                # 处理图像数据列表
-                                for image_data in images_data:
-                                    try:
-                                        # 上传到OSS
-                                        image_url = self._upload_to_oss(image_data)
-                                        if image_url:
-                                            result.append(image_url)
-                                            self.logger.info(f"任务 {task_id} 完成，已上传图像: {image_url}")
-                                    except Exception as e:
-                                        self.logger.error(f"处理图像失败: {str(e)}")
+                                # 处理图像数据列表，所有图像并发上传到OSS
+                                image_urls = self._upload_images_to_oss(images_data, task_id)
+                                result.extend(image_urls)
+                                self.logger.info(f"任务 {task_id} 完成，已上传 {len(image_urls)} 张图像: {image_urls}")
                             elif isinstance(images_data, dict):
                                 # 处理包含image_urls的字典
                                 if 'image_urls' in images_data:
                                     result.extend(images_data['image_urls'])
                                 # 处理包含images的字典
                                 elif 'images' in images_data:
-                                    for image_data in images_data['images']:
-                                        try:
-                                            image_url = self._upload_to_oss(image_data)
-                                            if image_url:
-                                                result.append(image_url)
-                                                self.logger.info(f"任务 {task_id} 完成，已上传图像: {image_url}")
-                                        except Exception as e:
-                                            self.logger.error(f"处理图像失败: {str(e)}")
+                                    image_urls = self._upload_images_to_oss(images_data['images'], task_id)
+                                    result.extend(image_urls)
+                                    self.logger.info(f"任务 {task_id} 完成，已上传 {len(image_urls)} 张图像: {image_urls}")
                             else:
                                 self.logger.warning(f"未知的图像数据格式: {type(images_data)}")
                         
@@ -704,7 +793,7 @@ class ComfyUIConsumer:
                     )
                     is_cancelled = True # Treat as cancelled for cleanup purposes
                     done_event.set()
-                elif message['type'] == 'execution_cancelled':
+                elif message['type'] in ('execution_cancelled', 'execution_interrupted'):
                     self.logger.info(f"任务 {task_id} 已被取消")
                     # Update task status to cancelled
                     self._update_task_status(
@@ -719,6 +808,7 @@ class ComfyUIConsumer:
                     data = message.get('data', {})
                     if data and 'value' in data and 'max' in data:
                         progress = (data['value'] / data['max']) * 100
+                        self._report_progress(task_id, progress)
                         # 当进度达到100%时，更新心跳间隔
                         if progress >= 100:
                             self.update_task_heartbeat_interval(task_id, 120)  # 更新为120秒
@@ -751,49 +841,41 @@ class ComfyUIConsumer:
         :param task_id: 任务ID
         :return: 处理后的图像URL列表
         """
-        urls = []
+        # 先按输入顺序整理：已有URL直接占位，需要上传的图像收集后并发上传
+        slots = []
+        uploads = []
         try:
             for i, image in enumerate(images):
                 # 情况1: 已经是URL字符串
                 if isinstance(image, str) and (image.startswith('http://') or image.startswith('https://')):
-                    urls.append(image)
+                    slots.append(image)
                     self.logger.info(f"图像 #{i+1}: 已有URL格式")
                     continue
                     
                 # 情况2: 是二进制图像数据
                 if isinstance(image, bytes):
-                    try:
-                        # 上传图像到OSS并获取URL
-                        img_size_kb = len(image) // 1024
-                        image_url = self._upload_to_oss(image)
-                        if image_url:
-                            urls.append(image_url)
-                            self.logger.info(f"图像 #{i+1}: 二进制数据({img_size_kb}KB)已上传至OSS: {image_url}")
-                    except Exception as e:
-                        self.logger.error(f"图像 #{i+1}: 上传OSS失败: {str(e)}")
-                        continue
+                    self.logger.info(f"图像 #{i+1}: 二进制数据({len(image) // 1024}KB)等待上传")
+                    uploads.append((len(slots), image))
+                    slots.append(None)
+                    continue
                 
                 # 情况3: 是一个包含图像信息的字典
                 if isinstance(image, dict):
                     if 'url' in image:
                         # 直接有URL
-                        urls.append(image['url'])
+                        slots.append(image['url'])
                         self.logger.info(f"图像 #{i+1}: 字典中URL格式")
                     elif 'filename' in image and 'subfolder' in image and 'type' in image:
-                        # 需要从文件系统获取图像
-                        try:
-                            filename = image['filename']
-                            subfolder = image['subfolder']
-                            self.logger.info(f"图像 #{i+1}: 从ComfyUI获取文件 {filename}")
-                            image_data = self._get_image(filename, subfolder, image['type'])
-                            img_size_kb = len(image_data) // 1024
-                            image_url = self._upload_to_oss(image_data)
-                            if image_url:
-                                urls.append(image_url)
-                                self.logger.info(f"图像 #{i+1}: 文件{filename}({img_size_kb}KB)已上传至OSS: {image_url}")
-                        except Exception as e:
-                            self.logger.error(f"图像 #{i+1}: 获取/上传失败: {str(e)}")
-                            continue
+                        # 需要从ComfyUI获取图像：在上传线程中流式下载到临时文件后直接上传
+                        self.logger.info(f"图像 #{i+1}: 从ComfyUI获取文件 {image['filename']}")
+                        uploads.append((len(slots), lambda image=image: comfyui_http.get(self.default_comfyui_url).open_view(
+                            image['filename'], image['subfolder'], image['type'])[0]))
+                        slots.append(None)
+
+            image_urls = self._upload_images_to_oss([item for _, item in uploads], task_id, keep_failed=True)
+            for (slot, _), image_url in zip(uploads, image_urls):
+                slots[slot] = image_url
+            urls = [url for url in slots if url]
             
             self.logger.info(f"图像处理结果: {len(images)}个输入，{len(urls)}个URL")
             return urls
@@ -807,23 +889,11 @@ class ComfyUIConsumer:
         try:
             self.logger.info(f"获取图像: {filename}, {subfolder}, {folder_type}")
             
-            # 准备URL参数
-            url_values = urllib.parse.urlencode({
-                "filename": filename,
-                "subfolder": subfolder, 
-                "type": folder_type
-            })
-            
-            # 构建基本URL
-            url = f"http://{self.default_comfyui_url}/view?{url_values}"
+            image_data = comfyui_http.get(self.default_comfyui_url).get_view(filename, subfolder, folder_type)
+            img_size_kb = len(image_data) // 1024
+            self.logger.info(f"成功获取图像: {filename}, 大小: {img_size_kb}KB")
+            return image_data
             
-            # 发送请求并获取响应
-            with urllib.request.urlopen(url) as response:
-                image_data = response.read()
-                img_size_kb = len(image_data) // 1024
-                self.logger.info(f"成功获取图像: {filename}, 大小: {img_size_kb}KB")
-                return image_data
-                
         except Exception as e:
             self.logger.error(f"获取图像失败: {str(e)}")
             raise
@@ -834,44 +904,19 @@ class ComfyUIConsumer:
             if task_id in self.active_helpers:
                 helper = self.active_helpers[task_id]
                 
-                # 1. 取消当前任务处理
-                helper.cancel_current_task()
-                
-                # 2. 直接通过HTTP请求强制中断ComfyUI中的任务
-                try:
-                    import urllib.request
-                    import json
-                    
-                    # 创建中断请求
-                    data = json.dumps({"prompt_id": task_id}).encode('utf-8')
-                    req = urllib.request.Request(
-                        f"http://{self.default_comfyui_url}/interrupt",
-                        data=data,
-                        headers={'Content-Type': 'application/json'}
-                    )
-                    # 发送中断请求
-                    urllib.request.urlopen(req)
-                    self.logger.info(f"已直接向ComfyUI服务器发送中断请求: {task_id}")
-                except Exception as e:
-                    self.logger.error(f"直接中断ComfyUI任务失败: {str(e)}")
-                
-                # 3. 强制关闭WebSocket连接
-                if hasattr(helper, 'ws') and helper.ws:
-                    try:
-                        helper.ws.close()
-                        self.logger.info(f"已强制关闭任务 {task_id} 的WebSocket连接")
-                    except Exception as e:
-                        self.logger.error(f"关闭WebSocket连接失败: {str(e)}")
+                # 1. 取消helper中的任务：正在执行时立即向ComfyUI服务器中断对应的prompt，
+                #    仍在helper队列中时轮到后直接跳过（helper按服务器共享，不能中断其他任务）
+                if helper.cancel_task(task_id):
+                    self.logger.info(f"已向ComfyUI服务器 {helper.server_address} 发送任务 {task_id} 的中断请求")
                 
-                # 4. 从活跃任务列表中移除
+                # 2. 从活跃任务列表中移除
                 del self.active_helpers[task_id]
                 
-                # 5. 标记任务为已取消
+                # 3. 标记任务为已取消
                 self._update_task_status(
                     task_id,
                     'cancelled',
-                    error_message="任务已被用户取消",
-                    completed_at=time.time()
+                    error_message="任务已被用户取消"
                 )
                 
                 return True
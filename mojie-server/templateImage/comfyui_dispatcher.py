@@ -0,0 +1,235 @@
+"""
+ComfyUI多后端调度模块
+按服务器跟踪处理中的任务数，将任务派发到负载最低的健康后端，替代全局单任务锁
+"""
+import json
+import logging
+import time
+from typing import Callable, Dict, List, Optional
+
+import redis
+from django.conf import settings
+
+from templateImage.task_events import task_event_bus
+
+logger = logging.getLogger(__name__)
+
+
+class ComfyUIDispatcher:
+    # 各后端处理中的任务数（哈希 backend -> count），多进程共享
+    INFLIGHT_KEY = 'comfyui_backend_inflight'
+    # 任务占用的后端租约（哈希 task_id -> {"backend", "ts"}），用于幂等释放和回收泄漏的占用
+    LEASE_KEY = 'comfyui_backend_leases'
+    # 不健康后端标记（带过期时间，过期后重新参与调度）
+    DOWN_KEY_PREFIX = 'comfyui_backend_down'
+
+    # 原子地选择负载最低且未满的后端并登记租约；任务已持有租约时直接返回原后端
+    _ACQUIRE_SCRIPT = """
+    local lease = redis.call('HGET', KEYS[2], ARGV[1])
+    if lease then
+        return cjson.decode(lease)['backend']
+    end
+    local best = nil
+    local best_load = nil
+    for i = 3, #ARGV, 2 do
+        local backend = ARGV[i]
+        local limit = tonumber(ARGV[i + 1])
+        local load = tonumber(redis.call('HGET', KEYS[1], backend) or '0')
+        if load < limit and (best == nil or load < best_load) then
+            best = backend
+            best_load = load
+        end
+    end
+    if best == nil then
+        return false
+    end
+    redis.call('HINCRBY', KEYS[1], best, 1)
+    redis.call('HSET', KEYS[2], ARGV[1], cjson.encode({backend = best, ts = tonumber(ARGV[2])}))
+    return best
+    """
+
+    # 原子地释放任务租约，重复释放无副作用
+    _RELEASE_SCRIPT = """
+    local lease = redis.call('HGET', KEYS[2], ARGV[1])
+    if not lease then
+        return false
+    end
+    local backend = cjson.decode(lease)['backend']
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    if redis.call('HINCRBY', KEYS[1], backend, -1) < 0 then
+        redis.call('HSET', KEYS[1], backend, 0)
+    end
+    return backend
+    """
+
+    def __init__(self, redis_host: str = 'localhost', redis_port: int = 6379):
+        self.redis = redis.StrictRedis(host=redis_host, port=redis_port, db=0, decode_responses=True)
+        self._acquire_script = self.redis.register_script(self._ACQUIRE_SCRIPT)
+        self._release_script = self.redis.register_script(self._RELEASE_SCRIPT)
+        self._health_checked_at = {}  # backend -> 最近一次健康检查时间
+        self._last_reap_time = 0
+
+    def get_backends(self, server_address: Optional[str]) -> List[str]:
+        """
+        获取任务可用的后端列表
+        任务配置的服务器属于COMFYUI_BACKENDS时，可以派发到其中任意一台；否则只能使用配置的服务器
+        """
+        backends = list(getattr(settings, 'COMFYUI_BACKENDS', []) or [])
+        server_address = server_address or getattr(settings, 'COMFYUI_SERVER_ADDRESS', None)
+        if server_address and server_address in backends:
+            return backends
+        return [server_address] if server_address else backends
+
+    def get_limit(self, backend: str) -> int:
+        """获取后端的并发上限"""
+        limits = getattr(settings, 'COMFYUI_BACKEND_CONCURRENCY', {}) or {}
+        return int(limits.get(backend, getattr(settings, 'COMFYUI_BACKEND_MAX_CONCURRENCY', 1)))
+
+    def mark_unhealthy(self, backend: str, cooldown: Optional[int] = None):
+        """将后端标记为不健康，冷却期内不参与调度"""
+        cooldown = cooldown or getattr(settings, 'COMFYUI_BACKEND_DOWN_COOLDOWN', 60)
+        try:
+            self.redis.setex(f"{self.DOWN_KEY_PREFIX}:{backend}", cooldown, 1)
+            logger.warning(f"ComfyUI后端 {backend} 已标记为不健康，{cooldown} 秒内不参与调度")
+        except Exception as e:
+            logger.error(f"标记后端 {backend} 不健康失败: {str(e)}")
+
+    def _healthy_backends(self, backends: List[str]) -> List[str]:
+        """过滤掉处于冷却期的后端"""
+        if not backends:
+            return []
+        down_flags = self.redis.mget([f"{self.DOWN_KEY_PREFIX}:{backend}" for backend in backends])
+        return [backend for backend, down in zip(backends, down_flags) if not down]
+
+    def _probe(self, backend: str) -> bool:
+        """
+        通过消费者缓存的ComfyUIHelper检查后端连接，结果在COMFYUI_BACKEND_HEALTH_TTL内复用
+        """
+        ttl = getattr(settings, 'COMFYUI_BACKEND_HEALTH_TTL', 30)
+        if time.time() - self._health_checked_at.get(backend, 0) < ttl:
+            return True
+        try:
+            # 延迟导入，避免循环导入
+            from templateImage.queue_service_singleton import queue_service
+            consumer = queue_service.get_consumer()
+            healthy = consumer.check_backend(backend) if consumer else True
+        except Exception as e:
+            logger.error(f"检查ComfyUI后端 {backend} 健康状态失败: {str(e)}")
+            healthy = False
+        if healthy:
+            self._health_checked_at[backend] = time.time()
+        return healthy
+
+    def _try_acquire(self, task_id: str, backends: List[str], force: bool = False) -> Optional[str]:
+        args = [task_id, time.time()]
+        for backend in backends:
+            # 强制派发时忽略并发上限，仍然选择负载最低的后端
+            args.extend([backend, 2 ** 31 if force else self.get_limit(backend)])
+        return self._acquire_script(keys=[self.INFLIGHT_KEY, self.LEASE_KEY], args=args) or None
+
+    def acquire(self, task_id: str, server_address: Optional[str] = None, timeout: Optional[float] = None,
+                cancel_check: Optional[Callable[[], bool]] = None) -> Optional[str]:
+        """
+        为任务获取一个处理中的后端名额，所有后端已满时等待
+        :param task_id: 任务ID
+        :param server_address: 任务配置的ComfyUI服务器地址
+        :param timeout: 最长等待时间（秒），超时后强制派发到负载最低的后端
+        :param cancel_check: 等待期间的取消检查函数，返回True时放弃获取
+        :return: 分配的后端地址，被取消时返回None
+        """
+        if timeout is None:
+            timeout = getattr(settings, 'COMFYUI_DISPATCH_WAIT_TIMEOUT', 600)
+        backends = self.get_backends(server_address)
+        if not backends:
+            raise ValueError("没有可用的ComfyUI后端")
+
+        deadline = time.time() + timeout
+        waiting_logged = False
+        while True:
+            # 先记录事件版本号，尝试获取期间发生的释放事件会让随后的等待立即返回
+            event_version = task_event_bus.version
+            self.reap_stale_leases()
+
+            # 所有后端都不健康时退化为使用全部后端，避免任务永远无法派发
+            candidates = self._healthy_backends(backends) or backends
+            force = time.time() >= deadline
+            backend = self._try_acquire(task_id, candidates, force=force)
+            if backend:
+                if len(candidates) > 1 and not self._probe(backend):
+                    self.release(task_id)
+                    self.mark_unhealthy(backend)
+                    continue
+                if force:
+                    logger.warning(f"任务 {task_id} 等待空闲后端超时，强制派发到 {backend}")
+                else:
+                    logger.info(f"任务 {task_id} 已派发到ComfyUI后端 {backend}")
+                return backend
+
+            if not waiting_logged:
+                logger.info(f"所有ComfyUI后端已满 {self.get_backend_loads(backends)}，任务 {task_id} 等待空闲后端")
+                waiting_logged = True
+
+            if cancel_check and cancel_check():
+                logger.info(f"任务 {task_id} 在等待后端时被取消")
+                return None
+
+            # 等待任意进程释放后端或任务状态变化的事件，兜底超时应对丢失的事件
+            task_event_bus.wait_for_event(event_version, timeout=min(
+                getattr(settings, 'COMFYUI_TASK_WAIT_FALLBACK_INTERVAL', 30), max(deadline - time.time(), 0.01)
+            ))
+
+    def release(self, task_id: str) -> Optional[str]:
+        """
+        释放任务占用的后端名额（幂等）
+        :return: 被释放的后端地址，任务未持有租约时返回None
+        """
+        try:
+            backend = self._release_script(keys=[self.INFLIGHT_KEY, self.LEASE_KEY], args=[task_id])
+        except Exception as e:
+            logger.error(f"释放任务 {task_id} 的后端名额失败: {str(e)}")
+            return None
+        if backend:
+            logger.info(f"任务 {task_id} 已释放ComfyUI后端 {backend}")
+            task_event_bus.publish(task_id, 'backend_released', backend=backend)
+        return backend or None
+
+    def has_capacity(self, server_address: Optional[str] = None) -> bool:
+        """判断任务可用的后端中是否还有空闲名额"""
+        backends = self.get_backends(server_address)
+        candidates = self._healthy_backends(backends) or backends
+        loads = self.get_backend_loads()
+        return any(loads.get(backend, 0) < self.get_limit(backend) for backend in candidates)
+
+    def get_task_backend(self, task_id: str) -> Optional[str]:
+        """获取任务当前占用的后端"""
+        lease = self.redis.hget(self.LEASE_KEY, task_id)
+        return json.loads(lease)['backend'] if lease else None
+
+    def get_backend_loads(self, backends: Optional[List[str]] = None) -> Dict[str, int]:
+        """获取各后端处理中的任务数"""
+        loads = {backend: int(count) for backend, count in self.redis.hgetall(self.INFLIGHT_KEY).items()}
+        for backend in backends or []:
+            loads.setdefault(backend, 0)
+        return loads
+
+    def reap_stale_leases(self):
+        """回收超过COMFYUI_BACKEND_LEASE_TTL仍未释放的租约（如工作进程崩溃），每分钟最多执行一次"""
+        now = time.time()
+        if now - self._last_reap_time < 60:
+            return
+        self._last_reap_time = now
+        lease_ttl = getattr(settings, 'COMFYUI_BACKEND_LEASE_TTL', 1800)
+        try:
+            for task_id, lease in self.redis.hgetall(self.LEASE_KEY).items():
+                if now - json.loads(lease).get('ts', now) > lease_ttl:
+                    logger.warning(f"任务 {task_id} 的后端租约已超时，自动释放")
+                    self.release(task_id)
+        except Exception as e:
+            logger.error(f"回收超时后端租约失败: {str(e)}")
+
+
+# 创建全局调度器实例
+comfyui_dispatcher = ComfyUIDispatcher(
+    redis_host=settings.REDIS_HOST,
+    redis_port=settings.REDIS_PORT
+)
@@ -0,0 +1,153 @@
+"""
+ComfyUI执行引擎
+图像和视频工作流共用的按服务器调度的执行队列：每个服务器一组工作线程（数量可配置），
+队列为空时阻塞等待，不再由每个helper各自起线程轮询；不同类型的任务（image/video）轮流出队，
+同一后端上排队的视频任务不会让图像任务一直等待，反之亦然
+"""
+import logging
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_Job = Tuple[str, Callable, Future]
+
+
+class _ServerLane:
+    """单个ComfyUI服务器的执行队列和工作线程"""
+
+    def __init__(self, server_address: str, concurrency: int):
+        self.server_address = server_address
+        self.concurrency = max(concurrency, 1)
+        self._condition = threading.Condition()
+        self._queues: Dict[str, Deque[_Job]] = {}
+        self._rotation: Deque[str] = deque()  # 任务类型的轮转顺序
+        self.workers = 0
+        self.idle = 0
+        self.running = 0
+        self.completed = 0
+
+    def submit(self, kind: str, fn: Callable, job_id: str) -> Future:
+        future = Future()
+        with self._condition:
+            if kind not in self._queues:
+                self._queues[kind] = deque()
+                self._rotation.append(kind)
+            self._queues[kind].append((job_id, fn, future))
+            if self.idle == 0 and self.workers < self.concurrency:
+                self.workers += 1
+                threading.Thread(target=self._worker, daemon=True,
+                                 name=f"comfyui-engine-{self.server_address}-{self.workers}").start()
+            self._condition.notify()
+        return future
+
+    def cancel(self, job_id: str) -> bool:
+        """取消尚未开始执行的任务"""
+        with self._condition:
+            for queue in self._queues.values():
+                for job in queue:
+                    if job[0] == job_id:
+                        queue.remove(job)
+                        return job[2].cancel()
+        return False
+
+    def _next_job(self) -> Optional[_Job]:
+        """按任务类型轮流取出下一个任务，调用方需持有锁"""
+        for _ in range(len(self._rotation)):
+            kind = self._rotation[0]
+            self._rotation.rotate(-1)
+            queue = self._queues[kind]
+            while queue:
+                job = queue.popleft()
+                if not job[2].cancelled():
+                    return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                self.idle += 1
+                job = self._next_job()
+                while job is None:
+                    self._condition.wait()
+                    job = self._next_job()
+                self.idle -= 1
+                self.running += 1
+
+            job_id, fn, future = job
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn())
+                    except BaseException as e:
+                        future.set_exception(e)
+            except Exception as e:
+                logger.error(f"执行引擎处理任务 {job_id} 失败: {str(e)}")
+            finally:
+                with self._condition:
+                    self.running -= 1
+                    self.completed += 1
+
+    def stats(self) -> Dict:
+        with self._condition:
+            return {
+                'concurrency': self.concurrency,
+                'workers': self.workers,
+                'running': self.running,
+                'completed': self.completed,
+                'queued': {kind: sum(1 for job in queue if not job[2].cancelled())
+                           for kind, queue in self._queues.items()},
+            }
+
+
+class ComfyUIExecutionEngine:
+    def __init__(self):
+        self._lanes: Dict[str, _ServerLane] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_concurrency(server_address: str) -> int:
+        """服务器在本进程内同时执行的工作流数，默认与调度器的后端并发上限一致"""
+        limits = getattr(settings, 'COMFYUI_ENGINE_CONCURRENCY', {}) or {}
+        default = getattr(settings, 'COMFYUI_ENGINE_MAX_CONCURRENCY', None) or \
+            getattr(settings, 'COMFYUI_BACKEND_MAX_CONCURRENCY', 1)
+        return int(limits.get(server_address, default))
+
+    def _lane(self, server_address: str) -> _ServerLane:
+        with self._lock:
+            lane = self._lanes.get(server_address)
+            if lane is None:
+                lane = _ServerLane(server_address, self.get_concurrency(server_address))
+                self._lanes[server_address] = lane
+            return lane
+
+    def submit(self, server_address: str, kind: str, fn: Callable, job_id: Optional[str] = None) -> Future:
+        """
+        提交任务到服务器的执行队列
+        :param server_address: ComfyUI服务器地址
+        :param kind: 任务类型（如image、video），不同类型轮流执行
+        :param fn: 在工作线程中执行的函数，返回值作为Future的结果
+        :param job_id: 任务ID，用于取消
+        :return: 任务的Future
+        """
+        return self._lane(server_address).submit(kind, fn, job_id or str(uuid.uuid4()))
+
+    def cancel(self, server_address: str, job_id: str) -> bool:
+        """取消尚未开始执行的任务，已开始执行时返回False"""
+        with self._lock:
+            lane = self._lanes.get(server_address)
+        return lane.cancel(job_id) if lane else False
+
+    def stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            lanes = list(self._lanes.values())
+        return {lane.server_address: lane.stats() for lane in lanes}
+
+
+# 创建全局ComfyUI执行引擎实例
+comfyui_engine = ComfyUIExecutionEngine()
@@ -0,0 +1,157 @@
+"""
+ComfyUI HTTP连接池模块
+每个ComfyUI服务器复用一个保持长连接的requests会话，/prompt、/history、/view等请求不再各自建立TCP连接；
+/view支持流式下载到临时文件，小图留在内存，大图溢出到磁盘，可直接交给上传流程
+"""
+import logging
+import tempfile
+import threading
+from typing import Dict, Optional, Tuple
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+
+class ComfyUIHttpClient:
+    def __init__(self, server_address: str, token: Optional[str] = None, pool_size: int = 10,
+                 connect_timeout: float = 5, read_timeout: float = 60, chunk_size: int = 256 * 1024,
+                 spool_max_size: int = 8 * 1024 * 1024):
+        """
+        单个ComfyUI服务器的HTTP客户端
+        :param server_address: 服务器地址
+        :param token: 认证token
+        :param pool_size: 连接池大小（同一服务器的最大并发连接数）
+        :param connect_timeout: 建立连接超时（秒）
+        :param read_timeout: 读取超时（秒）
+        :param chunk_size: 流式下载的分块大小（字节）
+        :param spool_max_size: 流式下载时保留在内存中的最大字节数，超过后写入临时文件
+        """
+        self.server_address = server_address
+        self.token = token
+        self.base_url = f"http://{server_address}"
+        self.timeout = (connect_timeout, read_timeout)
+        self.chunk_size = chunk_size
+        self.spool_max_size = spool_max_size
+
+        self.session = requests.Session()
+        # 只对幂等的GET请求自动重试，提交工作流失败时由调用方决定是否重试，避免重复提交
+        retry = Retry(total=2, connect=2, read=1, backoff_factor=0.5,
+                      status_forcelist=(502, 503, 504), allowed_methods=frozenset(['GET']))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        if token:
+            self.session.headers['Authorization'] = f'Bearer {token}'
+
+    def _params(self, params: Optional[Dict] = None) -> Dict:
+        params = dict(params or {})
+        if self.token:
+            params['token'] = self.token
+        return params
+
+    def request(self, method: str, path: str, params: Optional[Dict] = None, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        response = self.session.request(method, f"{self.base_url}{path}", params=self._params(params), **kwargs)
+        if not response.ok:
+            logger.error(f"ComfyUI请求 {method} {path} 失败 ({response.status_code}): {response.text[:500]}")
+        response.raise_for_status()
+        return response
+
+    def post_json(self, path: str, payload: Dict) -> Dict:
+        response = self.request('POST', path, json=payload)
+        return response.json() if response.content else {}
+
+    def get_json(self, path: str, params: Optional[Dict] = None) -> Dict:
+        return self.request('GET', path, params=params).json()
+
+    def queue_prompt(self, prompt: Dict, client_id: str) -> str:
+        """提交工作流，返回prompt_id"""
+        return self.post_json('/prompt', {"prompt": prompt, "client_id": client_id})['prompt_id']
+
+    def get_history(self, prompt_id: str) -> Dict:
+        return self.get_json(f"/history/{prompt_id}")
+
+    def interrupt(self, prompt_id: Optional[str] = None):
+        self.post_json('/interrupt', {"prompt_id": prompt_id} if prompt_id else {})
+
+    def delete_from_queue(self, prompt_ids):
+        """从ComfyUI队列中删除尚未开始执行的prompt"""
+        self.post_json('/queue', {"delete": list(prompt_ids)})
+
+    def free(self, unload_models: bool = True, free_memory: bool = True):
+        """请求ComfyUI在当前任务结束后卸载模型并释放显存"""
+        self.post_json('/free', {"unload_models": unload_models, "free_memory": free_memory})
+
+    def get_system_stats(self) -> Dict:
+        return self.get_json('/system_stats')
+
+    @staticmethod
+    def _view_params(filename: str, subfolder: str, folder_type: str) -> Dict:
+        return {"filename": filename, "subfolder": subfolder, "type": folder_type}
+
+    def get_view(self, filename: str, subfolder: str = '', folder_type: str = 'output') -> bytes:
+        """下载输出文件的完整内容"""
+        return self.request('GET', '/view', params=self._view_params(filename, subfolder, folder_type)).content
+
+    def open_view(self, filename: str, subfolder: str = '', folder_type: str = 'output') -> Tuple[tempfile.SpooledTemporaryFile, int]:
+        """
+        流式下载输出文件到临时文件，读取位置已重置到开头
+        :return: (临时文件, 文件大小)，调用方使用完后需要关闭
+        """
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_max_size)
+        size = 0
+        try:
+            with self.request('GET', '/view', params=self._view_params(filename, subfolder, folder_type),
+                              stream=True) as response:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    if chunk:
+                        spool.write(chunk)
+                        size += len(chunk)
+        except Exception:
+            spool.close()
+            raise
+        spool.seek(0)
+        return spool, size
+
+    def close(self):
+        self.session.close()
+
+
+class ComfyUIHttpPool:
+    """按 (服务器地址, token) 复用HTTP客户端"""
+
+    def __init__(self):
+        self._clients: Dict[Tuple[str, Optional[str]], ComfyUIHttpClient] = {}
+        self._lock = threading.Lock()
+
+    def get(self, server_address: str, token: Optional[str] = None) -> ComfyUIHttpClient:
+        key = (server_address, token)
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    client = ComfyUIHttpClient(
+                        server_address,
+                        token,
+                        pool_size=getattr(settings, 'COMFYUI_HTTP_POOL_SIZE', 10),
+                        connect_timeout=getattr(settings, 'COMFYUI_HTTP_CONNECT_TIMEOUT', 5),
+                        read_timeout=getattr(settings, 'COMFYUI_HTTP_READ_TIMEOUT', 60),
+                        spool_max_size=getattr(settings, 'COMFYUI_VIEW_SPOOL_MAX_SIZE', 8 * 1024 * 1024),
+                    )
+                    self._clients[key] = client
+        return client
+
+    def close_all(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            client.close()
+
+
+# 创建全局HTTP连接池实例
+comfyui_http = ComfyUIHttpPool()
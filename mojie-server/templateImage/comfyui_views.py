@@ -16,9 +16,11 @@ import logging
 import uuid
 from rest_framework.pagination import PageNumberPagination
 
+from rest_framework.renderers import JSONRenderer
 from rest_framework_simplejwt.authentication import JWTAuthentication
 
 from common.ErrorCode import ErrorCode
+from common.event_stream import EventStreamRenderer, QueryParamJWTAuthentication, StreamLimiter
 from djangoProject import settings
 from templateImage.ImageUploadDTO import TextImageDTO, TextImageNewDTO, CompleteRedrawingWorkflowDTO, \
     InternalSupplementationAndRemovalWorkflowDTO, InternalSupplementationWorkflowDTO, WidePictureWorkflowDTO, \
@@ -40,6 +42,11 @@ from rest_framework import status
 from django.db.models import F
 from drf_spectacular.utils import extend_schema
 import json
+import time
+
+from django.http import StreamingHttpResponse
+
+from templateImage.task_events import task_event_bus
 
 # 尝试导入PointsManager，如不存在则使用空函数替代
 try:
@@ -154,304 +161,120 @@ def create_conversation_and_record(user, task_type, description, task_id, image_
 class TaskStatusAPIView(APIView):
     """
     获取任务状态的API视图
+    只读接口：从Redis状态快照读取，支持ETag/If-None-Match，状态修正由后台任务完成
     """
     permission_classes = [AllowAny]
 
+    @staticmethod
+    def _etag_matches(request, etag: str) -> bool:
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if not if_none_match:
+            return False
+        candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+        return '*' in candidates or etag in candidates
+
+    @staticmethod
+    def _build_result(task_id: str, task_status: dict) -> dict:
+        """从状态快照构建结果数据"""
+        output_data = task_status.get('output_data')
+        if output_data:
+            if isinstance(output_data, dict):
+                return output_data
+            try:
+                return json.loads(output_data) if isinstance(output_data, str) else output_data
+            except (json.JSONDecodeError, TypeError):
+                logger.warning(f"无法解析任务 {task_id} 的输出数据: {output_data}")
+                return {'data': output_data}
+        if 'image_urls' in task_status:
+            return {'image_urls': task_status['image_urls']}
+        # 已完成但快照中没有结果时，从关联的ImageUploadRecord获取URL
+        if task_status.get('status') == 'completed':
+            urls = [url for url in ImageUploadRecord.objects.filter(
+                comfyUI_task__task_id=task_id
+            ).values_list('image_url', flat=True) if url]
+            if urls:
+                logger.info(f"任务 {task_id} 从关联记录获取到 {len(urls)} 个图片URL")
+            return {'image_urls': urls}
+        return {'image_urls': []}
+
     @extend_schema(
-        responses={200: None},
-        description="获取任务状态"
+        responses={200: None, 304: None},
+        description="获取任务状态，支持If-None-Match条件请求；带wait参数（秒）时长轮询，状态变化或超时后返回"
     )
     def get(self, request, task_id):
         try:
-            logger.info(f"开始查询任务状态: {task_id}")
+            try:
+                wait = min(float(request.query_params.get('wait') or 0),
+                           getattr(settings, 'COMFYUI_LONG_POLL_MAX_WAIT', 30))
+            except ValueError:
+                wait = 0
+            deadline = time.time() + wait
+
+            while True:
+                # 先记录事件版本号再读取快照，读取期间发生的变化会让随后的等待立即返回
+                event_version = task_event_bus.version
+                event_sequence = task_event_bus.sequence
+                task_status = TaskUtils.get_task_status_snapshot(task_id)
+                if not task_status or task_status.get('status') in ['not_found', 'unknown']:
+                    logger.warning(f"任务不存在: {task_id}")
+                    return ResponseUtil.error(
+                        message="任务不存在",
+                        code=404
+                    )
+
+                etag = f'W/"{task_status["version"]}"'
+                if not self._etag_matches(request, etag):
+                    break
+
+                # 客户端已有最新状态：等待该任务的状态事件，超时返回304
+                while time.time() < deadline:
+                    event_version = task_event_bus.wait_for_event(event_version, timeout=deadline - time.time())
+                    events, complete, event_sequence = task_event_bus.events_since(event_sequence)
+                    if not complete or task_events_affect(events, {task_id: task_status.get('status')}):
+                        break
+                else:
+                    response = Response(status=status.HTTP_304_NOT_MODIFIED)
+                    response['ETag'] = etag
+                    return response
 
-            # 使用TaskUtils获取任务状态（保持一致性）
-            task_status = TaskUtils.get_task_status(task_id)
-            
-            # 记录任务状态来源，用于调试
-            if task_status:
-                status_source = task_status.get('from_source', 'unknown')
-                logger.info(f"任务 {task_id} 状态数据来源: {status_source}")
-                
-                # 记录Redis任务状态内容（调试用）
-                if status_source == 'redis':
-                    redis_keys = list(task_status.keys())
-                    logger.info(f"Redis中任务 {task_id} 的数据包含字段: {redis_keys}")
-                    if 'status' in task_status:
-                        logger.info(f"Redis中任务 {task_id} 的状态为: {task_status['status']}")
-                    if 'image_urls' in task_status:
-                        logger.info(f"Redis中任务 {task_id} 有 {len(task_status['image_urls'])} 个图片URL")
-                    elif 'output_data' in task_status and task_status['output_data']:
-                        logger.info(f"Redis中任务 {task_id} 的output_data类型: {type(task_status['output_data'])}")
-                
-                # 特殊处理 processing_completed 状态 - 这是一个临时状态
-                if task_status.get('status') == 'processing_completed':
-                    # 检查是否有输出结果
-                    has_results = False
-                    
-                    # 检查是否有图片URL
-                    if 'image_urls' in task_status and task_status['image_urls']:
-                        has_results = True
-                        logger.info(f"发现任务 {task_id} 处于processing_completed状态但已有图片URLs，应转为completed状态")
-                    
-                    # 检查是否有输出数据
-                    elif 'output_data' in task_status and task_status['output_data']:
-                        output_data = task_status['output_data']
-                        if isinstance(output_data, dict) and 'image_urls' in output_data and output_data['image_urls']:
-                            has_results = True
-                            logger.info(f"发现任务 {task_id} 处于processing_completed状态但已有输出数据，应转为completed状态")
-                    
-                    # 如果有结果，强制更新状态为completed
-                    if has_results:
-                        # 更新Redis和MySQL状态
-                        if hasattr(queue_service, '_update_task_status'):
-                            try:
-                                # 强制更新任务状态为completed
-                                queue_service._update_task_status(task_id, 'completed', force_redis_update=True)
-                                logger.info(f"已将任务 {task_id} 状态从processing_completed更新为completed")
-                                
-                                # 更新任务状态字典，用于返回给前端
-                                task_status['status'] = 'completed'
-                            except Exception as e:
-                                logger.error(f"更新任务状态失败: {str(e)}")
-            
-            if not task_status or task_status.get('status') == 'unknown':
-                logger.warning(f"任务不存在: {task_id}")
-                return ResponseUtil.error(
-                    message="任务不存在",
-                    code=404
-                )
-                
-            # 在Redis找不到状态时，可能需要从MySQL获取完整任务对象以获取某些字段
-            task = None
-            if task_status.get('from_source') == 'mysql' or not task_status.get('output_data'):
-                task = ComfyUITask.objects.filter(task_id=task_id).first()
-            
             # 准备响应数据
             response_data = {
                 'task_id': task_id,
                 'status': task_status.get('status'),
-                'created_at': task_status.get('created_at'),
+                'created_at': task_status.get('created_at') or timezone.now().isoformat(),
                 'updated_at': task_status.get('updated_at'),
                 'priority': task_status.get('priority'),
                 'progress': task_status.get('progress', 0.0),
+                'result': self._build_result(task_id, task_status),
             }
-            
-            # 确保created_at字段存在值
-            if not response_data['created_at']:
-                # 如果Redis中没有创建时间，尝试从MySQL获取
-                if task is None:
-                    task = ComfyUITask.objects.filter(task_id=task_id).first()
-                if task and task.created_at:
-                    response_data['created_at'] = task.created_at.isoformat()
-                    logger.info(f"从MySQL获取到任务 {task_id} 的创建时间")
-                else:
-                    # 如果MySQL也没有，使用当前时间
-                    response_data['created_at'] = timezone.now().isoformat()
-                    logger.warning(f"任务 {task_id} 的创建时间未知，使用当前时间代替")
-            
-            # 添加处理时间（如果有）
+            if task_status.get('queue_position') is not None:
+                response_data['queue_position'] = task_status['queue_position']
             if 'processing_time' in task_status:
                 response_data['processing_time'] = task_status['processing_time']
-            
-            # 添加输入数据（如果有）
             if 'input_data' in task_status:
                 response_data['input_data'] = task_status['input_data']
-            elif task and task.input_data:
-                response_data['input_data'] = task.input_data
-            
-            # 添加输出数据（如果有）
-            if 'output_data' in task_status and task_status['output_data']:
-                output_data = task_status['output_data']
-                if isinstance(output_data, dict):
-                    # 已是字典格式
-                    response_data['result'] = output_data
-                else:
-                    # 尝试解析JSON字符串
-                    try:
-                        parsed_data = json.loads(output_data) if isinstance(output_data, str) else output_data
-                        response_data['result'] = parsed_data
-                    except (json.JSONDecodeError, TypeError):
-                        logger.warning(f"无法解析任务 {task_id} 的输出数据: {output_data}")
-                        response_data['result'] = {'data': output_data}
-            elif task and task.output_data:
-                response_data['result'] = task.output_data
-            # 检查图片URL结果
-            elif 'image_urls' in task_status:
-                response_data['result'] = {'image_urls': task_status['image_urls']}
-            else:
-                logger.warning(f"任务 {task_id} 没有output_data")
-                # 如果已完成但无output_data，尝试从关联的ImageUploadRecord获取URL
-                if task_status.get('status') == 'completed':
-                    if task is None:
-                        task = ComfyUITask.objects.filter(task_id=task_id).first()
-                        
-                    if task:
-                        records = ImageUploadRecord.objects.filter(comfyUI_task=task)
-                        if records.exists():
-                            urls = [record.image_url for record in records if record.image_url]
-                            if urls:
-                                logger.info(f"任务 {task_id} 从关联记录获取到 {len(urls)} 个图片URL")
-                                response_data['result'] = {'image_urls': urls}
-                            else:
-                                response_data['result'] = {'image_urls': []}
-                        else:
-                            response_data['result'] = {'image_urls': []}
-                    else:
-                        response_data['result'] = {'image_urls': []}
-                else:
-                    response_data['result'] = {'image_urls': []}
-            
-            # 添加错误信息（如果有）
-            if 'error_message' in task_status and task_status['error_message']:
+            if task_status.get('error_message'):
                 response_data['error'] = task_status['error_message']
-            elif task and task.error_message:
-                response_data['error'] = task.error_message
-            
+
             # 添加执行时间
             if task_status.get('completed_at') and task_status.get('created_at'):
-                try:
-                    # 确保时间格式一致
-                    from_time = None
-                    to_time = None
-                    
-                    # 处理created_at
-                    if isinstance(task_status['created_at'], str):
-                        try:
-                            from_time = parse_datetime(task_status['created_at'])
-                        except (ValueError, TypeError):
-                            logger.warning(f"无法解析created_at时间字符串: {task_status['created_at']}")
-                    else:
-                        from_time = task_status['created_at']
-                    
-                    # 处理completed_at
-                    if isinstance(task_status['completed_at'], str):
-                        try:
-                            to_time = parse_datetime(task_status['completed_at'])
-                        except (ValueError, TypeError):
-                            logger.warning(f"无法解析completed_at时间字符串: {task_status['completed_at']}")
-                    else:
-                        to_time = task_status['completed_at']
-                    
-                    # 计算执行时间
-                    if from_time and to_time:
-                        execution_time = (to_time - from_time).total_seconds()
-                        response_data['execution_time_seconds'] = round(execution_time, 2)
-                    else:
-                        logger.warning(f"无法计算执行时间: from_time={from_time}, to_time={to_time}")
-                except Exception as e:
-                    logger.warning(f"计算执行时间时出错: {str(e)}")
-                    # 尝试从MySQL获取执行时间
-                    if task and task.completed_at and task.created_at:
-                        execution_time = (task.completed_at - task.created_at).total_seconds()
-                        response_data['execution_time_seconds'] = round(execution_time, 2)
-                        logger.info(f"从MySQL计算得到任务 {task_id} 的执行时间: {round(execution_time, 2)}秒")
-            elif task and task.completed_at and task.created_at:
-                execution_time = (task.completed_at - task.created_at).total_seconds()
-                response_data['execution_time_seconds'] = round(execution_time, 2)
-                logger.info(f"从MySQL计算得到任务 {task_id} 的执行时间: {round(execution_time, 2)}秒")
-            
-            # 记录任务状态
-            logger.info(f"任务状态查询成功: {task_id}, 状态: {task_status.get('status')}")
-            
-            # 特殊处理: 检测是否有图片结果但状态不匹配的情况
-            if (task_status.get('status') == 'processing' or task_status.get('status') == 'processing_completed') and 'result' in response_data and 'image_urls' in response_data['result'] and response_data['result']['image_urls']:
-                logger.info(f"检测到任务 {task_id} 状态为{task_status.get('status')}但已有结果图片，自动将状态更新为completed")
-                
-                # 处理任务完成相关逻辑（例如积分扣除等）
-                if task is None:
-                    task = ComfyUITask.objects.filter(task_id=task_id).first()
-                    
-                if task and task.user:
-                    # 尝试扣除积分
-                    try:
-                        # 获取任务类型对应的积分
-                        task_info = ComfyUITask.TASK_TYPE_INFO.get(task.task_type, {})
-                        points_required = task_info.get('points', 0)
-                
-                        # 如果需要扣除积分
-                        if points_required > 0:
-                            # 获取用户信息
-                            user = task.user
-                            
-                            # 检查是否已经扣除过积分
-                            if not hasattr(task, 'is_points_deducted') or not task.is_points_deducted:
-                                # 导入PointsManager
-                                from user.points import PointsManager
-                                
-                                # 扣除积分
-                                result = PointsManager.deduct_points(
-                                    user=user, 
-                                    points=points_required, 
-                                    reason=f"使用{task_info.get('name', task.task_type)}功能",
-                                    notes=f"任务ID: {task_id}",
-                                    transaction_type="AI生成"
-                                )
-            
-                                if result['success']:
-                                    logger.info(f"已扣除用户 {user.username} 的普通积分 {points_required} 点")
-                                    # 标记为已扣除
-                                    task.is_points_deducted = True
-                                    task.save(update_fields=['is_points_deducted'])
-                                else:
-                                    logger.warning(f"扣除积分失败: {result['message']}")
-                            else:
-                                logger.info(f"任务 {task_id} 已扣除过积分，跳过")
-                                
-                            logger.info(f"任务 {task_id} 成功完成，已扣除用户积分")
-                        
-                        # 检查是否需要自动保存到云空间
-                        auto_save = task_info.get('auto_save_to_cloud', False)
-                        if auto_save:
-                            # TODO: 实现自动保存到云空间逻辑
-                            logger.info(f"任务 {task_id} 自动保存到云空间功能已开启，准备保存图片")
-                        else:
-                            logger.info(f"任务 {task_id} 自动保存到云空间功能已关闭，不自动保存图片")
-                    except Exception as e:
-                        logger.error(f"处理积分扣除时出错: {str(e)}")
-                
-                # 更新任务状态为已完成
-                TaskUtils._update_task_status(
-                    task_id,
-                    'completed',
-                    force_redis_update=True,
-                    output_data=response_data.get('result'),
-                    completed_at=timezone.now()
-                )
-                            
-                # 更新返回给前端的状态
+                from_time = parse_datetime(task_status['created_at'])
+                to_time = parse_datetime(task_status['completed_at'])
+                if from_time and to_time:
+                    response_data['execution_time_seconds'] = round((to_time - from_time).total_seconds(), 2)
+
+            # 已有结果但状态尚未修正的任务直接按completed返回，持久化由后台状态修正完成
+            if response_data['status'] in ['processing', 'processing_completed'] and \
+                    response_data['result'].get('image_urls'):
                 response_data['status'] = 'completed'
-                logger.info(f"已自动将任务 {task_id} 状态从{task_status.get('status')}更新为completed")
-            
-            # 同步记录状态
-            if task_status.get('status') == 'completed':
-                logger.info(f"任务完成，图片URL: {response_data.get('result', {}).get('image_urls', [])}")
-                
-                # 使用sync_record_status方法确保所有记录状态和image_url都是最新的
-                sync_result = TaskUtils.sync_record_status(task_id, force=True)
-                if sync_result['success'] and sync_result['updated_count'] > 0:
-                    logger.info(f"任务状态查询: 使用sync_record_status同步更新了 {sync_result['updated_count']} 条记录")
-                elif not sync_result['success']:
-                    logger.error(f"任务状态查询: 同步记录状态失败: {sync_result.get('message', '未知错误')}")
-                
-            elif task_status.get('status') == 'failed':
-                if task is None:
-                    task = ComfyUITask.objects.filter(task_id=task_id).first()
-                
-                if task:
-                    logger.error(f"任务失败: {task.error_message or '未知错误'}")
-                    
-                    # 使用TaskUtils.sync_record_status方法同步记录状态
-                    sync_result = TaskUtils.sync_record_status(task_id, force=False)
-                    if sync_result['success'] and sync_result['updated_count'] > 0:
-                        logger.info(f"任务状态查询: 已同步 {sync_result['updated_count']} 条记录状态为failed")
-                    elif not sync_result['success']:
-                        logger.error(f"任务状态查询: 同步记录状态失败: {sync_result.get('message', '未知错误')}")
 
-            return ResponseUtil.success(
+            response = ResponseUtil.success(
                 data=response_data,
                 message="任务状态获取成功"
             )
+            response['ETag'] = etag
+            response['Cache-Control'] = 'no-cache'
+            return response
 
         except Exception as e:
             logger.error(f"获取任务状态失败: {str(e)}", exc_info=True)
@@ -461,6 +284,165 @@ class TaskStatusAPIView(APIView):
             )
 
 
+def task_events_affect(events: list, task_statuses: dict) -> bool:
+    """
+    判断一批任务事件是否影响关注的任务
+    :param events: 任务事件列表
+    :param task_statuses: 关注的任务ID -> 当前状态；待处理任务在其他任务离开等待队列时位置会变化
+    """
+    watching_queue = 'pending' in task_statuses.values()
+    for event in events:
+        if event.get('task_id') in task_statuses:
+            return True
+        if watching_queue and event.get('status') != 'pending' and 'progress' not in event:
+            return True
+    return False
+
+
+# 本进程同时保持的推送连接数上限
+_sse_stream_limiter = StreamLimiter(getattr(settings, 'COMFYUI_SSE_MAX_STREAMS', 50))
+
+
+class TaskEventStreamAPIView(APIView):
+    """
+    任务状态推送接口（Server-Sent Events）
+    推送单个任务或当前用户所有任务的状态、进度和队列位置变化，替代客户端轮询
+    单任务推送在任务结束后关闭连接；连接达到COMFYUI_SSE_MAX_DURATION后关闭，客户端自动重连
+    用户任务推送可通过查询参数token传递JWT（EventSource无法设置Authorization请求头）
+    每个连接在保持期间占用一个worker线程，部署时应使用gthread/gevent等worker，
+    单进程的连接数受COMFYUI_SSE_MAX_STREAMS限制，超出时通知客户端稍后重连
+    """
+    TERMINAL_STATUSES = ['completed', 'failed', 'cancelled']
+    renderer_classes = [JSONRenderer, EventStreamRenderer]
+    authentication_classes = [JWTAuthentication, QueryParamJWTAuthentication]
+
+    def get_permissions(self):
+        # 单任务推送与TaskStatusAPIView一致，用户任务推送需要登录
+        if self.kwargs.get('task_id'):
+            return [AllowAny()]
+        return super().get_permissions()
+
+    @staticmethod
+    def _format_event(snapshot: dict) -> str:
+        payload = {
+            'task_id': snapshot.get('task_id'),
+            'status': snapshot.get('status'),
+            'progress': snapshot.get('progress', 0.0),
+            'queue_position': snapshot.get('queue_position'),
+            'timestamp': snapshot.get('timestamp'),
+        }
+        if snapshot.get('error_message'):
+            payload['error'] = snapshot['error_message']
+        image_urls = TaskUtils._snapshot_image_urls(snapshot)
+        if image_urls:
+            payload['image_urls'] = image_urls
+        data = json.dumps(payload, ensure_ascii=False, default=str)
+        return f"id: {snapshot['version']}\nevent: status\ndata: {data}\n\n"
+
+    def _stream(self, task_ids: set, user_id=None):
+        """
+        事件流生成器：等待任务事件，只在关注的任务变化时读取快照并推送
+        :param task_ids: 关注的任务ID
+        :param user_id: 用户ID，用户模式下推送该用户新建的任务
+        """
+        heartbeat = getattr(settings, 'COMFYUI_SSE_HEARTBEAT', 15)
+        deadline = time.time() + getattr(settings, 'COMFYUI_SSE_MAX_DURATION', 300)
+        single_task = user_id is None
+        sent_versions = {}
+        task_statuses = {task_id: None for task_id in task_ids}
+        other_tasks = set()  # 已确认不属于该用户的任务
+
+        yield "retry: 3000\n\n"
+        event_sequence = task_event_bus.sequence
+        changed = set(task_statuses)
+        while True:
+            for task_id in changed:
+                snapshot = TaskUtils.get_task_status_snapshot(task_id)
+                if snapshot.get('status') == 'not_found':
+                    task_statuses.pop(task_id, None)
+                    continue
+                task_statuses[task_id] = snapshot.get('status')
+                if sent_versions.get(task_id) != snapshot['version']:
+                    sent_versions[task_id] = snapshot['version']
+                    yield self._format_event(snapshot)
+                if snapshot.get('status') in self.TERMINAL_STATUSES:
+                    if single_task:
+                        return
+                    task_statuses.pop(task_id, None)
+            if single_task and not task_statuses:
+                return
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            # 推送接口同时关注状态和进度事件
+            new_sequence = task_event_bus.wait_for_update(event_sequence, timeout=min(heartbeat, remaining))
+            if new_sequence == event_sequence:
+                yield ": ping\n\n"
+                changed = set()
+                continue
+
+            events, complete, event_sequence = task_event_bus.events_since(event_sequence)
+            if not complete:
+                # 错过了部分事件，重新读取所有关注任务的状态
+                changed = set(task_statuses)
+                continue
+
+            changed = set()
+            queue_moved = False
+            for event in events:
+                event_task_id = event.get('task_id')
+                if event.get('status') != 'pending' and 'progress' not in event:
+                    queue_moved = True
+                if not event_task_id or event_task_id in task_statuses:
+                    if event_task_id:
+                        changed.add(event_task_id)
+                    continue
+                if single_task or event_task_id in other_tasks or event.get('status') in self.TERMINAL_STATUSES:
+                    continue
+                # 用户模式下发现新任务，按事件中的用户ID判断归属，缺失时查询一次数据库
+                if 'user_id' in event:
+                    owned = event['user_id'] == user_id
+                else:
+                    owned = ComfyUITask.objects.filter(task_id=event_task_id, user_id=user_id).exists()
+                if owned:
+                    task_statuses[event_task_id] = None
+                    changed.add(event_task_id)
+                else:
+                    other_tasks.add(event_task_id)
+            if queue_moved:
+                changed.update(task_id for task_id, task_status in task_statuses.items() if task_status == 'pending')
+
+    @extend_schema(
+        responses={200: None},
+        description="以Server-Sent Events推送任务状态、进度和队列位置变化；不带task_id时推送当前用户的所有未完成任务"
+    )
+    def get(self, request, task_id=None):
+        if task_id:
+            if not ComfyUITask.objects.filter(task_id=task_id).exists():
+                return ResponseUtil.error(message="任务不存在", code=404)
+            stream = self._stream({task_id})
+        else:
+            user_id = request.user.id
+            active_task_ids = set(ComfyUITask.objects.filter(
+                user_id=user_id,
+                status__in=['pending', 'processing', 'processing_completed']
+            ).values_list('task_id', flat=True))
+            stream = self._stream(active_task_ids, user_id=user_id)
+
+        if _sse_stream_limiter.try_acquire():
+            stream = _sse_stream_limiter.lease(stream)
+        else:
+            logger.warning(f"推送连接数已达上限 {_sse_stream_limiter.max_streams}，通知客户端稍后重连")
+            stream = iter(["retry: 10000\n\n"])
+
+        response = StreamingHttpResponse(stream, content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # 禁止Nginx缓冲事件流
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
 @method_decorator(csrf_exempt, name='dispatch')
 class TaskCancelAPIView(APIView):
     """
@@ -549,16 +531,6 @@ class QueueInfoAPIView(APIView):
                 count=Count('task_id')
             )
 
-            # 在查询任务队列之前，重新计算所有队列位置
-            TaskUtils._recalculate_queue_positions()
-            
-            # 手动设置正在处理的任务的队列位置为0（最高优先级）
-            processing_tasks = ComfyUITask.objects.filter(status='processing')
-            for task in processing_tasks:
-                task.queue_position = 0
-                task.save(update_fields=['queue_position'])
-                logger.info(f"手动设置处理中任务 {task.task_id} 的队列位置为0")
-
             # 获取当前队列中的任务（包括待处理和正在处理的任务，按状态、优先级和创建时间排序）
             queue_tasks = ComfyUITask.objects.filter(
                 Q(status='pending') | Q(status='processing')
@@ -576,6 +548,18 @@ class QueueInfoAPIView(APIView):
                 'progress'
             )
 
+            # 队列位置从排名索引读取（处理中的任务为0），不再在每次请求时重算并写回数据库
+            queue_tasks = list(queue_tasks)
+            pending_ranks = queue_service.get_pending_ranks(
+                [t['task_id'] for t in queue_tasks if t['status'] == 'pending']
+            )
+            for queue_task in queue_tasks:
+                if queue_task['status'] == 'processing':
+                    queue_task['queue_position'] = 0
+                elif queue_task['task_id'] in pending_ranks:
+                    queue_task['queue_position'] = pending_ranks[queue_task['task_id']]
+            queue_tasks.sort(key=lambda t: (t['status'] != 'processing', t['queue_position'] or 0))
+
             # 获取正在处理的任务
             processing_tasks = ComfyUITask.objects.filter(
                 status='processing'
@@ -590,7 +574,7 @@ class QueueInfoAPIView(APIView):
                     'status_stats': list(status_stats),
                     'priority_stats': list(priority_stats),
                     'recent_stats': list(recent_stats),
-                    'queue_tasks': list(queue_tasks),
+                    'queue_tasks': queue_tasks,
                     'processing_tasks': list(processing_tasks)},
                  message="获取队列信息成功！"
             )
@@ -0,0 +1,229 @@
+"""
+ComfyUI WebSocket长连接管理模块
+每个ComfyUI服务器维持一条共享的WebSocket连接，由后台线程读取消息并按prompt_id分发给等待的任务，
+断线后按指数退避自动重连，任务无需各自建立连接和握手
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+from queue import Queue
+from typing import Dict, List, Optional, Tuple
+
+import websocket
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# 按prompt_id分发的消息类型，其余消息（如status）广播给所有订阅者
+PROMPT_MESSAGE_TYPES = ('executing', 'executed', 'progress', 'execution_start', 'execution_cached',
+                        'execution_error', 'execution_interrupted', 'execution_success')
+
+
+class ComfyUIConnection:
+    def __init__(self, server_address: str, token: Optional[str] = None, connect_timeout: float = 10,
+                 max_reconnect_delay: float = 30, idle_ping_interval: float = 30, early_message_ttl: float = 120):
+        """
+        单个ComfyUI服务器的共享WebSocket连接
+        :param server_address: 服务器地址
+        :param token: 认证token
+        :param connect_timeout: 建立连接的超时时间（秒）
+        :param max_reconnect_delay: 最大重连延迟（秒）
+        :param idle_ping_interval: 连接空闲多久后发送ping保活（秒）
+        :param early_message_ttl: 订阅前到达的消息的保留时间（秒）
+        """
+        self.server_address = server_address
+        self.token = token
+        # 同一服务器上的所有任务使用同一个client_id提交，ComfyUI会把它们的消息都推送到这条连接
+        self.client_id = str(uuid.uuid4())
+        self.connect_timeout = connect_timeout
+        self.max_reconnect_delay = max_reconnect_delay
+        self.idle_ping_interval = idle_ping_interval
+        self.early_message_ttl = early_message_ttl
+
+        self._ws = None
+        self._connected = threading.Event()
+        self._running = True
+        self._reader_thread = None
+        self._lock = threading.Lock()
+        self._subscriptions: Dict[str, Queue] = {}  # prompt_id -> 消息队列
+        # 提交后、订阅前到达的消息：prompt_id -> [(到达时间, 消息)]
+        self._early_messages: Dict[str, List[Tuple[float, dict]]] = {}
+        self._executing_prompt_id = None  # 当前正在执行的prompt，用于归属不带prompt_id的消息
+
+    @property
+    def is_connected(self) -> bool:
+        return self._connected.is_set()
+
+    def _ws_url(self) -> str:
+        url = f"ws://{self.server_address}/ws?clientId={self.client_id}"
+        if self.token:
+            url += f"&token={self.token}"
+        return url
+
+    def ensure_connected(self, timeout: Optional[float] = None) -> bool:
+        """
+        确保读取线程已启动并等待连接可用
+        :param timeout: 最长等待时间（秒），默认使用连接超时时间
+        :return: 连接是否可用
+        """
+        if not self._running:
+            return False
+        with self._lock:
+            if not self._reader_thread or not self._reader_thread.is_alive():
+                self._reader_thread = threading.Thread(target=self._run, daemon=True)
+                self._reader_thread.start()
+        return self._connected.wait(self.connect_timeout if timeout is None else timeout)
+
+    def _run(self):
+        """读取线程：建立连接、读取消息，断线后按指数退避重连"""
+        delay = 1
+        has_connected = False
+        while self._running:
+            try:
+                ws = websocket.WebSocket()
+                ws.connect(self._ws_url(), timeout=self.connect_timeout)
+                ws.settimeout(self.idle_ping_interval)
+            except Exception as e:
+                logger.error(f"连接ComfyUI服务器 {self.server_address} 的WebSocket失败，{delay} 秒后重试: {str(e)}")
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+                continue
+
+            self._ws = ws
+            self._connected.set()
+            delay = 1
+            logger.info(f"已建立ComfyUI服务器 {self.server_address} 的共享WebSocket连接")
+            if has_connected:
+                # 断线期间的消息已经丢失，通知等待的任务通过历史记录核对执行结果
+                self._broadcast({'type': 'reconnected', 'data': {}})
+            has_connected = True
+
+            try:
+                while self._running:
+                    try:
+                        message = ws.recv()
+                    except websocket.WebSocketTimeoutException:
+                        ws.ping()
+                        continue
+                    # 二进制消息为预览图，不需要处理
+                    if isinstance(message, str):
+                        self._dispatch(message)
+            except Exception as e:
+                if self._running:
+                    logger.warning(f"ComfyUI服务器 {self.server_address} 的WebSocket连接断开: {str(e)}")
+            finally:
+                self._connected.clear()
+                self._ws = None
+                try:
+                    ws.close()
+                except Exception:
+                    pass
+            if self._running:
+                self._broadcast({'type': 'connection_lost', 'data': {}})
+
+    def _dispatch(self, raw: str):
+        """按prompt_id将消息分发给订阅的任务"""
+        try:
+            message = json.loads(raw)
+        except json.JSONDecodeError as e:
+            logger.error(f"解析ComfyUI消息失败: {str(e)}")
+            return
+        if not isinstance(message, dict):
+            return
+
+        message_type = message.get('type')
+        data = message.get('data') or {}
+        if message_type not in PROMPT_MESSAGE_TYPES:
+            self._broadcast(message)
+            return
+
+        # 部分版本的progress/executed消息不带prompt_id，归属于当前正在执行的prompt
+        prompt_id = data.get('prompt_id') or self._executing_prompt_id
+        if message_type == 'executing':
+            self._executing_prompt_id = prompt_id if data.get('node') is not None else None
+        if not prompt_id:
+            return
+
+        with self._lock:
+            queue = self._subscriptions.get(prompt_id)
+            if queue is None:
+                self._prune_early_messages()
+                self._early_messages.setdefault(prompt_id, []).append((time.time(), message))
+                return
+        queue.put(message)
+
+    def _prune_early_messages(self):
+        """清理过期的未订阅消息（调用方持有锁）"""
+        expire_before = time.time() - self.early_message_ttl
+        for prompt_id in [prompt_id for prompt_id, messages in self._early_messages.items()
+                          if messages[-1][0] < expire_before]:
+            del self._early_messages[prompt_id]
+
+    def _broadcast(self, message: dict):
+        with self._lock:
+            queues = list(self._subscriptions.values())
+        for queue in queues:
+            queue.put(message)
+
+    def subscribe(self, prompt_id: str) -> Queue:
+        """
+        订阅prompt的消息，订阅前已到达的消息会先放入队列
+        :return: 消息队列
+        """
+        queue = Queue()
+        with self._lock:
+            for _, message in self._early_messages.pop(prompt_id, []):
+                queue.put(message)
+            self._subscriptions[prompt_id] = queue
+        return queue
+
+    def unsubscribe(self, prompt_id: str):
+        with self._lock:
+            self._subscriptions.pop(prompt_id, None)
+            self._early_messages.pop(prompt_id, None)
+
+    def close(self):
+        """关闭连接并停止读取线程"""
+        self._running = False
+        ws = self._ws
+        if ws:
+            try:
+                ws.close()
+            except Exception as e:
+                logger.error(f"关闭ComfyUI服务器 {self.server_address} 的WebSocket连接失败: {str(e)}")
+        self._connected.clear()
+
+
+class ComfyUIConnectionManager:
+    """按 (服务器地址, token) 管理共享的WebSocket连接"""
+
+    def __init__(self):
+        self._connections: Dict[Tuple[str, Optional[str]], ComfyUIConnection] = {}
+        self._lock = threading.Lock()
+
+    def get(self, server_address: str, token: Optional[str] = None) -> ComfyUIConnection:
+        key = (server_address, token)
+        with self._lock:
+            connection = self._connections.get(key)
+            if connection is None or not connection._running:
+                connection = ComfyUIConnection(
+                    server_address,
+                    token,
+                    max_reconnect_delay=getattr(settings, 'COMFYUI_WS_MAX_RECONNECT_DELAY', 30),
+                    idle_ping_interval=getattr(settings, 'COMFYUI_WS_PING_INTERVAL', 30),
+                )
+                self._connections[key] = connection
+            return connection
+
+    def close_all(self):
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for connection in connections:
+            connection.close()
+
+
+# 创建全局连接管理实例
+comfyui_connections = ComfyUIConnectionManager()
@@ -0,0 +1,167 @@
+"""
+对象存储内容索引模块
+以内容SHA-256为键记录已上传的对象，Redis作为缓存，数据库作为持久化兜底；
+相同内容再次上传到同一目录时直接复用已有对象，不再重复上传。
+复用的对象可能被多条记录引用，数据库中记录引用次数，删除时只有最后一个引用才真正删除对象
+"""
+import hashlib
+import logging
+from typing import Optional, Tuple
+
+import redis
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import F
+
+from templateImage.models import StoredObjectHash
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class ContentHashIndex:
+    KEY_PREFIX = 'tos_content_hash'
+
+    def __init__(self, redis_host: str = 'localhost', redis_port: int = 6379, cache_ttl: int = 7 * 24 * 3600):
+        self.redis = redis.StrictRedis(host=redis_host, port=redis_port, db=0, decode_responses=True)
+        self.cache_ttl = cache_ttl
+
+    @property
+    def enabled(self) -> bool:
+        return getattr(settings, 'CONTENT_DEDUP_ENABLED', True)
+
+    def _key(self, sha256: str, folder: str) -> str:
+        return f"{self.KEY_PREFIX}:{folder}:{sha256}"
+
+    @staticmethod
+    def folder_of(object_name: str) -> str:
+        """对象所在目录，去重只在同一目录内进行，避免删除某个目录的对象时影响其他业务"""
+        return object_name.rsplit('/', 1)[0] if '/' in object_name else ''
+
+    @staticmethod
+    def compute(data=None, file_path: Optional[str] = None) -> Optional[Tuple[str, int]]:
+        """
+        计算内容的SHA-256
+        :param data: 字节数据或可seek的文件对象（计算后恢复读取位置）
+        :param file_path: 本地文件路径
+        :return: (十六进制摘要, 字节数)，无法在不消耗内容的前提下计算时返回None（如迭代器、不可seek的流）
+        """
+        digest = hashlib.sha256()
+        size = 0
+        if isinstance(data, (bytes, bytearray)):
+            digest.update(data)
+            return digest.hexdigest(), len(data)
+
+        if file_path:
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    size += len(chunk)
+            return digest.hexdigest(), size
+
+        if data is not None and hasattr(data, 'read') and hasattr(data, 'seek'):
+            try:
+                start = data.tell()
+                for chunk in iter(lambda: data.read(HASH_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    size += len(chunk)
+                data.seek(start)
+            except Exception as e:
+                logger.debug(f"文件对象不支持计算内容哈希: {str(e)}")
+                return None
+            return digest.hexdigest(), size
+        return None
+
+    def lookup(self, sha256: str, folder: str = '') -> Optional[str]:
+        """查找内容对应的已有对象名称，先查Redis，未命中时查数据库并回填Redis"""
+        key = self._key(sha256, folder)
+        try:
+            object_key = self.redis.get(key)
+            if object_key:
+                return object_key
+        except Exception as e:
+            logger.error(f"从Redis查询内容索引失败，改为查询数据库: {str(e)}")
+
+        record = StoredObjectHash.objects.filter(sha256=sha256, folder=folder).only('object_key').first()
+        if not record:
+            return None
+        try:
+            self.redis.setex(key, self.cache_ttl, record.object_key)
+        except Exception as e:
+            logger.error(f"回填内容索引缓存失败: {str(e)}")
+        return record.object_key
+
+    def acquire(self, sha256: str, folder: str = '') -> Optional[str]:
+        """
+        复用已有对象并增加其引用次数
+        :return: 已有对象名称，没有可复用的对象（或索引已被删除）时返回None
+        """
+        object_key = self.lookup(sha256, folder)
+        if not object_key:
+            return None
+        # Redis中的记录只作为提示，以数据库中引用次数的增加结果为准
+        updated = StoredObjectHash.objects.filter(sha256=sha256, folder=folder, object_key=object_key).update(
+            ref_count=F('ref_count') + 1)
+        if updated:
+            return object_key
+        try:
+            self.redis.delete(self._key(sha256, folder))
+        except Exception as e:
+            logger.error(f"删除过期的内容索引缓存失败: {str(e)}")
+        return None
+
+    def release(self, object_key: str) -> bool:
+        """
+        减少对象的引用次数
+        :return: 对象已不再被引用（或没有索引记录）、可以删除时返回True
+        """
+        while True:
+            record = StoredObjectHash.objects.filter(object_key=object_key).only('id', 'sha256', 'folder').first()
+            if not record:
+                return True
+            if StoredObjectHash.objects.filter(id=record.id, ref_count__gt=1).update(
+                    ref_count=F('ref_count') - 1):
+                logger.info(f"对象 {object_key} 仍被其他记录引用，保留对象")
+                return False
+            # 最后一个引用：删除索引；删除前被并发复用（引用次数已增加）时重新检查
+            deleted, _ = StoredObjectHash.objects.filter(id=record.id, ref_count__lte=1).delete()
+            if deleted:
+                try:
+                    self.redis.delete(self._key(record.sha256, record.folder))
+                except Exception as e:
+                    logger.error(f"删除内容索引缓存失败: {str(e)}")
+                return True
+
+    def record(self, sha256: str, object_key: str, size: int = 0):
+        """记录新上传的对象，同一目录下相同内容已有记录时保留原记录"""
+        folder = self.folder_of(object_key)
+        try:
+            StoredObjectHash.objects.create(sha256=sha256, folder=folder, object_key=object_key, size=size)
+        except IntegrityError:
+            # 并发上传相同内容时另一方已经写入，保留先写入的对象
+            object_key = StoredObjectHash.objects.filter(sha256=sha256, folder=folder).values_list(
+                'object_key', flat=True).first() or object_key
+        try:
+            self.redis.setex(self._key(sha256, folder), self.cache_ttl, object_key)
+        except Exception as e:
+            logger.error(f"写入内容索引缓存失败: {str(e)}")
+
+    def forget_object(self, object_key: str):
+        """对象被删除后移除其索引，避免后续上传复用已不存在的对象"""
+        records = list(StoredObjectHash.objects.filter(object_key=object_key))
+        if not records:
+            return
+        try:
+            self.redis.delete(*[self._key(record.sha256, record.folder) for record in records])
+        except Exception as e:
+            logger.error(f"删除内容索引缓存失败: {str(e)}")
+        StoredObjectHash.objects.filter(id__in=[record.id for record in records]).delete()
+
+
+# 创建全局内容索引实例
+content_hash_index = ContentHashIndex(
+    redis_host=settings.REDIS_HOST,
+    redis_port=settings.REDIS_PORT,
+    cache_ttl=getattr(settings, 'CONTENT_DEDUP_CACHE_TTL', 7 * 24 * 3600)
+)
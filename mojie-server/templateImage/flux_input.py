@@ -0,0 +1,140 @@
+"""
+Flux输入图片预处理模块
+先把输入图片缩小到Flux实际使用的分辨率再拼接网格，用JPEG（或低压缩级别的PNG）编码，
+按输入图片内容哈希缓存编码结果，相同的输入组合不再重复解码、拼接和编码
+"""
+import base64
+import hashlib
+import logging
+import math
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from typing import List, Tuple
+
+from django.conf import settings
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+
+class FluxInputPreparer:
+    def __init__(self, max_pixels: int = 1024 * 1024, image_format: str = 'JPEG', jpeg_quality: int = 90,
+                 png_compress_level: int = 1, cache_size: int = 32):
+        """
+        :param max_pixels: 编码后图片的最大像素数，超过时等比缩小
+        :param image_format: 编码格式，JPEG或PNG
+        :param jpeg_quality: JPEG质量
+        :param png_compress_level: PNG压缩级别（0-9），越低越快
+        :param cache_size: 缓存的编码结果数量
+        """
+        self.max_pixels = max_pixels
+        self.image_format = image_format.upper()
+        self.jpeg_quality = jpeg_quality
+        self.png_compress_level = png_compress_level
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, str]" = OrderedDict()  # 输入哈希 -> base64编码结果
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def grid_shape(num_images: int) -> Tuple[int, int]:
+        """根据图片数量计算网格的行数和列数"""
+        if num_images <= 2:
+            return 1, num_images
+        elif num_images <= 4:
+            return 2, 2
+        elif num_images <= 6:
+            return 2, 3
+        elif num_images <= 9:
+            return 3, 3
+        return 3, 4
+
+    @classmethod
+    def capacity(cls, num_images: int) -> int:
+        """网格最多容纳的图片数，超出的图片不会参与拼接"""
+        rows, cols = cls.grid_shape(num_images)
+        return rows * cols
+
+    def _cache_key(self, images: List[bytes]) -> str:
+        digest = hashlib.sha256(
+            f"{self.max_pixels}:{self.image_format}:{self.jpeg_quality}:{self.png_compress_level}".encode('utf-8')
+        )
+        for data in images:
+            digest.update(hashlib.sha256(data).digest())
+        return digest.hexdigest()
+
+    def _scaled_size(self, width: int, height: int, count: int = 1) -> Tuple[int, int]:
+        """count张该尺寸的图片总像素不超过max_pixels时的尺寸"""
+        scale = min(1.0, math.sqrt(self.max_pixels / (width * height * count)))
+        return max(1, round(width * scale)), max(1, round(height * scale))
+
+    @staticmethod
+    def _load(data: bytes, size: Tuple[int, int]) -> Image.Image:
+        """解码并缩放到指定尺寸，JPEG在解码时直接按比例缩小"""
+        img = Image.open(BytesIO(data))
+        img.draft('RGB', size)
+        img = img.convert('RGB')
+        if img.size != size:
+            img = img.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+        return img
+
+    def _compose(self, images: List[bytes]) -> Image.Image:
+        if len(images) == 1:
+            width, height = Image.open(BytesIO(images[0])).size
+            return self._load(images[0], self._scaled_size(width, height))
+
+        rows, cols = self.grid_shape(len(images))
+        # 使用第一张图片的尺寸作为基准，所有格子的总像素不超过max_pixels
+        width, height = Image.open(BytesIO(images[0])).size
+        target_width, target_height = self._scaled_size(width, height, rows * cols)
+        merged_image = Image.new('RGB', (target_width * cols, target_height * rows))
+        for idx, data in enumerate(images[:rows * cols]):
+            row, col = divmod(idx, cols)
+            merged_image.paste(self._load(data, (target_width, target_height)),
+                               (col * target_width, row * target_height))
+        return merged_image
+
+    def _encode(self, img: Image.Image) -> bytes:
+        buffered = BytesIO()
+        if self.image_format == 'PNG':
+            img.save(buffered, format='PNG', compress_level=self.png_compress_level)
+        else:
+            img.save(buffered, format='JPEG', quality=self.jpeg_quality)
+        return buffered.getvalue()
+
+    def prepare(self, images: List[bytes]) -> str:
+        """
+        把输入图片（多张时拼接为网格）缩放、编码为base64
+        :param images: 输入图片的二进制数据
+        :return: base64编码的图片数据
+        """
+        key = self._cache_key(images)
+        with self._lock:
+            encoded = self._cache.get(key)
+            if encoded is not None:
+                self._cache.move_to_end(key)
+                return encoded
+
+        img = self._compose(images)
+        encoded = base64.b64encode(self._encode(img)).decode('utf-8')
+        logger.info(f"Flux输入图片已编码: {len(images)}张, {img.size[0]}x{img.size[1]}, {len(encoded) / 1024:.0f}KB")
+
+        with self._lock:
+            self._cache[key] = encoded
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return encoded
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+# 创建全局Flux输入图片预处理实例
+flux_input_preparer = FluxInputPreparer(
+    max_pixels=getattr(settings, 'FLUX_INPUT_MAX_PIXELS', 1024 * 1024),
+    image_format=getattr(settings, 'FLUX_INPUT_FORMAT', 'JPEG'),
+    jpeg_quality=getattr(settings, 'FLUX_INPUT_JPEG_QUALITY', 90),
+    png_compress_level=getattr(settings, 'FLUX_INPUT_PNG_COMPRESS_LEVEL', 1),
+    cache_size=getattr(settings, 'FLUX_INPUT_CACHE_SIZE', 32),
+)
@@ -0,0 +1,133 @@
+"""
+Flux任务轮询调度模块
+所有进行中的Flux Kontext任务在同一个事件循环上轮询结果：每个任务按自适应退避（开始较快，之后逐渐放慢）查询，
+等待期间不占用线程，单个进程可以同时进行更多的Flux生成
+"""
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Dict, Optional
+
+import httpx
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class FluxPollingScheduler:
+    # 轮询结果中表示任务已结束但失败的状态
+    FAILED_STATUSES = ('Failed', 'Error', 'Content Moderated', 'Request Moderated')
+
+    def __init__(self, initial_interval: float = 0.5, max_interval: float = 5, backoff: float = 1.5,
+                 timeout: float = 150, request_timeout: float = 10, max_concurrent_requests: int = 50):
+        """
+        :param initial_interval: 首次轮询前的等待时间（秒）
+        :param max_interval: 轮询间隔上限（秒）
+        :param backoff: 每次轮询后间隔的放大倍数
+        :param timeout: 单个任务的最长等待时间（秒），超过后报轮询超时
+        :param request_timeout: 单次轮询请求的超时（秒）
+        :param max_concurrent_requests: 同时发出的轮询请求数上限
+        """
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timeout = timeout
+        self.request_timeout = request_timeout
+        self.max_concurrent_requests = max_concurrent_requests
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        # 以下对象只在事件循环线程中创建和使用
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.requests = 0
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        """首次提交任务时启动事件循环线程，每个进程只启动一次"""
+        if self._loop is not None:
+            return self._loop
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, daemon=True, name='flux-polling').start()
+                self._loop = loop
+        return self._loop
+
+    def watch(self, polling_url: str, timeout: Optional[float] = None) -> Future:
+        """
+        开始轮询任务结果，立即返回
+        :param polling_url: Flux API返回的轮询URL
+        :param timeout: 最长等待时间（秒），默认使用调度器配置
+        :return: Future，结果为状态为Ready的轮询响应；任务失败或超时时为ValueError
+        """
+        loop = self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(self._poll(polling_url, timeout or self.timeout), loop)
+
+    async def _fetch(self, polling_url: str) -> Optional[Dict]:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self.request_timeout,
+                limits=httpx.Limits(max_connections=self.max_concurrent_requests)
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+        async with self._semaphore:
+            self.requests += 1
+            response = await self._client.get(polling_url)
+        response.raise_for_status()
+        return response.json()
+
+    async def _poll(self, polling_url: str, timeout: float) -> Dict:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        interval = self.initial_interval
+        attempts = 0
+        self.pending += 1
+        try:
+            while True:
+                await asyncio.sleep(max(min(interval, deadline - loop.time()), 0))
+                attempts += 1
+                try:
+                    result = await self._fetch(polling_url)
+                except (httpx.HTTPError, ValueError) as e:
+                    logger.warning(f"Flux轮询请求异常: {str(e)}，重试中... (第{attempts}次)")
+                    result = None
+
+                if result:
+                    status = result.get('status')
+                    if status == 'Ready':
+                        self.completed += 1
+                        logger.info(f"Flux任务已完成，共轮询 {attempts} 次: {polling_url}")
+                        return result
+                    if status in self.FAILED_STATUSES:
+                        raise ValueError(f"任务处理失败: {result.get('details') or status}")
+
+                if loop.time() >= deadline:
+                    raise ValueError("轮询超时，请稍后重试")
+                interval = min(interval * self.backoff, self.max_interval)
+        except ValueError:
+            self.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+
+    def get_stats(self) -> Dict:
+        return {
+            'pending': self.pending,
+            'completed': self.completed,
+            'failed': self.failed,
+            'requests': self.requests,
+        }
+
+
+# 创建全局Flux轮询调度实例
+flux_polling_scheduler = FluxPollingScheduler(
+    initial_interval=getattr(settings, 'FLUX_POLL_INITIAL_INTERVAL', 0.5),
+    max_interval=getattr(settings, 'FLUX_POLL_MAX_INTERVAL', 5),
+    backoff=getattr(settings, 'FLUX_POLL_BACKOFF', 1.5),
+    timeout=getattr(settings, 'FLUX_POLL_TIMEOUT', 150),
+    max_concurrent_requests=getattr(settings, 'FLUX_POLL_MAX_CONCURRENT_REQUESTS', 50),
+)
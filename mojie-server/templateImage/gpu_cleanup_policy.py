@@ -0,0 +1,135 @@
+"""
+GPU资源清理策略模块
+不再在每个任务后提交空负载工作流，而是按服务器跟踪连续任务使用的模型集合：
+只有在累计执行N个任务、下一个工作流换用不同的模型、显存占用超过阈值或任务出错时才释放显存，
+其余情况保留ComfyUI的模型缓存供下一个任务复用
+"""
+import logging
+import threading
+from typing import Dict, FrozenSet, Optional
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# 视为模型文件的输入值后缀
+MODEL_FILE_SUFFIXES = ('.safetensors', '.ckpt', '.pt', '.pth', '.bin', '.gguf', '.onnx', '.sft')
+
+
+class GPUCleanupPolicy:
+    def __init__(self, server_address: str, every_n_tasks: int = 20, vram_threshold: float = 0.9,
+                 on_model_change: bool = True):
+        """
+        单个ComfyUI服务器的GPU清理策略
+        :param server_address: 服务器地址
+        :param every_n_tasks: 累计执行多少个任务后清理一次，0表示不按任务数清理
+        :param vram_threshold: 显存占用比例阈值，超过后清理，0表示不检查显存
+        :param on_model_change: 下一个工作流使用不同模型集合时是否先清理
+        """
+        self.server_address = server_address
+        self.every_n_tasks = every_n_tasks
+        self.vram_threshold = vram_threshold
+        self.on_model_change = on_model_change
+
+        self._lock = threading.Lock()
+        self.tasks_since_cleanup = 0
+        self.last_model_set: Optional[FrozenSet[str]] = None
+        self.cache_hits = 0  # 与上一个任务使用相同模型集合（模型缓存可复用）的次数
+        self.cache_misses = 0
+        self.cleanups = 0
+
+    @staticmethod
+    def model_set(prompt: Dict) -> FrozenSet[str]:
+        """提取工作流使用的模型文件集合"""
+        models = set()
+        for node in prompt.values():
+            if not isinstance(node, dict):
+                continue
+            for value in (node.get('inputs') or {}).values():
+                if isinstance(value, str) and value.lower().endswith(MODEL_FILE_SUFFIXES):
+                    models.add(value)
+        return frozenset(models)
+
+    def before_task(self, model_set: FrozenSet[str]) -> Optional[str]:
+        """
+        任务提交前调用，记录模型缓存命中情况
+        :return: 需要先清理时返回原因，否则返回None
+        """
+        with self._lock:
+            previous = self.last_model_set
+            self.last_model_set = model_set
+            if previous is None:
+                return None
+            if model_set == previous or not model_set:
+                self.cache_hits += 1
+                return None
+            self.cache_misses += 1
+            if self.on_model_change and self.tasks_since_cleanup > 0:
+                return f"模型集合变化（新增 {len(model_set - previous)} 个模型）"
+            return None
+
+    def after_task(self, success: bool = True, vram_usage: Optional[float] = None) -> Optional[str]:
+        """
+        任务结束后调用
+        :param success: 任务是否成功
+        :param vram_usage: 当前显存占用比例，未知时为None
+        :return: 需要清理时返回原因，否则返回None
+        """
+        with self._lock:
+            self.tasks_since_cleanup += 1
+            if not success:
+                return "任务执行出错"
+            if self.every_n_tasks and self.tasks_since_cleanup >= self.every_n_tasks:
+                return f"已连续执行 {self.tasks_since_cleanup} 个任务"
+            if self.vram_threshold and vram_usage is not None and vram_usage >= self.vram_threshold:
+                return f"显存占用 {vram_usage:.0%} 超过阈值 {self.vram_threshold:.0%}"
+            return None
+
+    def record_cleanup(self):
+        with self._lock:
+            self.tasks_since_cleanup = 0
+            self.cleanups += 1
+            # 清理后模型需要重新加载，下一个任务不计为缓存命中
+            self.last_model_set = None
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.cache_hits + self.cache_misses
+            return {
+                'server_address': self.server_address,
+                'tasks_since_cleanup': self.tasks_since_cleanup,
+                'cache_hits': self.cache_hits,
+                'cache_misses': self.cache_misses,
+                'cache_hit_rate': round(self.cache_hits / total, 4) if total else None,
+                'cleanups': self.cleanups,
+            }
+
+
+class GPUCleanupPolicyManager:
+    """按服务器管理清理策略，同一服务器上的所有helper共享GPU状态"""
+
+    def __init__(self):
+        self._policies: Dict[str, GPUCleanupPolicy] = {}
+        self._lock = threading.Lock()
+
+    def get(self, server_address: str) -> GPUCleanupPolicy:
+        with self._lock:
+            policy = self._policies.get(server_address)
+            if policy is None:
+                policy = GPUCleanupPolicy(
+                    server_address,
+                    every_n_tasks=getattr(settings, 'COMFYUI_GPU_CLEANUP_EVERY_N_TASKS', 20),
+                    vram_threshold=getattr(settings, 'COMFYUI_GPU_CLEANUP_VRAM_THRESHOLD', 0.9),
+                    on_model_change=getattr(settings, 'COMFYUI_GPU_CLEANUP_ON_MODEL_CHANGE', True),
+                )
+                self._policies[server_address] = policy
+            return policy
+
+    def stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            policies = list(self._policies.values())
+        return {policy.server_address: policy.stats() for policy in policies}
+
+
+# 创建全局GPU清理策略实例
+gpu_cleanup_policies = GPUCleanupPolicyManager()
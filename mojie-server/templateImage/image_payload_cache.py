@@ -0,0 +1,230 @@
+"""
+图像载荷缓存模块
+缓存按URL下载并转换为PNG后的图像数据：进程内LRU（按字节数限制）加本地磁盘缓存（按URL和ETag），
+会话历史中的图像在后续轮次中不再重复下载和重新编码；超过复验时间后用ETag发起条件请求确认未变化
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+from typing import Dict, Optional, Tuple
+
+from django.conf import settings
+from PIL import Image
+
+from common.http_session import get_shared_session
+
+logger = logging.getLogger(__name__)
+
+
+class ImagePayloadCache:
+    def __init__(self, cache_dir: str, memory_max_bytes: int = 128 * 1024 * 1024,
+                 disk_max_bytes: int = 1024 * 1024 * 1024, revalidate_after: float = 24 * 3600,
+                 timeout: float = 30):
+        """
+        :param cache_dir: 磁盘缓存目录，为空时只使用内存缓存
+        :param memory_max_bytes: 内存缓存的最大字节数
+        :param disk_max_bytes: 磁盘缓存的最大字节数，超过后删除最久未使用的文件
+        :param revalidate_after: 缓存超过该时间（秒）后用ETag向源站确认是否变化
+        :param timeout: 下载超时（秒）
+        """
+        self.cache_dir = cache_dir
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self.revalidate_after = revalidate_after
+        self.timeout = timeout
+
+        self._memory: "OrderedDict[str, Tuple[bytes, Optional[str], float]]" = OrderedDict()  # url -> (数据, ETag, 校验时间)
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._disk_writes = 0
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'revalidated': 0, 'downloads': 0}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    # ---- 内存 ----
+
+    def _memory_get(self, url: str) -> Optional[Tuple[bytes, Optional[str], float]]:
+        with self._lock:
+            entry = self._memory.get(url)
+            if entry is not None:
+                self._memory.move_to_end(url)
+            return entry
+
+    def _memory_put(self, url: str, payload: bytes, etag: Optional[str], checked_at: float):
+        if len(payload) > self.memory_max_bytes:
+            return
+        with self._lock:
+            previous = self._memory.pop(url, None)
+            if previous is not None:
+                self._memory_bytes -= len(previous[0])
+            self._memory[url] = (payload, etag, checked_at)
+            self._memory_bytes += len(payload)
+            while self._memory_bytes > self.memory_max_bytes and self._memory:
+                _, (evicted, _, _) = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    # ---- 磁盘 ----
+
+    def _disk_paths(self, url: str) -> Tuple[str, str]:
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        base = os.path.join(self.cache_dir, key[:2], key)
+        return f"{base}.png", f"{base}.json"
+
+    def _disk_get(self, url: str) -> Optional[Tuple[bytes, Optional[str], float]]:
+        if not self.cache_dir:
+            return None
+        data_path, meta_path = self._disk_paths(url)
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('url') != url:
+                return None
+            with open(data_path, 'rb') as f:
+                payload = f.read()
+            # 更新访问时间，清理时按最久未使用删除
+            os.utime(data_path, None)
+            return payload, meta.get('etag'), meta.get('checked_at', 0)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"读取图像磁盘缓存失败（{url}）: {str(e)}")
+            return None
+
+    def _disk_put(self, url: str, payload: bytes, etag: Optional[str], checked_at: float):
+        if not self.cache_dir:
+            return
+        data_path, meta_path = self._disk_paths(url)
+        try:
+            os.makedirs(os.path.dirname(data_path), exist_ok=True)
+            # 先写唯一命名的临时文件再替换，并发读取不会读到写了一半的文件，多个进程同时写入也不会互相覆盖
+            for path, content, mode in ((data_path, payload, 'wb'),
+                                        (meta_path, json.dumps({'url': url, 'etag': etag, 'checked_at': checked_at}), 'w')):
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+                try:
+                    with os.fdopen(fd, mode) as f:
+                        f.write(content)
+                    os.replace(tmp_path, path)
+                except BaseException:
+                    os.unlink(tmp_path)
+                    raise
+        except Exception as e:
+            logger.warning(f"写入图像磁盘缓存失败（{url}）: {str(e)}")
+            return
+
+        self._disk_writes += 1
+        if self._disk_writes % 50 == 0:
+            self._prune_disk()
+
+    def _prune_disk(self):
+        """磁盘缓存超过上限时删除最久未使用的文件，直到降到上限的90%"""
+        if not self._disk_lock.acquire(blocking=False):
+            return
+        try:
+            files = []
+            total = 0
+            for root, _, names in os.walk(self.cache_dir):
+                for name in names:
+                    if name.endswith('.png'):
+                        path = os.path.join(root, name)
+                        try:
+                            stat = os.stat(path)
+                        except FileNotFoundError:
+                            continue
+                        files.append((stat.st_mtime, stat.st_size, path))
+                        total += stat.st_size
+            if total <= self.disk_max_bytes:
+                return
+            for _, size, path in sorted(files):
+                for stale in (path, path[:-len('.png')] + '.json'):
+                    try:
+                        os.remove(stale)
+                    except FileNotFoundError:
+                        pass
+                total -= size
+                if total <= self.disk_max_bytes * 0.9:
+                    break
+            logger.info(f"图像磁盘缓存已清理，当前约 {total / 1024 / 1024:.0f}MB")
+        finally:
+            self._disk_lock.release()
+
+    # ---- 下载 ----
+
+    @staticmethod
+    def _to_png(content: bytes) -> bytes:
+        """验证图像格式并转换为PNG"""
+        img = Image.open(BytesIO(content))
+        if img.format != 'PNG':
+            buffered = BytesIO()
+            img.save(buffered, format="PNG")
+            return buffered.getvalue()
+        return content
+
+    def _fetch(self, url: str, etag: Optional[str]) -> Tuple[Optional[bytes], Optional[str]]:
+        """
+        下载图像，提供ETag时发起条件请求
+        :return: (PNG数据, ETag)，源站返回304时数据为None
+        """
+        headers = {'If-None-Match': etag} if etag else {}
+        response = get_shared_session('image_download').get(url, headers=headers, timeout=self.timeout)
+        if etag and response.status_code == 304:
+            return None, etag
+        response.raise_for_status()
+        self.stats['downloads'] += 1
+        return self._to_png(response.content), response.headers.get('ETag')
+
+    def get_png(self, url: str) -> bytes:
+        """获取URL对应图像的PNG数据，优先使用缓存"""
+        now = time.time()
+        entry = self._memory_get(url)
+        tier = 'memory_hits'
+        if entry is None:
+            entry = self._disk_get(url)
+            tier = 'disk_hits'
+            if entry is not None:
+                self._memory_put(url, *entry)
+
+        if entry is not None:
+            payload, etag, checked_at = entry
+            if now - checked_at < self.revalidate_after:
+                self.stats[tier] += 1
+                return payload
+            if etag:
+                try:
+                    fresh, new_etag = self._fetch(url, etag)
+                except Exception as e:
+                    # 源站暂时不可用时继续使用缓存
+                    logger.warning(f"图像缓存复验失败，继续使用缓存（{url}）: {str(e)}")
+                    return payload
+                if fresh is None:
+                    self.stats['revalidated'] += 1
+                    self._memory_put(url, payload, etag, now)
+                    self._disk_put(url, payload, etag, now)
+                    return payload
+                self._memory_put(url, fresh, new_etag, now)
+                self._disk_put(url, fresh, new_etag, now)
+                return fresh
+
+        payload, etag = self._fetch(url, None)
+        self._memory_put(url, payload, etag, now)
+        self._disk_put(url, payload, etag, now)
+        return payload
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {**self.stats, 'memory_entries': len(self._memory), 'memory_bytes': self._memory_bytes}
+
+
+# 创建全局图像载荷缓存实例
+image_payload_cache = ImagePayloadCache(
+    cache_dir=getattr(settings, 'IMAGE_PAYLOAD_CACHE_DIR', ''),
+    memory_max_bytes=getattr(settings, 'IMAGE_PAYLOAD_CACHE_MEMORY_MB', 128) * 1024 * 1024,
+    disk_max_bytes=getattr(settings, 'IMAGE_PAYLOAD_CACHE_DISK_MB', 1024) * 1024 * 1024,
+    revalidate_after=getattr(settings, 'IMAGE_PAYLOAD_CACHE_REVALIDATE', 24 * 3600),
+)
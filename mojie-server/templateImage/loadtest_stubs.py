@@ -0,0 +1,404 @@
+"""
+压测用的本地替身服务
+ComfyUIStubServer 模拟 ComfyUI 的 /prompt、/history、/view、/queue、/interrupt、/free、/system_stats 接口
+和 WebSocket 进度推送协议，执行耗时、失败率和输出大小可配置，无需GPU即可驱动完整的队列链路；
+LocalObjectStore 模拟 TOS 上传，按延迟和带宽计算耗时，对象保存在内存中
+"""
+import base64
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import socket
+import struct
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger(__name__)
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+OUTPUT_NODE_TYPES = ('SaveImage', 'PreviewImage')
+
+
+class LocalObjectStore:
+    """本地TOS替身：对象保存在内存中，按固定延迟加带宽模拟上传耗时"""
+
+    def __init__(self, latency_ms: float = 30, bandwidth_mbps: float = 100, keep_objects: bool = True):
+        self.latency = latency_ms / 1000
+        self.bytes_per_second = bandwidth_mbps * 1024 * 1024 / 8
+        self.keep_objects = keep_objects
+        self.objects = {}
+        self.bytes_received = 0
+        self.put_count = 0
+        self._lock = threading.Lock()
+
+    def put_object(self, bucket, key, content):
+        content = content.read() if hasattr(content, 'read') else bytes(content)
+        time.sleep(self.latency + len(content) / self.bytes_per_second)
+        with self._lock:
+            self.objects[key] = content if self.keep_objects else len(content)
+            self.bytes_received += len(content)
+            self.put_count += 1
+
+    def delete_object(self, bucket, key):
+        with self._lock:
+            self.objects.pop(key, None)
+
+    @staticmethod
+    def config() -> Dict:
+        """替换 VolcengineTOSUtils 共享配置时使用的配置"""
+        return {
+            'access_key_id': '', 'access_key_secret': '', 'endpoint': 'https://tos.local', 'region': 'local',
+            'bucket_name': 'loadtest', 'multipart_threshold': 1 << 40, 'part_size': 8 * 1024 * 1024,
+            'upload_concurrency': 1, 'part_retries': 0,
+        }
+
+
+class _WebSocketClient:
+    """服务端的WebSocket连接，只实现压测需要的文本帧、ping/pong和关闭帧"""
+
+    def __init__(self, sock: socket.socket, rfile):
+        self.sock = sock
+        self.rfile = rfile
+        self._send_lock = threading.Lock()
+        self.closed = False
+
+    def send_frame(self, opcode: int, payload: bytes = b''):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        with self._send_lock:
+            if self.closed:
+                return
+            try:
+                self.sock.sendall(header + payload)
+            except OSError:
+                self.closed = True
+
+    def send_json(self, message: Dict):
+        self.send_frame(0x1, json.dumps(message).encode('utf-8'))
+
+    def read_frame(self):
+        """读取一个客户端帧，返回 (opcode, payload)，连接关闭时返回 (None, b'')"""
+        header = self.rfile.read(2)
+        if len(header) < 2:
+            return None, b''
+        opcode = header[0] & 0x0f
+        length = header[1] & 0x7f
+        if length == 126:
+            length = struct.unpack('!H', self.rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self.rfile.read(8))[0]
+        mask = self.rfile.read(4) if header[1] & 0x80 else None
+        payload = self.rfile.read(length)
+        if mask:
+            payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+        return opcode, payload
+
+
+class ComfyUIStubServer:
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, exec_time: float = 2.0, jitter: float = 0.2,
+                 failure_rate: float = 0.0, output_kb: int = 512, outputs_per_prompt: int = 1,
+                 progress_steps: int = 10, http_latency_ms: float = 0, max_files: int = 2000):
+        """
+        ComfyUI替身服务器，按提交顺序串行执行（与单GPU的ComfyUI一致）
+        :param host: 监听地址
+        :param port: 监听端口，0表示随机端口
+        :param exec_time: 每个prompt的平均执行时间（秒）
+        :param jitter: 执行时间的随机波动比例
+        :param failure_rate: 执行失败（execution_error）的概率
+        :param output_kb: 每张输出图像的大小（KB）
+        :param outputs_per_prompt: 每个输出节点生成的图像数
+        :param progress_steps: 每个prompt推送的progress消息数
+        :param http_latency_ms: 每个HTTP请求额外增加的延迟（毫秒）
+        :param max_files: 保留的输出文件数量上限，超过后淘汰最早的文件
+        """
+        self.exec_time = exec_time
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.output_size = output_kb * 1024
+        self.outputs_per_prompt = outputs_per_prompt
+        self.progress_steps = max(progress_steps, 1)
+        self.http_latency = http_latency_ms / 1000
+        self.max_files = max_files
+
+        self._queue = queue.Queue()
+        self._pending: List[str] = []
+        self._running_prompt: Optional[str] = None
+        self._interrupted = threading.Event()
+        self._lock = threading.Lock()
+        self._clients: Dict[str, _WebSocketClient] = {}
+        self._history: Dict[str, Dict] = {}
+        self._files: OrderedDict = OrderedDict()
+        self._prompt_number = 0
+        self.stats = {'prompts': 0, 'completed': 0, 'failed': 0, 'interrupted': 0, 'views': 0, 'http_requests': 0}
+
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._threads: List[threading.Thread] = []
+
+    @property
+    def address(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"{host}:{port}"
+
+    def start(self) -> 'ComfyUIStubServer':
+        for target in (self._httpd.serve_forever, self._worker):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"ComfyUI替身服务已启动: {self.address}")
+        return self
+
+    def serve_forever(self):
+        threading.Thread(target=self._worker, daemon=True).start()
+        logger.info(f"ComfyUI替身服务已启动: {self.address}")
+        self._httpd.serve_forever()
+
+    def stop(self):
+        self._queue.put(None)
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    # ---- 执行 ----
+
+    def _send(self, client_id: Optional[str], message: Dict):
+        with self._lock:
+            targets = [self._clients.get(client_id)] if client_id else list(self._clients.values())
+        for client in targets:
+            if client:
+                client.send_json(message)
+
+    def _queue_status(self) -> Dict:
+        with self._lock:
+            remaining = len(self._pending) + (1 if self._running_prompt else 0)
+        return {'type': 'status', 'data': {'status': {'exec_info': {'queue_remaining': remaining}}}}
+
+    @staticmethod
+    def _ordered_nodes(prompt: Dict) -> List[str]:
+        return sorted(prompt.keys(), key=lambda node_id: (len(node_id), node_id))
+
+    def _store_file(self, filename: str, size: int):
+        with self._lock:
+            self._files[filename] = PNG_SIGNATURE + os.urandom(max(size - len(PNG_SIGNATURE), 0))
+            while len(self._files) > self.max_files:
+                self._files.popitem(last=False)
+
+    def _execute(self, prompt_id: str, prompt: Dict, client_id: str):
+        nodes = self._ordered_nodes(prompt)
+        output_nodes = [node_id for node_id in nodes
+                        if isinstance(prompt[node_id], dict) and prompt[node_id].get('class_type') in OUTPUT_NODE_TYPES]
+        output_nodes = output_nodes or nodes[-1:]
+        duration = self.exec_time * (1 + random.uniform(-self.jitter, self.jitter))
+        fail_at = random.choice(nodes) if nodes and random.random() < self.failure_rate else None
+
+        self._send(client_id, {'type': 'execution_start', 'data': {'prompt_id': prompt_id, 'timestamp': int(time.time() * 1000)}})
+        self._send(client_id, {'type': 'execution_cached', 'data': {'nodes': [], 'prompt_id': prompt_id}})
+        outputs = {}
+        # 执行时间集中在第一个非输出节点（相当于采样器），其余节点瞬间完成
+        work_node = next((node_id for node_id in nodes if node_id not in output_nodes), nodes[0] if nodes else None)
+        for node_id in nodes:
+            self._send(client_id, {'type': 'executing', 'data': {'node': node_id, 'display_node': node_id, 'prompt_id': prompt_id}})
+            if node_id == work_node:
+                for step in range(1, self.progress_steps + 1):
+                    if self._interrupted.wait(duration / self.progress_steps):
+                        self._interrupted.clear()
+                        self.stats['interrupted'] += 1
+                        self._send(client_id, {'type': 'execution_interrupted', 'data': {
+                            'prompt_id': prompt_id, 'node_id': node_id, 'node_type': 'KSampler', 'executed': []}})
+                        self._history[prompt_id] = {'prompt': [], 'outputs': {}, 'status': {
+                            'status_str': 'error', 'completed': False, 'messages': []}}
+                        return
+                    self._send(client_id, {'type': 'progress', 'data': {
+                        'value': step, 'max': self.progress_steps, 'prompt_id': prompt_id, 'node': node_id}})
+            if node_id == fail_at:
+                self.stats['failed'] += 1
+                self._send(client_id, {'type': 'execution_error', 'data': {
+                    'prompt_id': prompt_id, 'node_id': node_id, 'node_type': 'Stub',
+                    'exception_message': '模拟的执行失败', 'exception_type': 'RuntimeError', 'traceback': []}})
+                self._history[prompt_id] = {'prompt': [], 'outputs': {}, 'status': {
+                    'status_str': 'error', 'completed': False, 'messages': []}}
+                return
+            if node_id in output_nodes:
+                images = []
+                for index in range(self.outputs_per_prompt):
+                    filename = f"stub_{prompt_id}_{node_id}_{index}.png"
+                    self._store_file(filename, self.output_size)
+                    images.append({'filename': filename, 'subfolder': '', 'type': 'output'})
+                outputs[node_id] = {'images': images}
+                self._send(client_id, {'type': 'executed', 'data': {
+                    'node': node_id, 'display_node': node_id, 'output': {'images': images}, 'prompt_id': prompt_id}})
+
+        self._history[prompt_id] = {'prompt': [], 'outputs': outputs, 'status': {
+            'status_str': 'success', 'completed': True, 'messages': []}}
+        self.stats['completed'] += 1
+        self._send(client_id, {'type': 'executing', 'data': {'node': None, 'prompt_id': prompt_id}})
+        self._send(client_id, {'type': 'execution_success', 'data': {'prompt_id': prompt_id}})
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            prompt_id, prompt, client_id = item
+            with self._lock:
+                if prompt_id not in self._pending:
+                    # 已从队列中删除
+                    continue
+                self._pending.remove(prompt_id)
+                self._running_prompt = prompt_id
+            self._interrupted.clear()
+            try:
+                self._execute(prompt_id, prompt, client_id)
+            except Exception as e:
+                logger.error(f"替身服务执行prompt {prompt_id} 出错: {str(e)}")
+            finally:
+                with self._lock:
+                    self._running_prompt = None
+                self._send(None, self._queue_status())
+
+    # ---- HTTP / WebSocket ----
+
+    def _submit(self, body: Dict) -> Dict:
+        prompt = body.get('prompt')
+        if not isinstance(prompt, dict) or not prompt:
+            raise ValueError('prompt必须是非空的API格式工作流')
+        prompt_id = str(uuid.uuid4())
+        with self._lock:
+            self._prompt_number += 1
+            number = self._prompt_number
+            self._pending.append(prompt_id)
+        self.stats['prompts'] += 1
+        self._queue.put((prompt_id, prompt, body.get('client_id')))
+        self._send(None, self._queue_status())
+        return {'prompt_id': prompt_id, 'number': number, 'node_errors': {}}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                logger.debug(f"ComfyUI替身服务: {format % args}")
+
+            def _reply(self, status: int, body, content_type: str = 'application/json'):
+                if server.http_latency:
+                    time.sleep(server.http_latency)
+                data = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _read_json(self) -> Dict:
+                length = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(length) or b'{}') if length else {}
+
+            def do_GET(self):
+                server.stats['http_requests'] += 1
+                url = urlparse(self.path)
+                params = {key: values[0] for key, values in parse_qs(url.query).items()}
+                if url.path == '/ws':
+                    return self._websocket(params.get('clientId') or str(uuid.uuid4()))
+                if url.path == '/view':
+                    data = server._files.get(params.get('filename', ''))
+                    if data is None:
+                        return self._reply(404, {'error': 'file not found'})
+                    server.stats['views'] += 1
+                    return self._reply(200, data, 'image/png')
+                if url.path.startswith('/history'):
+                    prompt_id = url.path[len('/history/'):] if url.path.startswith('/history/') else None
+                    if prompt_id:
+                        history = server._history.get(prompt_id)
+                        return self._reply(200, {prompt_id: history} if history else {})
+                    return self._reply(200, dict(server._history))
+                if url.path == '/queue':
+                    with server._lock:
+                        running = [[0, server._running_prompt, {}, {}, []]] if server._running_prompt else []
+                        pending = [[index + 1, prompt_id, {}, {}, []] for index, prompt_id in enumerate(server._pending)]
+                    return self._reply(200, {'queue_running': running, 'queue_pending': pending})
+                if url.path == '/system_stats':
+                    return self._reply(200, {
+                        'system': {'os': 'stub', 'python_version': '', 'embedded_python': False},
+                        'devices': [{'name': 'stub', 'type': 'cuda', 'index': 0, 'vram_total': 24 * 1024 ** 3,
+                                     'vram_free': 16 * 1024 ** 3, 'torch_vram_total': 0, 'torch_vram_free': 0}],
+                    })
+                return self._reply(404, {'error': 'not found'})
+
+            def do_POST(self):
+                server.stats['http_requests'] += 1
+                url = urlparse(self.path)
+                try:
+                    body = self._read_json()
+                except ValueError:
+                    return self._reply(400, {'error': 'invalid json'})
+                if url.path == '/prompt':
+                    try:
+                        return self._reply(200, server._submit(body))
+                    except ValueError as e:
+                        return self._reply(400, {'error': {'type': 'invalid_prompt', 'message': str(e)}, 'node_errors': {}})
+                if url.path == '/interrupt':
+                    prompt_id = body.get('prompt_id')
+                    if server._running_prompt and (not prompt_id or prompt_id == server._running_prompt):
+                        server._interrupted.set()
+                    return self._reply(200, {})
+                if url.path == '/queue':
+                    with server._lock:
+                        for prompt_id in body.get('delete', []):
+                            if prompt_id in server._pending:
+                                server._pending.remove(prompt_id)
+                        if body.get('clear'):
+                            server._pending.clear()
+                    return self._reply(200, {})
+                if url.path == '/free':
+                    return self._reply(200, {})
+                return self._reply(404, {'error': 'not found'})
+
+            def _websocket(self, client_id: str):
+                key = self.headers.get('Sec-WebSocket-Key')
+                if not key:
+                    return self._reply(400, {'error': 'websocket upgrade required'})
+                accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+                self.send_response(101)
+                self.send_header('Upgrade', 'websocket')
+                self.send_header('Connection', 'Upgrade')
+                self.send_header('Sec-WebSocket-Accept', accept)
+                self.end_headers()
+                self.wfile.flush()
+
+                client = _WebSocketClient(self.connection, self.rfile)
+                with server._lock:
+                    server._clients[client_id] = client
+                client.send_json({'type': 'status', 'data': {**server._queue_status()['data'], 'sid': client_id}})
+                try:
+                    while True:
+                        opcode, payload = client.read_frame()
+                        if opcode is None or opcode == 0x8:
+                            client.send_frame(0x8)
+                            break
+                        if opcode == 0x9:
+                            client.send_frame(0xA, payload)
+                except (OSError, struct.error):
+                    pass
+                finally:
+                    client.closed = True
+                    with server._lock:
+                        if server._clients.get(client_id) is client:
+                            del server._clients[client_id]
+                    self.close_connection = True
+
+        return Handler
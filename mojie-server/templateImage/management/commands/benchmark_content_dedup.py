@@ -0,0 +1,63 @@
+import os
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from common.volcengine_tos_utils import VolcengineTOSUtils
+from templateImage.content_index import content_hash_index
+from templateImage.loadtest_stubs import LocalObjectStore
+
+
+class Command(BaseCommand):
+    help = '在本地TOS替身上对比开启/关闭内容去重时的上传流量和耗时'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--uploads', type=int, default=100, help='上传次数，默认100次')
+        parser.add_argument('--distinct', type=int, default=20, help='不同内容的数量，默认20个')
+        parser.add_argument('--size-kb', type=int, default=1024, help='每个内容的大小（KB），默认1024')
+        parser.add_argument('--latency-ms', type=float, default=30, help='模拟的单次请求延迟（毫秒），默认30')
+        parser.add_argument('--bandwidth-mbps', type=float, default=100, help='模拟的上行带宽（Mbps），默认100')
+
+    def _run(self, store: LocalObjectStore, payloads, folder: str, dedup: bool):
+        tos_utils = VolcengineTOSUtils()
+        start = time.perf_counter()
+        urls = [
+            tos_utils.upload_image(f"{folder}/{uuid.uuid4()}.png", file_data=payload, dedup=dedup)
+            for payload in payloads
+        ]
+        elapsed = time.perf_counter() - start
+        if not all(urls):
+            raise RuntimeError("存在上传失败的对象")
+        return elapsed, store.bytes_received, store.put_count
+
+    def handle(self, *args, **options):
+        distinct = [os.urandom(options['size_kb'] * 1024) for _ in range(options['distinct'])]
+        payloads = [distinct[i % len(distinct)] for i in range(options['uploads'])]
+        folder = f"benchmark-dedup-{uuid.uuid4().hex[:8]}"
+
+        shared_config, shared_client = VolcengineTOSUtils._shared_config, VolcengineTOSUtils._shared_client
+        results = {}
+        try:
+            for label, dedup in (('关闭去重', False), ('开启去重', True)):
+                store = LocalObjectStore(options['latency_ms'], options['bandwidth_mbps'])
+                VolcengineTOSUtils._shared_client = store
+                VolcengineTOSUtils._shared_config = store.config()
+                results[label] = self._run(store, payloads, f"{folder}-{int(dedup)}", dedup)
+                if dedup:
+                    for key in list(store.objects):
+                        content_hash_index.forget_object(key)
+        finally:
+            VolcengineTOSUtils._shared_config, VolcengineTOSUtils._shared_client = shared_config, shared_client
+
+        self.stdout.write(f"{'模式':<10}{'耗时(s)':>10}{'上传次数':>10}{'上传流量(MB)':>14}")
+        for label, (elapsed, sent, puts) in results.items():
+            self.stdout.write(f"{label:<10}{elapsed:>10.2f}{puts:>10}{sent / 1024 / 1024:>14.1f}")
+
+        base_time, base_bytes, _ = results['关闭去重']
+        dedup_time, dedup_bytes, _ = results['开启去重']
+        self.stdout.write(self.style.SUCCESS(
+            f"节省流量 {(base_bytes - dedup_bytes) / 1024 / 1024:.1f}MB "
+            f"({(1 - dedup_bytes / base_bytes) * 100:.0f}%)，"
+            f"节省耗时 {base_time - dedup_time:.2f}s ({(1 - dedup_time / base_time) * 100:.0f}%)"
+        ))
@@ -0,0 +1,96 @@
+import base64
+import statistics
+import time
+from io import BytesIO
+
+from django.core.management.base import BaseCommand
+from PIL import Image
+
+from templateImage.flux_input import FluxInputPreparer
+
+
+def legacy_prepare(images):
+    """原实现：全分辨率LANCZOS缩放、拼接后编码为PNG"""
+    if len(images) == 1:
+        img = Image.open(BytesIO(images[0])).convert('RGB')
+        img_byte_arr = BytesIO()
+        img.save(img_byte_arr, format='PNG')
+        return base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
+
+    decoded = [Image.open(BytesIO(data)).convert('RGB') for data in images]
+    rows, cols = FluxInputPreparer.grid_shape(len(decoded))
+    target_width, target_height = decoded[0].size
+    merged_image = Image.new('RGB', (target_width * cols, target_height * rows))
+    for idx, img in enumerate(decoded):
+        if idx >= rows * cols:
+            break
+        img = img.resize((target_width, target_height), Image.Resampling.LANCZOS)
+        row, col = divmod(idx, cols)
+        merged_image.paste(img, (col * target_width, row * target_height))
+    img_byte_arr = BytesIO()
+    merged_image.save(img_byte_arr, format='PNG')
+    return base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
+
+
+class Command(BaseCommand):
+    help = '对比Flux输入图片的原处理方式与缩放后编码（含缓存）的耗时和payload大小'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', type=int, default=4, help='每次请求的输入图片数，默认4张')
+        parser.add_argument('--width', type=int, default=2048, help='输入图片宽度，默认2048')
+        parser.add_argument('--height', type=int, default=2048, help='输入图片高度，默认2048')
+        parser.add_argument('--rounds', type=int, default=5, help='每种方式的测试轮数，默认5轮')
+        parser.add_argument('--format', default='JPEG', help='新方式的编码格式（JPEG/PNG），默认JPEG')
+
+    @staticmethod
+    def _make_images(count, width, height):
+        """生成带渐变和噪声的JPEG图片，接近用户上传照片的压缩特性"""
+        images = []
+        for i in range(count):
+            gradient = Image.linear_gradient('L').resize((width, height)).rotate(i * 37)
+            noise = Image.effect_noise((width, height), 40 + i * 5)
+            img = Image.merge('RGB', (gradient, Image.blend(gradient, noise, 0.4), noise))
+            buffered = BytesIO()
+            img.save(buffered, format='JPEG', quality=95)
+            images.append(buffered.getvalue())
+        return images
+
+    @staticmethod
+    def _measure(fn, images, rounds):
+        timings = []
+        payload = ''
+        for _ in range(rounds):
+            start = time.perf_counter()
+            payload = fn(images)
+            timings.append(time.perf_counter() - start)
+        return statistics.mean(timings) * 1000, len(payload)
+
+    def handle(self, *args, **options):
+        images = self._make_images(options['images'], options['width'], options['height'])
+        rounds = options['rounds']
+        self.stdout.write(
+            f"输入: {options['images']}张 {options['width']}x{options['height']} JPEG，"
+            f"共 {sum(len(data) for data in images) / 1024 / 1024:.1f}MB，每种方式 {rounds} 轮"
+        )
+
+        preparer = FluxInputPreparer(image_format=options['format'])
+
+        def prepare_cold(data):
+            preparer.clear()
+            return preparer.prepare(data)
+
+        results = {
+            '原实现': self._measure(legacy_prepare, images, rounds),
+            '缩放后编码': self._measure(prepare_cold, images, rounds),
+            '缓存命中': self._measure(preparer.prepare, images, rounds),
+        }
+
+        self.stdout.write(f"{'方式':<10}{'平均耗时(ms)':>14}{'payload(KB)':>14}")
+        for label, (elapsed_ms, size) in results.items():
+            self.stdout.write(f"{label:<10}{elapsed_ms:>14.1f}{size / 1024:>14.0f}")
+
+        base_ms, base_size = results['原实现']
+        new_ms, new_size = results['缩放后编码']
+        self.stdout.write(self.style.SUCCESS(
+            f"耗时减少 {(1 - new_ms / base_ms) * 100:.0f}%，payload减少 {(1 - new_size / base_size) * 100:.0f}%"
+        ))
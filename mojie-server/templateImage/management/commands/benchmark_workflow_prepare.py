@@ -0,0 +1,121 @@
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from templateImage.workflowUtils import ComfyUIHelper
+from templateImage.workflow_cache import WorkflowTemplateCache
+
+
+class Command(BaseCommand):
+    help = '对比工作流提示词准备耗时：逐次读取解析文件 vs 模板缓存和预编译补丁计划'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workflow',
+            type=str,
+            action='append',
+            help='指定工作流文件（可多次指定），默认测试comfyui目录下的所有工作流',
+        )
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=200,
+            help='每个工作流的测试次数，默认200次',
+        )
+        parser.add_argument(
+            '--nodes',
+            type=int,
+            default=6,
+            help='每次更新的节点数，默认6个（与ImageService中的典型更新一致）',
+        )
+
+    def _default_workflows(self):
+        project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+        comfyui_dir = os.path.join(project_root, 'comfyui')
+        return sorted(
+            os.path.join(comfyui_dir, name) for name in os.listdir(comfyui_dir) if name.endswith('.json')
+        )
+
+    @staticmethod
+    def _sample_updates(workflow: dict, node_count: int) -> dict:
+        """选取前几个带标量输入的节点，构造与实际任务结构相同的参数更新"""
+        prompt_updates = {}
+        for node_id, node in workflow.items():
+            if not isinstance(node, dict):
+                continue
+            scalar_inputs = {key: value for key, value in (node.get('inputs') or {}).items()
+                             if isinstance(value, (str, int, float))}
+            if scalar_inputs:
+                key = next(iter(scalar_inputs))
+                prompt_updates[node_id] = {'inputs': {key: scalar_inputs[key]}}
+            if len(prompt_updates) >= node_count:
+                break
+        return prompt_updates
+
+    @staticmethod
+    def _legacy_prepare(workflow_file: str, prompt_updates: dict) -> dict:
+        """原实现：每次探测候选路径、读取并解析文件，再逐节点更新"""
+        for path in ComfyUIHelper._workflow_candidate_paths(workflow_file):
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as f:
+                    workflow = json.loads(f.read())
+                break
+        else:
+            raise FileNotFoundError(workflow_file)
+        for node_id, updates in prompt_updates.items():
+            if node_id in workflow:
+                workflow[node_id]["inputs"].update(updates["inputs"])
+        return workflow
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        workflows = options['workflow'] or self._default_workflows()
+        cache = WorkflowTemplateCache()
+
+        total_legacy = 0.0
+        total_cached = 0.0
+        measured = 0
+        self.stdout.write(f"{'工作流':<60}{'节点数':>8}{'原实现(ms)':>14}{'缓存(ms)':>12}{'加速':>10}")
+        for workflow_file in workflows:
+            try:
+                path = cache.resolve_path(workflow_file,
+                                          lambda: ComfyUIHelper._workflow_candidate_paths(workflow_file))
+                prompt_updates = self._sample_updates(cache.load(path), options['nodes'])
+                if not prompt_updates:
+                    raise ValueError("不是API格式的工作流")
+            except Exception as e:
+                self.stdout.write(self.style.WARNING(f"跳过 {workflow_file}: {str(e)}"))
+                continue
+
+            # 两种实现的结果必须一致
+            legacy_prompt = self._legacy_prepare(workflow_file, prompt_updates)
+            if json.dumps(legacy_prompt, sort_keys=True) != json.dumps(cache.build_prompt(path, prompt_updates),
+                                                                      sort_keys=True):
+                self.stdout.write(self.style.ERROR(f"{workflow_file}: 缓存构建的提示词与原实现不一致"))
+                continue
+
+            start = time.perf_counter()
+            for _ in range(iterations):
+                self._legacy_prepare(workflow_file, prompt_updates)
+            legacy_ms = (time.perf_counter() - start) * 1000 / iterations
+
+            start = time.perf_counter()
+            for _ in range(iterations):
+                cache.build_prompt(path, prompt_updates)
+            cached_ms = (time.perf_counter() - start) * 1000 / iterations
+
+            total_legacy += legacy_ms
+            total_cached += cached_ms
+            measured += 1
+            self.stdout.write(
+                f"{os.path.basename(path):<60}{len(legacy_prompt):>8}{legacy_ms:>14.3f}{cached_ms:>12.4f}"
+                f"{legacy_ms / cached_ms if cached_ms else 0:>9.0f}x"
+            )
+
+        if total_cached:
+            self.stdout.write(self.style.SUCCESS(
+                f"每个任务平均准备耗时: 原实现 {total_legacy / measured:.3f}ms, "
+                f"缓存 {total_cached / measured:.4f}ms, 加速 {total_legacy / total_cached:.0f}x"
+            ))
@@ -0,0 +1,316 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import redis
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from common.volcengine_tos_utils import VolcengineTOSUtils
+from exception.business_exception import BusinessException
+from templateImage.loadtest_stubs import ComfyUIStubServer, LocalObjectStore
+from templateImage.models import ComfyUITask
+from templateImage.task_events import task_event_bus
+
+TERMINAL_STATUSES = ('completed', 'failed', 'cancelled')
+
+# 压测使用的最小工作流：加载模型 -> 文本编码 -> 采样 -> 保存图像
+LOADTEST_WORKFLOW = {
+    "3": {"class_type": "KSampler", "inputs": {"seed": 0, "steps": 20, "model": ["4", 0], "positive": ["6", 0]}},
+    "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "loadtest.safetensors"}},
+    "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "", "clip": ["4", 1]}},
+    "9": {"class_type": "SaveImage", "inputs": {"images": ["3", 0], "filename_prefix": "loadtest"}},
+}
+
+
+class QueryCounter:
+    """统计各线程执行的SQL数量（按语句类型），压测自身的轮询查询不计入"""
+
+    def __init__(self):
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __call__(self, execute, sql, params, many, context):
+        if not getattr(self._local, 'suspended', False):
+            verb = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else 'UNKNOWN'
+            with self._lock:
+                self.counts[verb] += 1
+        return execute(sql, params, many, context)
+
+    @contextmanager
+    def suspended(self):
+        self._local.suspended = True
+        try:
+            yield
+        finally:
+            self._local.suspended = False
+
+    def install(self):
+        # 已有连接（当前线程）直接挂载，之后各线程新建的连接通过信号挂载
+        for connection in connections.all():
+            connection.execute_wrappers.append(self)
+        connection_created.connect(self._on_connection_created)
+
+    def uninstall(self):
+        connection_created.disconnect(self._on_connection_created)
+        for connection in connections.all():
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+    def _on_connection_created(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+class ProgressEventCounter:
+    """订阅任务进度频道，统计各任务收到的进度事件数，用于核对进度是否推送到推送接口"""
+
+    def __init__(self, client):
+        self.counts = Counter()
+        self._pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self._thread = None
+
+    def start(self):
+        self._pubsub.subscribe(task_event_bus.PROGRESS_CHANNEL)
+        self._thread = threading.Thread(target=self._listen, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        try:
+            self._pubsub.unsubscribe()
+            self._pubsub.close()
+        except Exception:
+            pass
+
+    def _listen(self):
+        try:
+            for message in self._pubsub.listen():
+                if message.get('type') != 'message':
+                    continue
+                try:
+                    self.counts[json.loads(message['data']).get('task_id')] += 1
+                except (TypeError, ValueError):
+                    continue
+        except Exception:
+            # 停止时关闭连接会中断listen
+            pass
+
+
+def percentile(values, pct):
+    """最近秩法计算百分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+class Command(BaseCommand):
+    help = ('端到端压测ComfyUI任务队列：通过TaskUtils.create_async_task提交任务，经QueueService和ComfyUIConsumer'
+            '发送到ComfyUI替身服务，统计吞吐量、排队等待、端到端延迟分位数以及Redis/MySQL操作次数')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tasks', type=int, default=50, help='提交的任务数，默认50')
+        parser.add_argument('--rate', type=float, default=0, help='每秒提交的任务数，0表示一次性全部提交，默认0')
+        parser.add_argument('--priority', type=str, default='medium', help='任务优先级（low/medium/high），默认medium')
+        parser.add_argument('--server', type=str, action='append',
+                            help='使用已运行的ComfyUI（或替身服务）地址，可多次指定；不指定时在进程内启动替身服务')
+        parser.add_argument('--backends', type=int, default=1, help='进程内启动的替身服务数量，默认1')
+        parser.add_argument('--backend-concurrency', type=int, default=None,
+                            help='每个后端同时处理的任务数，默认使用COMFYUI_BACKEND_MAX_CONCURRENCY')
+        parser.add_argument('--exec-time', type=float, default=2.0, help='替身服务每个工作流的平均执行时间（秒），默认2')
+        parser.add_argument('--jitter', type=float, default=0.2, help='执行时间的随机波动比例，默认0.2')
+        parser.add_argument('--failure-rate', type=float, default=0.0, help='替身服务执行失败的概率，默认0')
+        parser.add_argument('--output-kb', type=int, default=512, help='每张输出图像的大小（KB），默认512')
+        parser.add_argument('--outputs', type=int, default=1, help='每个任务输出的图像数，默认1')
+        parser.add_argument('--http-latency-ms', type=float, default=0, help='替身服务每个HTTP请求的额外延迟（毫秒），默认0')
+        parser.add_argument('--upload-latency-ms', type=float, default=30, help='本地TOS替身的单次上传延迟（毫秒），默认30')
+        parser.add_argument('--upload-bandwidth-mbps', type=float, default=100, help='本地TOS替身的上行带宽（Mbps），默认100')
+        parser.add_argument('--real-tos', action='store_true', help='上传到真实的TOS，而不是本地替身')
+        parser.add_argument('--timeout', type=float, default=600, help='等待所有任务结束的最长时间（秒），默认600')
+        parser.add_argument('--poll-interval', type=float, default=0.5, help='检查任务状态的间隔（秒），默认0.5')
+        parser.add_argument('--keep-tasks', action='store_true', help='保留压测产生的任务记录，默认结束后删除')
+
+    def _redis_command_calls(self, client) -> Counter:
+        try:
+            return Counter({name[len('cmdstat_'):]: stats.get('calls', 0)
+                            for name, stats in client.info('commandstats').items()})
+        except Exception as e:
+            self.stderr.write(f"读取Redis命令统计失败: {str(e)}")
+            return Counter()
+
+    def _ensure_consumer(self, server_address: str, workflow_file: str):
+        """管理命令中后台服务通常未启动，此时按apps中的方式创建消费者"""
+        from templateImage.comfyUI_consumer import ComfyUIConsumer
+        from templateImage.queue_service_singleton import queue_service, initialize_queue_service
+
+        consumer = queue_service.get_consumer()
+        if consumer is None:
+            output_dir = getattr(settings, 'COMFYUI_OUTPUT_DIR', 'output')
+            os.makedirs(output_dir, exist_ok=True)
+            consumer = ComfyUIConsumer(comfyui_url=server_address, workflow_file=workflow_file, output_dir=output_dir)
+            queue_service.set_consumer(consumer)
+            initialize_queue_service()
+        return consumer
+
+    def _submit(self, count: int, rate: float, priority: str, task_data_factory):
+        from templateImage.task_utils import TaskUtils
+
+        task_ids, rejected = [], 0
+        start = time.perf_counter()
+        for index in range(count):
+            if rate > 0:
+                delay = start + index / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            try:
+                task_ids.append(TaskUtils.create_async_task('loadtest', task_data_factory(index), priority=priority)['task_id'])
+            except BusinessException as e:
+                rejected += 1
+                self.stderr.write(f"任务 {index} 被拒绝: {e}")
+        return task_ids, rejected
+
+    def _wait(self, task_ids, counter: QueryCounter, timeout: float, poll_interval: float) -> int:
+        deadline = time.time() + timeout
+        finished = 0
+        while time.time() < deadline:
+            with counter.suspended():
+                finished = ComfyUITask.objects.filter(task_id__in=task_ids, status__in=TERMINAL_STATUSES).count()
+            if finished >= len(task_ids):
+                break
+            time.sleep(poll_interval)
+        return finished
+
+    def handle(self, *args, **options):
+        stubs = []
+        servers = options['server']
+        if not servers:
+            for _ in range(max(options['backends'], 1)):
+                stubs.append(ComfyUIStubServer(
+                    exec_time=options['exec_time'],
+                    jitter=options['jitter'],
+                    failure_rate=options['failure_rate'],
+                    output_kb=options['output_kb'],
+                    outputs_per_prompt=options['outputs'],
+                    http_latency_ms=options['http_latency_ms'],
+                ).start())
+            servers = [stub.address for stub in stubs]
+
+        saved_settings = {name: getattr(settings, name, None)
+                          for name in ('COMFYUI_BACKENDS', 'COMFYUI_BACKEND_MAX_CONCURRENCY')}
+        if len(servers) > 1:
+            settings.COMFYUI_BACKENDS = servers
+        if options['backend_concurrency']:
+            settings.COMFYUI_BACKEND_MAX_CONCURRENCY = options['backend_concurrency']
+
+        with tempfile.NamedTemporaryFile('w', suffix='.json', prefix='loadtest_', delete=False) as f:
+            json.dump(LOADTEST_WORKFLOW, f)
+            workflow_file = f.name
+
+        store = None
+        shared_config, shared_client = VolcengineTOSUtils._shared_config, VolcengineTOSUtils._shared_client
+        if not options['real_tos']:
+            store = LocalObjectStore(options['upload_latency_ms'], options['upload_bandwidth_mbps'], keep_objects=False)
+            VolcengineTOSUtils._shared_config, VolcengineTOSUtils._shared_client = store.config(), store
+
+        consumer = self._ensure_consumer(servers[0], workflow_file)
+        saved_tos_utils = consumer.tos_utils
+        consumer.tos_utils = VolcengineTOSUtils()
+
+        def task_data_factory(index):
+            return {
+                'server_address': servers[0],
+                'workflow_file': workflow_file,
+                'prompt_updates': {
+                    '6': {'inputs': {'text': f'loadtest {index}'}},
+                    '3': {'inputs': {'seed': index}},
+                },
+                'target_node_id': '9',
+            }
+
+        redis_client = redis.StrictRedis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=0)
+        counter = QueryCounter()
+        progress_counter = ProgressEventCounter(redis_client)
+        task_ids = []
+        try:
+            counter.install()
+            progress_counter.start()
+            redis_before = self._redis_command_calls(redis_client)
+            start = time.time()
+            task_ids, rejected = self._submit(options['tasks'], options['rate'], options['priority'], task_data_factory)
+            submit_elapsed = time.time() - start
+            finished = self._wait(task_ids, counter, options['timeout'], options['poll_interval'])
+            wall = time.time() - start
+            redis_delta = self._redis_command_calls(redis_client) - redis_before
+            query_counts = Counter(counter.counts)
+
+            with counter.suspended():
+                rows = list(ComfyUITask.objects.filter(task_id__in=task_ids).values(
+                    'status', 'created_at', 'started_at', 'completed_at'))
+            self._report(options, servers, rows, len(task_ids), rejected, finished, submit_elapsed, wall,
+                         redis_delta, query_counts, stubs, store,
+                         [progress_counter.counts[task_id] for task_id in task_ids])
+        finally:
+            progress_counter.stop()
+            counter.uninstall()
+            consumer.tos_utils = saved_tos_utils
+            VolcengineTOSUtils._shared_config, VolcengineTOSUtils._shared_client = shared_config, shared_client
+            for name, value in saved_settings.items():
+                setattr(settings, name, value)
+            if task_ids and not options['keep_tasks']:
+                ComfyUITask.objects.filter(task_id__in=task_ids).delete()
+            for stub in stubs:
+                stub.stop()
+            os.remove(workflow_file)
+
+    def _report(self, options, servers, rows, submitted, rejected, finished, submit_elapsed, wall,
+                redis_delta, query_counts, stubs, store, progress_counts):
+        statuses = Counter(row['status'] for row in rows)
+        queue_waits = [(row['started_at'] - row['created_at']).total_seconds()
+                       for row in rows if row['started_at'] and row['created_at']]
+        latencies = [(row['completed_at'] - row['created_at']).total_seconds()
+                     for row in rows if row['status'] == 'completed' and row['completed_at'] and row['created_at']]
+        completed_rows = [row for row in rows if row['status'] == 'completed' and row['completed_at']]
+        if completed_rows:
+            span = (max(row['completed_at'] for row in completed_rows)
+                    - min(row['created_at'] for row in rows)).total_seconds()
+        else:
+            span = wall
+
+        self.stdout.write(f"后端: {', '.join(servers)}")
+        self.stdout.write(f"提交 {submitted} 个任务（拒绝 {rejected} 个），提交耗时 {submit_elapsed:.2f}s，"
+                          f"已结束 {finished} 个，总耗时 {wall:.2f}s")
+        self.stdout.write(f"任务状态: {dict(statuses)}")
+        self.stdout.write(f"吞吐量: {len(completed_rows) / span if span > 0 else 0:.2f} 任务/秒")
+
+        self.stdout.write(f"{'指标(s)':<12}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+        for label, values in (('排队等待', queue_waits), ('端到端延迟', latencies)):
+            cells = [percentile(values, pct) for pct in (50, 95, 99)] + [max(values) if values else None]
+            self.stdout.write(f"{label:<12}" + ''.join(
+                f"{value:>10.2f}" if value is not None else f"{'-':>10}" for value in cells))
+
+        per_task = max(submitted, 1)
+        total_redis = sum(redis_delta.values())
+        total_queries = sum(query_counts.values())
+        self.stdout.write(f"Redis命令: {total_redis} 次（{total_redis / per_task:.1f} 次/任务，包含同一Redis上其他客户端的命令）"
+                          f"，前10: {dict(redis_delta.most_common(10))}")
+        self.stdout.write(f"MySQL语句: {total_queries} 次（{total_queries / per_task:.1f} 次/任务）: {dict(query_counts)}")
+        progress_tasks = sum(1 for count in progress_counts if count)
+        self.stdout.write(f"进度推送: {sum(progress_counts)} 条事件，{progress_tasks}/{submitted} 个任务收到进度事件")
+
+        for stub in stubs:
+            self.stdout.write(f"替身服务 {stub.address}: {stub.stats}")
+        if store:
+            self.stdout.write(f"本地TOS替身: 上传 {store.put_count} 次，共 {store.bytes_received / 1024 / 1024:.1f}MB")
+
+        if finished < submitted:
+            self.stdout.write(self.style.WARNING(f"有 {submitted - finished} 个任务在 {options['timeout']}s 内未结束"))
+        else:
+            self.stdout.write(self.style.SUCCESS("压测完成"))
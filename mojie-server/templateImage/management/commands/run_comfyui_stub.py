@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from templateImage.loadtest_stubs import ComfyUIStubServer
+
+
+class Command(BaseCommand):
+    help = '启动ComfyUI替身服务（/prompt、/history、/view、/queue、/interrupt及WebSocket进度推送），用于无GPU环境的联调和压测'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', type=str, default='127.0.0.1', help='监听地址，默认127.0.0.1')
+        parser.add_argument('--port', type=int, default=8188, help='监听端口，默认8188')
+        parser.add_argument('--exec-time', type=float, default=2.0, help='每个工作流的平均执行时间（秒），默认2')
+        parser.add_argument('--jitter', type=float, default=0.2, help='执行时间的随机波动比例，默认0.2')
+        parser.add_argument('--failure-rate', type=float, default=0.0, help='执行失败的概率，默认0')
+        parser.add_argument('--output-kb', type=int, default=512, help='每张输出图像的大小（KB），默认512')
+        parser.add_argument('--outputs', type=int, default=1, help='每个输出节点生成的图像数，默认1')
+        parser.add_argument('--http-latency-ms', type=float, default=0, help='每个HTTP请求额外增加的延迟（毫秒），默认0')
+
+    def handle(self, *args, **options):
+        server = ComfyUIStubServer(
+            host=options['host'],
+            port=options['port'],
+            exec_time=options['exec_time'],
+            jitter=options['jitter'],
+            failure_rate=options['failure_rate'],
+            output_kb=options['output_kb'],
+            outputs_per_prompt=options['outputs'],
+            http_latency_ms=options['http_latency_ms'],
+        )
+        self.stdout.write(self.style.SUCCESS(f"ComfyUI替身服务运行于 {server.address}，按Ctrl+C停止"))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.stop()
+            self.stdout.write(f"已停止，共处理 {server.stats['prompts']} 个工作流: {server.stats}")
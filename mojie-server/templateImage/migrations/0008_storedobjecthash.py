@@ -0,0 +1,29 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('templateImage', '0007_pointsdeductionhistory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredObjectHash',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, verbose_name='内容SHA-256')),
+                ('folder', models.CharField(blank=True, default='', max_length=255, verbose_name='对象目录')),
+                ('object_key', models.CharField(max_length=512, verbose_name='对象名称')),
+                ('size', models.BigIntegerField(default=0, verbose_name='内容大小（字节）')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+            ],
+            options={
+                'verbose_name': '对象内容哈希索引',
+                'verbose_name_plural': '对象内容哈希索引',
+                'db_table': 'stored_object_hash',
+                'indexes': [models.Index(fields=['object_key'], name='stored_object_hash_key_idx')],
+                'unique_together': {('sha256', 'folder')},
+            },
+        ),
+    ]
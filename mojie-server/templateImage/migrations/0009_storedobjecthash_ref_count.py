@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('templateImage', '0008_storedobjecthash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storedobjecthash',
+            name='ref_count',
+            field=models.PositiveIntegerField(default=1, verbose_name='引用次数'),
+        ),
+    ]
@@ -467,17 +467,24 @@ class ComfyUITask(models.Model):
 
         # 只在任务从未完成变为完成时处理
         if not is_new and old_status != 'completed' and self.status == 'completed':
-            # 任务状态变为完成，无论是否有错误信息都扣除积分
-            # 扣除积分
-            self.deduct_points()
-            logger.info(f"任务 {self.task_id} 成功完成，已扣除用户积分")
-            
-            # 根据开关决定是否保存图片到云空间
-            if self.auto_save_to_cloud:
-                self.save_to_user_cloud()
-                logger.info(f"任务 {self.task_id} 自动保存到云空间功能已开启，正在保存图片")
-            else:
-                logger.info(f"任务 {self.task_id} 自动保存到云空间功能已关闭，不自动保存图片")
+            self.handle_completion()
+
+    def handle_completion(self):
+        """
+        任务从未完成变为完成时的处理：扣除积分，并根据开关保存图片到云空间
+        通过bulk_update批量更新状态时不会经过save，需要显式调用
+        """
+        # 任务状态变为完成，无论是否有错误信息都扣除积分
+        # 扣除积分
+        self.deduct_points()
+        logger.info(f"任务 {self.task_id} 成功完成，已扣除用户积分")
+
+        # 根据开关决定是否保存图片到云空间
+        if self.auto_save_to_cloud:
+            self.save_to_user_cloud()
+            logger.info(f"任务 {self.task_id} 自动保存到云空间功能已开启，正在保存图片")
+        else:
+            logger.info(f"任务 {self.task_id} 自动保存到云空间功能已关闭，不自动保存图片")
 
 
 class TaskType(models.Model):
@@ -570,4 +577,23 @@ class PointsDeductionHistory(models.Model):
         db_table = 'points_deduction_history'
         
     def __str__(self):
-        return f"{self.user.username} - {self.deduction_time} - {self.points_deducted}点{self.deduction_type}"
\ No newline at end of file
+        return f"{self.user.username} - {self.deduction_time} - {self.points_deducted}点{self.deduction_type}"
+
+class StoredObjectHash(models.Model):
+    """对象存储内容哈希索引，相同内容再次上传到同一目录时复用已有对象，引用次数归零时才删除对象"""
+    sha256 = models.CharField(max_length=64, verbose_name='内容SHA-256')
+    folder = models.CharField(max_length=255, default='', blank=True, verbose_name='对象目录')
+    object_key = models.CharField(max_length=512, verbose_name='对象名称')
+    size = models.BigIntegerField(default=0, verbose_name='内容大小（字节）')
+    ref_count = models.PositiveIntegerField(default=1, verbose_name='引用次数')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='创建时间')
+
+    class Meta:
+        verbose_name = '对象内容哈希索引'
+        verbose_name_plural = verbose_name
+        db_table = 'stored_object_hash'
+        unique_together = ('sha256', 'folder')
+        indexes = [models.Index(fields=['object_key'], name='stored_object_hash_key_idx')]
+
+    def __str__(self):
+        return f"{self.sha256[:12]} -> {self.object_key}"
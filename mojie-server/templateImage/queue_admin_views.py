@@ -14,6 +14,7 @@ from rest_framework.decorators import action
 from common.response_utils import ResponseUtil
 from templateImage.models import ComfyUITask
 from templateImage.queue_service_singleton import queue_service
+from templateImage.task_executor import task_executor
 from templateImage.task_utils import TaskUtils
 
 logger = logging.getLogger(__name__)
@@ -338,7 +339,8 @@ class QueueAdminAPIView(APIView):
             system_metrics = {
                 'queue_size': queue_service.get_queue_size(),
                 'active_consumers': 1 if queue_service.get_consumer() else 0,
-                'redis_available': queue_service.is_redis_available
+                'redis_available': queue_service.is_redis_available,
+                'task_executor': task_executor.get_stats()
             }
 
             # 添加查询参数信息
@@ -561,6 +563,12 @@ class QueueAdminAPIView(APIView):
 
             task.save()
 
+            # 任务仍在队列中时同步调整其排序和排名索引
+            if new_priority and new_status != 'pending':
+                queue_service.update_task_priority(task.task_id, new_priority)
+            if new_priority and task.status == 'pending':
+                queue_service.track_pending_rank(task.task_id, task.priority, task.created_at)
+
             # 如果任务状态改变为pending，重新加入队列
             if new_status == 'pending':
                 queue_service.add_task(
@@ -1,31 +1,72 @@
+import os
 import queue
+import socket
 import threading
 import time
 import redis
 import json
 import uuid
 import logging
+from collections import deque
 from threading import Thread, Event
 from queue import Queue
 from typing import Dict, Optional, Callable, List, Any
 from datetime import datetime
 
+from django.conf import settings
+from django.core.cache import cache
 from django.db import transaction
 from django.db.backends.signals import connection_created
 from django.dispatch import receiver
 from django.utils import timezone
 
+from templateImage.comfyui_dispatcher import comfyui_dispatcher
 from templateImage.models import ComfyUITask
+from templateImage.task_cancellation import task_cancellation_bus
+from templateImage.task_events import task_event_bus
+from templateImage.task_status_buffer import task_status_buffer
 
 logger = logging.getLogger(__name__)
 
 
 class QueueService:
+    # Redis中的优先级队列：有序集合保存任务ID及排序分值，哈希保存任务数据，集合用于O(1)成员判断
+    QUEUE_KEY = 'comfyui_priority_queue'
+    QUEUE_PAYLOAD_KEY = 'comfyui_queue_payload'
+    QUEUE_MEMBERS_KEY = 'comfyui_queue_members'
+    LEGACY_QUEUE_KEY = 'comfyui_queue'  # 旧版列表队列，仅用于启动时清理
+
+    # 优先级分值权重，需大于任意入队时间戳，保证优先级先于入队时间参与排序
+    PRIORITY_SCORE_WEIGHT = 10 ** 10
+
+    # 任务状态快照（哈希 task_id -> JSON）
+    STATUS_HASH_KEY = 'comfyui_task_status'
+    # 待处理任务排名索引：分值与优先级队列相同（优先级等级 × 权重 + 创建时间），排名与派发顺序一致，无需定期重算
+    RANK_KEY = 'comfyui_pending_rank'
+
+    # Redis Streams后端：每个优先级一条流，所有工作进程共享同一消费组
+    STREAM_KEY_PREFIX = 'comfyui_task_stream'
+    STREAM_GROUP = 'comfyui_workers'
+
+    # 原子地弹出分值最小（优先级最高、入队最早）的任务并清理其数据和成员索引
+    _POP_TASK_SCRIPT = """
+    local popped = redis.call('ZPOPMIN', KEYS[1])
+    if #popped == 0 then
+        return false
+    end
+    local task_id = popped[1]
+    local payload = redis.call('HGET', KEYS[2], task_id)
+    redis.call('HDEL', KEYS[2], task_id)
+    redis.call('SREM', KEYS[3], task_id)
+    return payload
+    """
+
     def __init__(self, redis_host: str = 'localhost', redis_port: int = 6379):
         """
         增强版队列服务，支持任务中断和状态跟踪
         """
         self.redis = redis.StrictRedis(host=redis_host, port=redis_port, db=0)
+        self._pop_task_script = self.redis.register_script(self._POP_TASK_SCRIPT)
         self.local_queue = Queue()  # 本地内存队列作为备份
         self.is_redis_available = True
         self.task_callbacks = {}  # 存储任务回调函数
@@ -36,9 +77,21 @@ class QueueService:
         self._recovery_initialized = False
         self.consumer_thread = None  # 初始化时不启动线程
 
+        # Redis Streams后端相关状态
+        self.queue_backend = getattr(settings, 'COMFYUI_QUEUE_BACKEND', 'zset')
+        self.stream_consumer_name = f"{socket.gethostname()}:{os.getpid()}"
+        self._stream_backlog = deque()  # 已投递给本消费者、尚未处理的条目 (stream_key, entry_id, task, reclaimed)
+        self._stream_inflight = {}  # 处理中的条目 task_id -> (stream_key, entry_id)
+        self._stream_heartbeat_thread = None
+
         # 检查 Redis 连接
         self._check_redis_connection()
 
+    @property
+    def use_streams(self) -> bool:
+        """是否使用Redis Streams作为任务队列后端"""
+        return self.queue_backend == 'stream' and self.is_redis_available
+
     def get_consumer(self):
         """获取当前设置的消费者"""
         return self.consumer
@@ -47,15 +100,449 @@ class QueueService:
         """获取队列中等待的任务数量"""
         try:
             if self.is_redis_available:
-                return self.redis.llen('comfyui_queue')
+                return self.redis.zcard(self.QUEUE_KEY)
             else:
                 return self.local_queue.qsize()
         except Exception as e:
             logger.error(f"获取队列大小失败: {str(e)}")
             return 0
 
+    def _priority_score(self, priority: Optional[str], enqueue_time: float) -> float:
+        """
+        计算任务在优先级队列中的分值（越小越先处理）
+        :param priority: 任务优先级 (low, medium, high)
+        :param enqueue_time: 入队时间戳
+        :return: 分值
+        """
+        # 延迟导入，避免与task_utils循环导入
+        from templateImage.task_utils import TaskUtils
+        priority_value = TaskUtils.PRIORITY_MAP.get(priority, TaskUtils.PRIORITY_MAP[TaskUtils.PRIORITY_MEDIUM])
+        return priority_value * self.PRIORITY_SCORE_WEIGHT + enqueue_time
+
+    def _enqueue(self, task: Dict, priority: Optional[str] = None, score: Optional[float] = None, pipe=None):
+        """
+        将任务写入Redis优先级队列（单次往返，MULTI/EXEC保证三个结构一致）
+        :param task: 任务数据，必须包含task_id
+        :param priority: 任务优先级，未指定时使用任务数据中的priority
+        :param score: 直接指定分值（用于重新入队时保留原排序）
+        :param pipe: 批量入队时传入的管道，只追加命令，由调用方统一执行
+        """
+        task_id = task['task_id']
+        task.setdefault('enter_queue_time', time.time())
+        if priority:
+            task['priority'] = priority
+        if score is None:
+            score = self._priority_score(task.get('priority'), task['enter_queue_time'])
+
+        batch = pipe is not None
+        pipe = pipe if batch else self.redis.pipeline()
+        pipe.zadd(self.QUEUE_KEY, {task_id: score})
+        pipe.hset(self.QUEUE_PAYLOAD_KEY, task_id, json.dumps(task))
+        pipe.sadd(self.QUEUE_MEMBERS_KEY, task_id)
+        if self.queue_backend == 'stream':
+            # 有序集合仍作为排名和成员索引，流只负责投递、确认与崩溃回收
+            pipe.xadd(self._stream_key_for_score(score), {'task_id': task_id, 'payload': json.dumps(task)})
+        if not batch:
+            pipe.execute()
+
+    def _pop_task(self) -> Optional[Dict]:
+        """非阻塞地弹出优先级最高的任务，队列为空时返回None"""
+        payload = self._pop_task_script(keys=[self.QUEUE_KEY, self.QUEUE_PAYLOAD_KEY, self.QUEUE_MEMBERS_KEY])
+        if not payload:
+            return None
+        return json.loads(payload)
+
+    def _blocking_pop_task(self, timeout: int) -> Optional[Dict]:
+        """
+        阻塞地弹出优先级最高的任务
+        :param timeout: 阻塞超时时间（秒）
+        :return: 任务数据，超时返回None
+        """
+        popped = self.redis.bzpopmin(self.QUEUE_KEY, timeout=timeout)
+        if not popped:
+            return None
+        task_id = popped[1].decode('utf-8') if isinstance(popped[1], bytes) else popped[1]
+
+        pipe = self.redis.pipeline()
+        pipe.hget(self.QUEUE_PAYLOAD_KEY, task_id)
+        pipe.hdel(self.QUEUE_PAYLOAD_KEY, task_id)
+        pipe.srem(self.QUEUE_MEMBERS_KEY, task_id)
+        payload = pipe.execute()[0]
+        if not payload:
+            logger.warning(f"任务 {task_id} 在优先级队列中没有对应的任务数据，已丢弃")
+            return None
+        return json.loads(payload)
+
+    def _take_task(self, task_id: str) -> Optional[Dict]:
+        """从队列中取出指定任务（不论其排序位置），不存在时返回None"""
+        pipe = self.redis.pipeline()
+        pipe.hget(self.QUEUE_PAYLOAD_KEY, task_id)
+        pipe.zrem(self.QUEUE_KEY, task_id)
+        pipe.hdel(self.QUEUE_PAYLOAD_KEY, task_id)
+        pipe.srem(self.QUEUE_MEMBERS_KEY, task_id)
+        payload, removed = pipe.execute()[:2]
+        if not removed or not payload:
+            return None
+        return json.loads(payload)
+
+    def remove_task(self, task_id: str) -> bool:
+        """
+        从队列中移除任务
+        :param task_id: 任务ID
+        :return: 是否移除成功
+        """
+        try:
+            if self.is_redis_available:
+                return self._take_task(task_id) is not None
+
+            removed = False
+            for _ in range(self.local_queue.qsize()):
+                task = self.local_queue.get()
+                if task.get('task_id') == task_id:
+                    removed = True
+                else:
+                    self.local_queue.put(task)
+            return removed
+        except Exception as e:
+            logger.error(f"从队列中移除任务 {task_id} 失败: {str(e)}")
+            return False
+
+    def _rank_score(self, priority: Optional[str], created_at: Optional[datetime]) -> float:
+        """
+        计算任务在排名索引中的分值
+        与优先级队列和任务执行器的派发顺序一致：先按优先级，同优先级按创建时间
+        """
+        created_ts = created_at.timestamp() if created_at else time.time()
+        return self._priority_score(priority, created_ts)
+
+    def track_pending_rank(self, task_id: str, priority: Optional[str], created_at: Optional[datetime]):
+        """将待处理任务加入（或按新优先级更新）排名索引"""
+        try:
+            if self.is_redis_available:
+                self.redis.zadd(self.RANK_KEY, {task_id: self._rank_score(priority, created_at)})
+        except Exception as e:
+            logger.error(f"更新任务 {task_id} 排名索引失败: {str(e)}")
+
+    def untrack_pending_rank(self, task_id: str):
+        """任务离开待处理状态时从排名索引中移除"""
+        try:
+            if self.is_redis_available:
+                self.redis.zrem(self.RANK_KEY, task_id)
+        except Exception as e:
+            logger.error(f"移除任务 {task_id} 排名索引失败: {str(e)}")
+
+    def get_pending_rank(self, task_id: str) -> Optional[int]:
+        """
+        获取待处理任务的队列位置，O(log n)
+        :return: 队列位置 (从1开始)，不在索引中返回None
+        """
+        try:
+            if not self.is_redis_available:
+                return None
+            rank = self.redis.zrank(self.RANK_KEY, task_id)
+            return rank + 1 if rank is not None else None
+        except Exception as e:
+            logger.error(f"获取任务 {task_id} 排名失败: {str(e)}")
+            return None
+
+    def get_pending_ranks(self, task_ids: List[str]) -> Dict[str, int]:
+        """批量获取待处理任务的队列位置（单次往返）"""
+        if not task_ids or not self.is_redis_available:
+            return {}
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for task_id in task_ids:
+                pipe.zrank(self.RANK_KEY, task_id)
+            return {task_id: rank + 1 for task_id, rank in zip(task_ids, pipe.execute()) if rank is not None}
+        except Exception as e:
+            logger.error(f"批量获取任务排名失败: {str(e)}")
+            return {}
+
+    def rebuild_pending_rank(self, tasks: List[Dict]):
+        """
+        用数据库中的待处理任务重建排名索引（原子替换）
+        :param tasks: [{'task_id', 'priority', 'created_at'}, ...]
+        """
+        if not self.is_redis_available:
+            return
+        mapping = {t['task_id']: self._rank_score(t['priority'], t['created_at']) for t in tasks}
+        pipe = self.redis.pipeline()
+        pipe.delete(self.RANK_KEY)
+        if mapping:
+            pipe.zadd(self.RANK_KEY, mapping)
+        pipe.execute()
+
+    def get_task_rank(self, task_id: str) -> Optional[int]:
+        """
+        获取任务在队列中的位置
+        :param task_id: 任务ID
+        :return: 队列位置 (从1开始)，不在队列中返回None
+        """
+        try:
+            if self.is_redis_available:
+                rank = self.redis.zrank(self.QUEUE_KEY, task_id)
+                return rank + 1 if rank is not None else None
+
+            for i, queue_task in enumerate(list(self.local_queue.queue)):
+                if queue_task.get('task_id') == task_id:
+                    return i + 1
+            return None
+        except Exception as e:
+            logger.error(f"获取任务 {task_id} 队列位置失败: {str(e)}")
+            return None
+
+    def update_task_priority(self, task_id: str, priority: str) -> bool:
+        """
+        调整已在队列中任务的优先级，保留其原入队时间
+        :param task_id: 任务ID
+        :param priority: 新优先级
+        :return: 任务是否在队列中并已更新
+        """
+        try:
+            if not self.is_redis_available:
+                return False
+            payload = self.redis.hget(self.QUEUE_PAYLOAD_KEY, task_id)
+            if not payload:
+                return False
+            task = json.loads(payload)
+            task['priority'] = priority
+            score = self._priority_score(priority, task.get('enter_queue_time', time.time()))
+
+            pipe = self.redis.pipeline()
+            pipe.zadd(self.QUEUE_KEY, {task_id: score}, xx=True)
+            pipe.hset(self.QUEUE_PAYLOAD_KEY, task_id, json.dumps(task))
+            if self.queue_backend == 'stream':
+                # 在新优先级的流中再投递一次，先被读取的条目取走任务，另一条读取时会被跳过
+                pipe.xadd(self._stream_key_for_score(score), {'task_id': task_id, 'payload': json.dumps(task)})
+            pipe.execute()
+            logger.info(f"任务 {task_id} 优先级已调整为 {priority}")
+            return True
+        except Exception as e:
+            logger.error(f"调整任务 {task_id} 优先级失败: {str(e)}")
+            return False
+
+    def _stream_keys(self) -> List[str]:
+        """按优先级从高到低返回所有任务流的键"""
+        # 延迟导入，避免与task_utils循环导入
+        from templateImage.task_utils import TaskUtils
+        levels = sorted(set(TaskUtils.PRIORITY_MAP.values()))
+        return [f"{self.STREAM_KEY_PREFIX}:{level}" for level in levels]
+
+    def _stream_key_for_score(self, score: float) -> str:
+        """根据排序分值确定任务应投递的流（分值的整数部分即优先级等级）"""
+        keys = self._stream_keys()
+        level = min(max(int(score // self.PRIORITY_SCORE_WEIGHT), 0), len(keys) - 1)
+        return keys[level]
+
+    def _ensure_stream_group(self):
+        """确保每条任务流及其消费组存在"""
+        for key in self._stream_keys():
+            try:
+                self.redis.xgroup_create(key, self.STREAM_GROUP, id='0', mkstream=True)
+                logger.info(f"已创建任务流消费组: {key}/{self.STREAM_GROUP}")
+            except redis.exceptions.ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+
+    @staticmethod
+    def _decode(value):
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def _queue_stream_entries(self, stream_key, entries, reclaimed: bool = False) -> int:
+        """
+        将流条目放入本地待处理列表
+        :return: 放入的条目数量
+        """
+        count = 0
+        stream_key = self._decode(stream_key)
+        for entry_id, fields in entries:
+            entry_id = self._decode(entry_id)
+            if not fields:
+                # 条目已被删除，仅需确认
+                self._ack_stream_entry(stream_key, entry_id)
+                continue
+            try:
+                task = json.loads(fields[b'payload'] if b'payload' in fields else fields['payload'])
+            except (KeyError, json.JSONDecodeError) as e:
+                logger.error(f"任务流条目 {stream_key}/{entry_id} 数据无效，已丢弃: {str(e)}")
+                self._ack_stream_entry(stream_key, entry_id)
+                continue
+            self._stream_backlog.append((stream_key, entry_id, task, reclaimed))
+            count += 1
+        return count
+
+    def _read_stream_entry(self, block_ms: int):
+        """
+        从任务流读取下一个条目，优先级高的流优先
+        :param block_ms: 所有流均为空时的阻塞等待时长（毫秒）
+        :return: (stream_key, entry_id, task, reclaimed)，超时返回None
+        """
+        if self._stream_backlog:
+            return self._stream_backlog.popleft()
+
+        keys = self._stream_keys()
+        for key in keys:
+            response = self.redis.xreadgroup(self.STREAM_GROUP, self.stream_consumer_name, {key: '>'}, count=1)
+            if response:
+                break
+        else:
+            # 所有流都为空时在全部流上阻塞，直到有新任务投递
+            response = self.redis.xreadgroup(self.STREAM_GROUP, self.stream_consumer_name,
+                                             {key: '>' for key in keys}, count=1, block=block_ms)
+        for stream_key, entries in response or []:
+            self._queue_stream_entries(stream_key, entries)
+
+        return self._stream_backlog.popleft() if self._stream_backlog else None
+
+    def _ack_stream_entry(self, stream_key: str, entry_id: str):
+        """确认并删除已处理的流条目"""
+        try:
+            pipe = self.redis.pipeline()
+            pipe.xack(stream_key, self.STREAM_GROUP, entry_id)
+            pipe.xdel(stream_key, entry_id)
+            pipe.execute()
+        except Exception as e:
+            logger.error(f"确认任务流条目 {stream_key}/{entry_id} 失败: {str(e)}")
+
+    @staticmethod
+    def _is_process_alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def _reclaim_stream_tasks(self, startup: bool = False) -> int:
+        """
+        从消费组的待确认列表(PEL)中回收工作进程失效后遗留的任务
+        :param startup: 是否为启动时回收，启动时还会立即接管本机已退出进程和本消费者的遗留条目
+        :return: 回收的任务数量
+        """
+        claim_idle_ms = getattr(settings, 'COMFYUI_STREAM_CLAIM_IDLE_MS', 600000)
+        hostname = socket.gethostname()
+        reclaimed = 0
+
+        for key in self._stream_keys():
+            if startup:
+                # 1. 同名消费者（如容器内进程号相同）上次运行时未确认的条目
+                response = self.redis.xreadgroup(self.STREAM_GROUP, self.stream_consumer_name, {key: '0'})
+                for stream_key, entries in response or []:
+                    reclaimed += self._queue_stream_entries(stream_key, entries, reclaimed=True)
+
+                # 2. 本机已退出进程的消费者，无需等待空闲超时即可接管
+                for info in self.redis.xinfo_consumers(key, self.STREAM_GROUP):
+                    name = self._decode(info.get('name'))
+                    host, _, pid = name.rpartition(':')
+                    if name == self.stream_consumer_name or host != hostname or not pid.isdigit():
+                        continue
+                    if self._is_process_alive(int(pid)):
+                        continue
+                    pending = self.redis.xpending_range(key, self.STREAM_GROUP, min='-', max='+',
+                                                        count=1000, consumername=name)
+                    entry_ids = [item['message_id'] for item in pending]
+                    if entry_ids:
+                        entries = self.redis.xclaim(key, self.STREAM_GROUP, self.stream_consumer_name,
+                                                    min_idle_time=0, message_ids=entry_ids)
+                        reclaimed += self._queue_stream_entries(key, entries, reclaimed=True)
+                    self.redis.xgroup_delconsumer(key, self.STREAM_GROUP, name)
+                    logger.info(f"已接管已退出消费者 {name} 的 {len(entry_ids)} 个未确认任务")
+
+            # 3. 其他失效消费者中超过空闲时长的条目
+            start_id = '0-0'
+            while True:
+                response = self.redis.xautoclaim(key, self.STREAM_GROUP, self.stream_consumer_name,
+                                                 min_idle_time=claim_idle_ms, start_id=start_id, count=100)
+                next_id, entries = self._decode(response[0]), response[1]
+                reclaimed += self._queue_stream_entries(key, entries, reclaimed=True)
+                if next_id == '0-0':
+                    break
+                start_id = next_id
+
+        if reclaimed:
+            logger.warning(f"已从任务流待确认列表中回收 {reclaimed} 个任务")
+        return reclaimed
+
+    def _stream_heartbeat(self):
+        """定期刷新处理中条目的空闲时间，避免长任务被其他工作进程误回收"""
+        interval = max(getattr(settings, 'COMFYUI_STREAM_CLAIM_IDLE_MS', 600000) / 1000 / 3, 1)
+        while self.running and self.use_streams:
+            time.sleep(interval)
+            for task_id, (stream_key, entry_id) in list(self._stream_inflight.items()):
+                try:
+                    self.redis.xclaim(stream_key, self.STREAM_GROUP, self.stream_consumer_name,
+                                      min_idle_time=0, message_ids=[entry_id], justid=True)
+                except Exception as e:
+                    logger.error(f"刷新任务 {task_id} 的流条目心跳失败: {str(e)}")
+
+    def _consume_stream_tasks(self):
+        """Redis Streams消费者线程，阻塞读取消费组中的任务，处理完成后显式确认"""
+        logger.info(f"Streams消费者线程已启动，消费者: {self.stream_consumer_name}")
+        block_ms = getattr(settings, 'COMFYUI_STREAM_BLOCK_MS', 60000)
+        try:
+            self._ensure_stream_group()
+            self._reclaim_stream_tasks(startup=True)
+        except Exception as e:
+            logger.error(f"初始化任务流消费组失败: {str(e)}", exc_info=True)
+        last_reclaim = time.time()
+
+        if not self._stream_heartbeat_thread or not self._stream_heartbeat_thread.is_alive():
+            self._stream_heartbeat_thread = Thread(target=self._stream_heartbeat, daemon=True)
+            self._stream_heartbeat_thread.start()
+
+        while self.running:
+            task_id = "未知"
+            try:
+                if time.time() - last_reclaim >= block_ms / 1000:
+                    self._reclaim_stream_tasks()
+                    last_reclaim = time.time()
+
+                entry = self._read_stream_entry(block_ms)
+                if not entry:
+                    continue
+                stream_key, entry_id, task, reclaimed = entry
+                task_id = task.get('task_id', '未知')
+
+                if not reclaimed:
+                    # 从排序索引中取出任务，取不到说明任务已被移除（取消）或已由其他路径处理
+                    indexed_task = self._take_task(task_id)
+                    if indexed_task is None:
+                        logger.info(f"任务 {task_id} 已不在队列索引中，跳过流条目 {entry_id}")
+                        self._ack_stream_entry(stream_key, entry_id)
+                        continue
+                    task = indexed_task
+                else:
+                    logger.info(f"处理回收的任务: {task_id}")
+
+                self._stream_inflight[task_id] = (stream_key, entry_id)
+                try:
+                    self._process_task(task)
+                finally:
+                    self._stream_inflight.pop(task_id, None)
+                    self._ack_stream_entry(stream_key, entry_id)
+
+            except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+                logger.warning("Redis异常，切换本地队列模式")
+                self.is_redis_available = False
+                self._consume_tasks()
+                return
+            except Exception as e:
+                logger.error(f"处理任务流条目异常（ID: {task_id}）: {str(e)}", exc_info=True)
+                time.sleep(1)
+
+    def _consumer_target(self):
+        """根据队列后端选择消费者线程的执行函数"""
+        return self._consume_stream_tasks if self.use_streams else self._consume_tasks
+
     def initialize_recovery(self):
         """初始化任务恢复（在应用完全初始化后调用）"""
+        if not self._recovery_initialized and self.use_streams:
+            # 流中未投递的任务保留在流内，已投递未确认的任务由消费者线程从PEL中回收，无需清空队列和扫描数据库
+            logger.info("使用Redis Streams任务队列，任务恢复由消费组待确认列表完成")
+            self._recovery_initialized = True
+            return
+
         if not self._recovery_initialized:
             logger.info("开始初始化恢复功能")
             
@@ -66,327 +553,47 @@ class QueueService:
             def _recover_tasks_async():
                 try:
                     # 首先检查并同步所有已完成任务的状态
-                    _sync_completed_tasks_status()
-                    
-                    # 彻底扫描所有状态不一致的任务
-                    _scan_for_inconsistent_statuses()
-                    
-                    # 恢复pending和processing状态的任务
-                    tasks_to_recover = ComfyUITask.objects.filter(
-                        status__in=['pending', 'processing']
-                    ).order_by('created_at')
+                    self._sync_completed_tasks_status()
 
-                    if tasks_to_recover:
-                        logger.info(f"发现 {len(tasks_to_recover)} 个需要恢复的任务")
-                        recovered_task_ids = []  # 跟踪已恢复的任务ID
+                    # 彻底扫描所有状态不一致的任务
+                    self._scan_for_inconsistent_statuses()
 
-                        for task in tasks_to_recover:
-                            try:
-                                # 增强：双重检查Redis中任务状态，避免重复处理已完成任务
-                                skip_task = False
-                                redis_status = None
-                                if self.is_redis_available:
-                                    redis_status_data = self.redis.hget('comfyui_task_status', task.task_id)
-                                    if redis_status_data:
-                                        try:
-                                            redis_status = json.loads(redis_status_data)
-                                            if 'status' in redis_status and redis_status['status'] in ['completed', 'failed', 'cancelled']:
-                                                logger.warning(f"Redis中任务 {task.task_id} 状态为 {redis_status['status']}，不再恢复")
-                                                
-                                                # 如果数据库状态与Redis不一致，更新数据库状态
-                                                if task.status != redis_status['status']:
-                                                    logger.info(f"【状态同步】更新数据库中任务 {task.task_id} 状态为 {redis_status['status']} (原状态: {task.status})")
-                                                    task.status = redis_status['status']
-                                                    if 'completed_at' in redis_status and redis_status['completed_at']:
-                                                        try:
-                                                            task.completed_at = datetime.fromisoformat(redis_status['completed_at'])
-                                                        except:
-                                                            task.completed_at = timezone.now()
-                                                    elif redis_status['status'] in ['completed', 'failed', 'cancelled']:
-                                                        task.completed_at = timezone.now()
-                                                    
-                                                    if 'output_data' in redis_status and redis_status['output_data']:
-                                                        task.output_data = redis_status['output_data']
-                                                    
-                                                    task.save()
-                                                    logger.info(f"已成功更新数据库中任务 {task.task_id} 状态")
-                                                skip_task = True
-                                        except json.JSONDecodeError:
-                                            logger.warning(f"Redis中任务状态数据无效: {redis_status_data}")
-
-                                if skip_task:
-                                    continue
-
-                                # 再次检查数据库中的任务状态（可能已被其他线程更新）
-                                task.refresh_from_db()
-                                if task.status in ['completed', 'failed', 'cancelled']:
-                                    logger.info(f"数据库中任务 {task.task_id} 状态为 {task.status}，不再恢复")
-                                    
-                                    # 确保Redis状态一致
-                                    if self.is_redis_available and (not redis_status or redis_status.get('status') != task.status):
-                                        status_data = {
-                                            'task_id': task.task_id,
-                                            'status': task.status,
-                                            'timestamp': time.time(),
-                                            'from_source': 'mysql_sync',
-                                            'completed_at': task.completed_at.isoformat() if task.completed_at else timezone.now().isoformat(),
-                                            'output_data': task.output_data
-                                        }
-                                        self.redis.hset('comfyui_task_status', task.task_id, json.dumps(status_data))
-                                        logger.info(f"已同步数据库状态到Redis: 任务 {task.task_id} 状态 {task.status}")
-                                    continue
-
-                                # 重置processing状态的任务为pending
-                                if task.status == 'processing':
-                                    task.status = 'pending'
-                                    task.started_at = None
-                                    task.save(update_fields=['status', 'started_at'])
-                                    logger.info(f"已将任务 {task.task_id} 状态从processing重置为pending")
-
-                                # 重新加入队列
-                                task_item = {
-                                    'task_id': task.task_id,  # 使用task_id而不是id
-                                    'type': task.task_type,
-                                    'data': task.input_data,
-                                    'status': 'pending'
-                                }
-
-                                # 最终检查确保任务状态
-                                final_check = True
-                                
-                                # 1. 最后一次刷新检查数据库状态
-                                try:
-                                    task.refresh_from_db()  # 刷新任务对象
-                                    if task.status in ['completed', 'failed', 'cancelled']:
-                                        logger.warning(f"任务 {task.task_id} 在最终检查时数据库状态为 {task.status}，取消恢复")
-                                        final_check = False
-                                except Exception as e:
-                                    logger.error(f"最终检查任务状态失败: {str(e)}")
-                                
-                                # 2. 最后一次检查Redis状态
-                                if final_check and self.is_redis_available:
-                                    try:
-                                        redis_status_data = self.redis.hget('comfyui_task_status', task.task_id)
-                                        if redis_status_data:
-                                            redis_status = json.loads(redis_status_data)
-                                            if 'status' in redis_status and redis_status['status'] in ['completed', 'failed', 'cancelled']:
-                                                logger.warning(f"Redis中任务 {task.task_id} 在最终检查时状态为 {redis_status['status']}，取消恢复")
-                                                
-                                                # 同步到MySQL
-                                                if task.status != redis_status['status']:
-                                                    task.status = redis_status['status']
-                                                    if 'completed_at' in redis_status and redis_status['completed_at']:
-                                                        try:
-                                                            task.completed_at = datetime.fromisoformat(redis_status['completed_at'])
-                                                        except:
-                                                            task.completed_at = timezone.now()
-                                                    task.save()
-                                                final_check = False
-                                    except Exception as e:
-                                        logger.error(f"最终检查Redis状态失败: {str(e)}")
-                                
-                                if not final_check:
-                                    logger.info(f"任务 {task.task_id} 基于最终检查结果不再恢复")
-                                    continue
-
-                                # 通过所有检查后，将任务加入队列
-                                if self.is_redis_available:
-                                    self.redis.rpush('comfyui_queue', json.dumps(task_item))
-                                    # 同时更新Redis状态
-                                    status_data = {
-                                        'task_id': task.task_id,
-                                        'status': 'pending',
-                                        'timestamp': time.time(),
-                                        'from_source': 'recovery'
-                                    }
-                                    self.redis.hset('comfyui_task_status', task.task_id, json.dumps(status_data))
-                                else:
-                                    self.local_queue.put(task_item)
-
-                                logger.info(f"已恢复任务 {task.task_id} (原状态: {task.status})")
-                                recovered_task_ids.append(task.task_id)
-                                
-                                # 如果这是第一个恢复的任务，且当前无活跃任务，考虑直接处理
-                                if len(recovered_task_ids) == 1:
-                                    with self.lock:
-                                        active_tasks = list(self.active_tasks.keys())
-                                        if not active_tasks and self.consumer:
-                                            logger.info(f"这是第一个恢复的任务且当前无活跃任务，尝试直接处理: {task.task_id}")
-                                            # 先从队列中移除刚刚添加的任务
-                                            if self.is_redis_available:
-                                                try:
-                                                    removed = self.redis.lrem('comfyui_queue', 1, json.dumps(task_item))
-                                                    logger.info(f"已从Redis队列移除任务: {removed} 个")
-                                                except Exception as e:
-                                                    logger.error(f"从Redis队列移除任务失败: {str(e)}")
-                                            
-                                            # 确保任务数据完整
-                                            try:
-                                                if not task_item.get('data'):
-                                                    task_item['data'] = task.input_data
-                                                if not task_item.get('type'):
-                                                    task_item['type'] = task.task_type
-                                            except Exception as e:
-                                                logger.error(f"补充任务数据失败: {str(e)}")
-                                                
-                                            # 使用专门的方法直接处理恢复的任务
-                                            logger.info(f"调用_direct_process_recovered_task处理任务 {task.task_id}")
-                                            self._direct_process_recovered_task(task_item)
-                                            # 不要在这里返回，继续处理其他恢复的任务
+                    # 恢复pending和processing状态的任务
+                    recovered_task_ids = self._recover_pending_tasks()
 
-                            except Exception as e:
-                                logger.error(f"恢复任务 {task.task_id} 失败: {str(e)}")
-                    else:
-                        logger.info("没有发现需要恢复的任务")
-                        
                     # 所有恢复任务添加到队列后，检查是否有活跃任务
                     # 如果没有活跃任务，就主动触发任务处理机制
                     with self.lock:
-                        active_tasks = list(self.active_tasks.keys())
-                        if not active_tasks and self.consumer:
-                            logger.info("恢复完成后队列中没有活跃任务，尝试强制触发处理机制")
-                            # 主动触发任务处理
-                            self._trigger_task_processing()
-                            
-                            # 额外检查：如果触发后仍没有活跃任务，直接取出一个任务处理
-                            # 这确保恢复的任务能尽快开始处理
-                            with self.lock:
-                                if not self.active_tasks and recovered_task_ids and self.is_redis_available:
-                                    logger.info("触发后仍无活跃任务，尝试直接处理第一个恢复的任务")
-                                    try:
-                                        # 检查队列中是否有任务
-                                        queue_size = self.redis.llen('comfyui_queue')
-                                        if queue_size > 0:
-                                            # 获取第一个任务但不从队列移除，先检查是否是恢复的任务
-                                            task_data = self.redis.lindex('comfyui_queue', 0)
-                                            if task_data:
-                                                task = json.loads(task_data)
-                                                task_id = task.get('task_id', '未知')
-                                                # 确认是恢复的任务才处理
-                                                if task_id in recovered_task_ids:
-                                                    # 从队列中移除
-                                                    self.redis.lpop('comfyui_queue')
-                                                    logger.info(f"直接处理恢复的任务: {task_id}")
-                                                    # 立即处理这个任务
-                                                    self._direct_process_recovered_task(task)
-                                    except Exception as e:
-                                        logger.error(f"尝试直接处理恢复任务失败: {str(e)}")
+                        has_active_tasks = bool(self.active_tasks)
+                    if not has_active_tasks and self.consumer:
+                        logger.info("恢复完成后队列中没有活跃任务，尝试强制触发处理机制")
+                        # 主动触发任务处理
+                        self._trigger_task_processing()
 
-                except Exception as e:
-                    logger.error(f"恢复任务时发生错误: {str(e)}")
+                        # 额外检查：如果触发后仍没有活跃任务，直接取出一个任务处理
+                        # 这确保恢复的任务能尽快开始处理
+                        with self.lock:
+                            has_active_tasks = bool(self.active_tasks)
+                        if not has_active_tasks and recovered_task_ids and self.is_redis_available:
+                            logger.info("触发后仍无活跃任务，尝试直接处理第一个恢复的任务")
+                            try:
+                                # 查看队首任务但不从队列移除，先检查是否是恢复的任务
+                                head = self.redis.zrange(self.QUEUE_KEY, 0, 0)
+                                if head:
+                                    task_id = head[0].decode('utf-8')
+                                    # 确认是恢复的任务才处理
+                                    if task_id in recovered_task_ids:
+                                        # 从队列中移除
+                                        task = self._take_task(task_id)
+                                        if task:
+                                            logger.info(f"直接处理恢复的任务: {task_id}")
+                                            # 立即处理这个任务
+                                            self._direct_process_recovered_task(task)
+                            except Exception as e:
+                                logger.error(f"尝试直接处理恢复任务失败: {str(e)}")
 
-            def _sync_completed_tasks_status():
-                """同步所有已完成任务的状态"""
-                try:
-                    # 获取已完成、失败或取消的任务
-                    completed_tasks = ComfyUITask.objects.filter(
-                        status__in=['completed', 'failed', 'cancelled']
-                    ).order_by('-updated_at')[:1000]  # 限制数量，避免过多数据库操作
-                    
-                    if self.is_redis_available and completed_tasks:
-                        logger.info(f"同步 {len(completed_tasks)} 个已完成任务的状态到Redis")
-                        
-                        for task in completed_tasks:
-                            # 检查Redis中的任务状态
-                            redis_status_data = self.redis.hget('comfyui_task_status', task.task_id)
-                            if redis_status_data:
-                                try:
-                                    redis_status = json.loads(redis_status_data)
-                                    # 如果Redis中的状态与数据库不一致，优先使用数据库的状态
-                                    if redis_status.get('status') != task.status:
-                                        logger.warning(f"Redis中任务 {task.task_id} 状态 {redis_status.get('status')} 与数据库中 {task.status} 不一致，优先使用数据库的状态")
-                                        # 更新Redis中的状态
-                                        status_data = {
-                                            'task_id': task.task_id,
-                                            'status': task.status,
-                                            'timestamp': time.time(),
-                                            'from_source': 'mysql_sync',
-                                            'completed_at': task.completed_at.isoformat() if task.completed_at else timezone.now().isoformat(),
-                                            'output_data': task.output_data
-                                        }
-                                        self.redis.hset('comfyui_task_status', task.task_id, json.dumps(status_data))
-                                except Exception as e:
-                                    logger.error(f"解析或更新Redis中任务状态失败 {task.task_id}: {str(e)}")
-                            else:
-                                # Redis中没有这个任务的状态，添加它
-                                try:
-                                    status_data = {
-                                        'task_id': task.task_id,
-                                        'status': task.status,
-                                        'timestamp': time.time(),
-                                        'from_source': 'mysql_sync',
-                                        'completed_at': task.completed_at.isoformat() if task.completed_at else timezone.now().isoformat(),
-                                        'output_data': task.output_data
-                                    }
-                                    self.redis.hset('comfyui_task_status', task.task_id, json.dumps(status_data))
-                                    logger.info(f"将任务 {task.task_id} 状态 {task.status} 添加到Redis")
-                                except Exception as e:
-                                    logger.error(f"将任务状态添加到Redis失败 {task.task_id}: {str(e)}")
-                except Exception as e:
-                    logger.error(f"同步已完成任务状态失败: {str(e)}")
-                    
-            def _scan_for_inconsistent_statuses():
-                """扫描所有状态不一致的任务"""
-                if not self.is_redis_available:
-                    return
-                    
-                try:
-                    # 从Redis获取所有任务状态
-                    all_redis_tasks = self.redis.hgetall('comfyui_task_status')
-                    if not all_redis_tasks:
-                        logger.info("Redis中没有任务状态记录，跳过不一致状态扫描")
-                        return
-                        
-                    logger.info(f"扫描 {len(all_redis_tasks)} 个Redis任务状态的一致性")
-                    inconsistent_count = 0
-                    
-                    for task_id_bytes, status_data_bytes in all_redis_tasks.items():
-                        try:
-                            task_id = task_id_bytes.decode('utf-8')
-                            redis_status = json.loads(status_data_bytes.decode('utf-8'))
-                            
-                            # 只关注终态任务
-                            if redis_status.get('status') not in ['completed', 'failed', 'cancelled']:
-                                continue
-                                
-                            # 检查数据库状态
-                            db_task = ComfyUITask.objects.filter(task_id=task_id).first()
-                            if not db_task:
-                                logger.warning(f"Redis中任务 {task_id} 在数据库中不存在")
-                                continue
-                                
-                            # 如果状态不一致，记录并根据配置同步
-                            if db_task.status != redis_status.get('status'):
-                                inconsistent_count += 1
-                                logger.warning(f"状态不一致: 任务 {task_id} - Redis: {redis_status.get('status')}, MySQL: {db_task.status}")
-                                
-                                # 根据实际需求决定是更新MySQL还是Redis
-                                # 此处我们选择更新MySQL以匹配Redis（Redis为主要状态源）
-                                db_task.status = redis_status.get('status')
-                                if 'completed_at' in redis_status and redis_status['completed_at']:
-                                    try:
-                                        db_task.completed_at = datetime.fromisoformat(redis_status['completed_at'])
-                                    except:
-                                        db_task.completed_at = timezone.now()
-                                elif redis_status.get('status') in ['completed', 'failed', 'cancelled'] and not db_task.completed_at:
-                                    db_task.completed_at = timezone.now()
-                                    
-                                if 'output_data' in redis_status and redis_status['output_data']:
-                                    db_task.output_data = redis_status['output_data']
-                                    
-                                db_task.save()
-                                logger.info(f"已同步Redis状态到MySQL: 任务 {task_id} -> {redis_status.get('status')}")
-                                
-                        except Exception as e:
-                            logger.error(f"处理任务状态一致性检查失败 {task_id if 'task_id' in locals() else '未知'}: {str(e)}")
-                            
-                    if inconsistent_count > 0:
-                        logger.warning(f"发现并处理了 {inconsistent_count} 个状态不一致的任务")
-                    else:
-                        logger.info("所有任务状态一致，无需同步")
-                        
                 except Exception as e:
-                    logger.error(f"扫描不一致状态任务失败: {str(e)}")
+                    logger.error(f"恢复任务时发生错误: {str(e)}")
 
             # 启动异步恢复线程
             recovery_thread = Thread(target=_recover_tasks_async, daemon=True)
@@ -395,14 +602,278 @@ class QueueService:
             self._recovery_initialized = True
             logger.info("恢复功能初始化完成")
 
+    @staticmethod
+    def _chunks(items: List, size: int):
+        """按固定大小切分列表"""
+        for i in range(0, len(items), size):
+            yield items[i:i + size]
+
+    @property
+    def recovery_chunk_size(self) -> int:
+        """恢复和一致性扫描时每批处理的任务数"""
+        return getattr(settings, 'COMFYUI_RECOVERY_CHUNK_SIZE', 500)
+
+    @staticmethod
+    def _mysql_status_snapshot(task: ComfyUITask) -> Dict:
+        """以数据库中的终态任务构建Redis状态快照"""
+        return {
+            'task_id': task.task_id,
+            'status': task.status,
+            'timestamp': time.time(),
+            'from_source': 'mysql_sync',
+            'completed_at': task.completed_at.isoformat() if task.completed_at else timezone.now().isoformat(),
+            'output_data': task.output_data
+        }
+
+    @staticmethod
+    def _apply_redis_terminal_status(task: ComfyUITask, redis_status: Dict):
+        """将Redis中的终态写到任务对象上（不保存）"""
+        task.status = redis_status['status']
+        completed_at = redis_status.get('completed_at')
+        if completed_at:
+            try:
+                task.completed_at = datetime.fromisoformat(completed_at)
+            except (TypeError, ValueError):
+                task.completed_at = timezone.now()
+        elif not task.completed_at:
+            task.completed_at = timezone.now()
+        if redis_status.get('output_data'):
+            task.output_data = redis_status['output_data']
+
+    def _bulk_save_terminal_statuses(self, tasks: List[ComfyUITask], extra_fields: Optional[List[str]] = None):
+        """
+        批量保存同步自Redis的终态
+        bulk_update不会触发模型的save，新完成的任务需要显式执行完成处理（扣除积分等）
+        :param extra_fields: 需要一并保存的其他字段
+        """
+        if not tasks:
+            return
+        ComfyUITask.objects.bulk_update(tasks, ['status', 'completed_at', 'output_data'] + (extra_fields or []),
+                                        batch_size=self.recovery_chunk_size)
+        if self.is_redis_available:
+            self.redis.zrem(self.RANK_KEY, *[task.task_id for task in tasks])
+        for task in tasks:
+            if task.status == 'completed':
+                try:
+                    task.handle_completion()
+                except Exception as e:
+                    logger.error(f"任务 {task.task_id} 完成处理失败: {str(e)}")
+        logger.info(f"已批量同步 {len(tasks)} 个任务的Redis终态到MySQL")
+
+    def _sync_completed_tasks_status(self, limit: int = 1000):
+        """同步最近已完成任务的状态到Redis（按批HMGET读取，一次HSET写回）"""
+        if not self.is_redis_available:
+            return
+        try:
+            # 获取已完成、失败或取消的任务，限制数量，避免过多数据库操作
+            completed_tasks = list(ComfyUITask.objects.filter(
+                status__in=['completed', 'failed', 'cancelled']
+            ).only('task_id', 'status', 'completed_at', 'output_data').order_by('-updated_at')[:limit])
+            if not completed_tasks:
+                return
+            logger.info(f"同步 {len(completed_tasks)} 个已完成任务的状态到Redis")
+
+            synced_count = 0
+            for chunk in self._chunks(completed_tasks, self.recovery_chunk_size):
+                redis_statuses = self.get_status_snapshots([task.task_id for task in chunk])
+                snapshots = {}
+                for task in chunk:
+                    redis_status = redis_statuses.get(task.task_id)
+                    # 如果Redis中的状态与数据库不一致或缺失，优先使用数据库的状态
+                    if not redis_status or redis_status.get('status') != task.status:
+                        if redis_status:
+                            logger.warning(f"Redis中任务 {task.task_id} 状态 {redis_status.get('status')} 与数据库中 {task.status} 不一致，优先使用数据库的状态")
+                        snapshots[task.task_id] = json.dumps(self._mysql_status_snapshot(task))
+                if snapshots:
+                    self.redis.hset(self.STATUS_HASH_KEY, mapping=snapshots)
+                    synced_count += len(snapshots)
+            logger.info(f"已同步 {synced_count} 个已完成任务的状态到Redis")
+        except Exception as e:
+            logger.error(f"同步已完成任务状态失败: {str(e)}")
+
+    def _scan_for_inconsistent_statuses(self):
+        """扫描Redis终态与MySQL不一致的任务（HSCAN分批读取，每批一次查询、一次bulk_update）"""
+        if not self.is_redis_available:
+            return
+
+        def _sync_chunk(redis_statuses: Dict[str, Dict]) -> int:
+            # 此处选择更新MySQL以匹配Redis（Redis为主要状态源）
+            tasks = [task for task in ComfyUITask.objects.filter(task_id__in=list(redis_statuses.keys()))
+                     if task.status != redis_statuses[task.task_id].get('status')]
+            for task in tasks:
+                logger.warning(f"状态不一致: 任务 {task.task_id} - Redis: {redis_statuses[task.task_id].get('status')}, MySQL: {task.status}")
+                self._apply_redis_terminal_status(task, redis_statuses[task.task_id])
+            self._bulk_save_terminal_statuses(tasks)
+            return len(tasks)
+
+        try:
+            scanned_count = 0
+            inconsistent_count = 0
+            chunk = {}
+            for task_id, status_data in self.redis.hscan_iter(self.STATUS_HASH_KEY, count=self.recovery_chunk_size):
+                scanned_count += 1
+                try:
+                    task_id = task_id.decode('utf-8')
+                    redis_status = json.loads(status_data)
+                except (UnicodeDecodeError, json.JSONDecodeError) as e:
+                    logger.error(f"解析Redis中的任务状态失败: {str(e)}")
+                    continue
+                # 只关注终态任务
+                if redis_status.get('status') not in ['completed', 'failed', 'cancelled']:
+                    continue
+                chunk[task_id] = redis_status
+                if len(chunk) >= self.recovery_chunk_size:
+                    inconsistent_count += _sync_chunk(chunk)
+                    chunk = {}
+            if chunk:
+                inconsistent_count += _sync_chunk(chunk)
+
+            if not scanned_count:
+                logger.info("Redis中没有任务状态记录，跳过不一致状态扫描")
+            elif inconsistent_count > 0:
+                logger.warning(f"扫描 {scanned_count} 个Redis任务状态，发现并处理了 {inconsistent_count} 个状态不一致的任务")
+            else:
+                logger.info(f"扫描 {scanned_count} 个Redis任务状态，所有任务状态一致，无需同步")
+        except Exception as e:
+            logger.error(f"扫描不一致状态任务失败: {str(e)}")
+
+    def _recover_pending_tasks(self) -> List[str]:
+        """
+        将pending和processing状态的任务重新加入队列
+        按批处理：每批一次数据库查询、两次HMGET（加载时与入队前的最终检查），入队写入合并为一个管道
+        :return: 已恢复的任务ID列表
+        """
+        task_ids = list(ComfyUITask.objects.filter(
+            status__in=['pending', 'processing']
+        ).order_by('created_at').values_list('task_id', flat=True))
+        if not task_ids:
+            logger.info("没有发现需要恢复的任务")
+            return []
+        logger.info(f"发现 {len(task_ids)} 个需要恢复的任务")
+
+        terminal_statuses = ['completed', 'failed', 'cancelled']
+        recovered_task_ids = []  # 跟踪已恢复的任务ID
+        for chunk in self._chunks(task_ids, self.recovery_chunk_size):
+            try:
+                # 重新按批加载，期间已被其他线程更新为终态的任务不再出现
+                tasks = list(ComfyUITask.objects.filter(
+                    task_id__in=chunk, status__in=['pending', 'processing']
+                ).order_by('created_at'))
+
+                # 双重检查Redis中任务状态，避免重复处理已完成任务
+                redis_statuses = self.get_status_snapshots([task.task_id for task in tasks])
+                terminal_tasks = []
+                candidates = []
+                for task in tasks:
+                    redis_status = redis_statuses.get(task.task_id)
+                    if redis_status and redis_status.get('status') in terminal_statuses:
+                        logger.warning(f"Redis中任务 {task.task_id} 状态为 {redis_status['status']}，不再恢复")
+                        self._apply_redis_terminal_status(task, redis_status)
+                        terminal_tasks.append(task)
+                    else:
+                        candidates.append(task)
+
+                # 重置processing状态的任务为pending（单条UPDATE）
+                processing_ids = [task.task_id for task in candidates if task.status == 'processing']
+                if processing_ids:
+                    reset_count = ComfyUITask.objects.filter(
+                        task_id__in=processing_ids, status='processing'
+                    ).update(status='pending', started_at=None)
+                    logger.info(f"已将 {reset_count} 个任务状态从processing重置为pending")
+
+                # 最终检查：入队前再确认一次数据库和Redis中的状态
+                still_pending = set(ComfyUITask.objects.filter(
+                    task_id__in=[task.task_id for task in candidates], status='pending'
+                ).values_list('task_id', flat=True))
+                final_statuses = self.get_status_snapshots(list(still_pending))
+
+                to_enqueue = []
+                for task in candidates:
+                    if task.task_id not in still_pending:
+                        logger.warning(f"任务 {task.task_id} 在最终检查时数据库状态已变化，取消恢复")
+                        continue
+                    redis_status = final_statuses.get(task.task_id)
+                    if redis_status and redis_status.get('status') in terminal_statuses:
+                        logger.warning(f"Redis中任务 {task.task_id} 在最终检查时状态为 {redis_status['status']}，取消恢复")
+                        self._apply_redis_terminal_status(task, redis_status)
+                        terminal_tasks.append(task)
+                        continue
+                    to_enqueue.append(task)
+
+                self._bulk_save_terminal_statuses(terminal_tasks)
+                if not to_enqueue:
+                    continue
+
+                # 通过所有检查后，将任务加入队列
+                task_items = []
+                for task in to_enqueue:
+                    task_items.append({
+                        'task_id': task.task_id,  # 使用task_id而不是id
+                        'type': task.task_type,
+                        'data': task.input_data,
+                        'status': 'pending',
+                        'priority': task.priority,
+                        # 按原创建时间排序，保证恢复后的任务顺序不变
+                        'enter_queue_time': task.created_at.timestamp() if task.created_at else time.time()
+                    })
+
+                if self.is_redis_available:
+                    pipe = self.redis.pipeline(transaction=False)
+                    for task, task_item in zip(to_enqueue, task_items):
+                        self._enqueue(task_item, pipe=pipe)
+                    pipe.hset(self.STATUS_HASH_KEY, mapping={
+                        task.task_id: json.dumps({
+                            'task_id': task.task_id,
+                            'status': 'pending',
+                            'timestamp': time.time(),
+                            'from_source': 'recovery',
+                            'priority': task.priority,
+                            'created_at': task.created_at.isoformat() if task.created_at else None,
+                        }) for task in to_enqueue
+                    })
+                    pipe.zadd(self.RANK_KEY, {
+                        task.task_id: self._rank_score(task.priority, task.created_at) for task in to_enqueue
+                    })
+                    pipe.execute()
+                else:
+                    for task_item in task_items:
+                        self.local_queue.put(task_item)
+
+                first_recovery = not recovered_task_ids
+                recovered_task_ids.extend(task.task_id for task in to_enqueue)
+                logger.info(f"已恢复 {len(to_enqueue)} 个任务，累计 {len(recovered_task_ids)} 个")
+
+                # 如果这是第一个恢复的任务，且当前无活跃任务，考虑直接处理
+                if first_recovery and self.consumer:
+                    with self.lock:
+                        has_active_tasks = bool(self.active_tasks)
+                    if not has_active_tasks:
+                        task_item = task_items[0]
+                        logger.info(f"这是第一个恢复的任务且当前无活跃任务，尝试直接处理: {task_item['task_id']}")
+                        # 先从队列中移除刚刚添加的任务
+                        if self.is_redis_available:
+                            try:
+                                removed = self.remove_task(task_item['task_id'])
+                                logger.info(f"已从Redis队列移除任务: {removed}")
+                            except Exception as e:
+                                logger.error(f"从Redis队列移除任务失败: {str(e)}")
+                        # 使用专门的方法直接处理恢复的任务
+                        logger.info(f"调用_direct_process_recovered_task处理任务 {task_item['task_id']}")
+                        self._direct_process_recovered_task(task_item)
+            except Exception as e:
+                logger.error(f"恢复任务批次失败 ({len(chunk)} 个任务): {str(e)}")
+
+        return recovered_task_ids
+
     def _clear_queue(self):
         """清理队列，避免重复处理已完成或失败的任务"""
         try:
             if self.is_redis_available:
-                queue_len = self.redis.llen('comfyui_queue')
+                queue_len = self.redis.zcard(self.QUEUE_KEY)
                 if queue_len > 0:
                     logger.warning(f"清理 Redis 中的 {queue_len} 个待处理任务")
-                    self.redis.delete('comfyui_queue')
+                self.redis.delete(self.QUEUE_KEY, self.QUEUE_PAYLOAD_KEY, self.QUEUE_MEMBERS_KEY,
+                                  self.LEGACY_QUEUE_KEY)
             self.local_queue = Queue()  # 清理本地队列
             logger.info("队列清理完成")
         except Exception as e:
@@ -424,12 +895,13 @@ class QueueService:
             logger.warning("Redis 连接不可用，将使用本地内存队列")
             self.is_redis_available = False
 
-    def add_task(self, task_id: str, task_type: str, task_data: Dict) -> str:
+    def add_task(self, task_id: str, task_type: str, task_data: Dict, priority: Optional[str] = None) -> str:
         """
         添加任务到队列
         :param task_id: 任务ID
         :param task_type: 任务类型
         :param task_data: 任务数据
+        :param priority: 任务优先级 (low, medium, high)，未指定时使用数据库中的优先级
         :return: 任务ID
         """
         try:
@@ -512,17 +984,22 @@ class QueueService:
                         self.redis.hset('comfyui_task_status', task_id, json.dumps(status_data))
 
             # 6. 创建任务对象并添加到队列
+            if not priority:
+                priority = db_task.priority if db_task else ComfyUITask.PRIORITY_MEDIUM
             task = {
                 'task_id': task_id,
                 'type': task_type,
-                'data': task_data
+                'data': task_data,
+                'priority': priority
             }
 
             # 使用事务，确保先完成数据库提交再添加到队列
             def add_to_queue():
                 # 添加到队列
                 if self.is_redis_available:
-                    self.redis.rpush('comfyui_queue', json.dumps(task))
+                    self._enqueue(task)
+                    if db_task:
+                        self.track_pending_rank(task_id, priority, db_task.created_at)
                     # 更新任务状态
                     status_data = {
                         'task_id': task_id,
@@ -552,18 +1029,8 @@ class QueueService:
         """检查任务是否已在队列中"""
         try:
             if self.is_redis_available:
-                # 检查Redis队列
-                queue_len = self.redis.llen('comfyui_queue')
-                if queue_len > 0:
-                    for i in range(queue_len):
-                        queue_item = self.redis.lindex('comfyui_queue', i)
-                        if queue_item:
-                            try:
-                                queue_task = json.loads(queue_item)
-                                if queue_task.get('task_id') == task_id:
-                                    return True
-                            except:
-                                pass
+                # 通过成员索引集合检查，O(1)单次往返
+                return bool(self.redis.sismember(self.QUEUE_MEMBERS_KEY, task_id))
             else:
                 # 检查本地队列
                 for queue_task in list(self.local_queue.queue):
@@ -604,10 +1071,9 @@ class QueueService:
                     # 从 Redis 获取任务，使用动态超时时间
                     if idle_count % 30 == 0:
                         logger.info(f"准备从Redis队列获取任务，超时时间: {int(wait_timeout)}秒")
-                    task_data = self.redis.blpop('comfyui_queue', timeout=int(wait_timeout))
-                    if task_data:
-                        logger.info(f"成功从Redis队列获取到任务数据: {task_data[1][:100]}...")
-                        task = json.loads(task_data[1])
+                    task = self._blocking_pop_task(timeout=max(int(wait_timeout), 1))
+                    if task:
+                        logger.info(f"成功从Redis优先级队列获取到任务: {task.get('task_id')}")
                     else:
                         if idle_count % 30 == 0:
                             logger.info("Redis队列中没有任务，继续等待...")
@@ -743,18 +1209,9 @@ class QueueService:
                     logger.warning(f"已有 {len(active_tasks)} 个任务在处理中: {active_tasks}，任务 {task_id} 将等待")
                     
                     # 检查该任务是否已在队列中
-                    already_in_queue = False
-                    if self.is_redis_available:
-                        # 检查队列中是否已经有该任务
-                        queue_size = self.redis.llen('comfyui_queue')
-                        for i in range(queue_size):
-                            queue_item = self.redis.lindex('comfyui_queue', i)
-                            if queue_item:
-                                queue_task = json.loads(queue_item)
-                                if queue_task.get('task_id') == task_id:
-                                    already_in_queue = True
-                                    logger.info(f"任务 {task_id} 已在队列中，无需重新加入")
-                                    break
+                    already_in_queue = self.is_redis_available and self._is_task_in_queue(task_id)
+                    if already_in_queue:
+                        logger.info(f"任务 {task_id} 已在队列中，无需重新加入")
                     
                     # 如果任务不在队列中，将其放回队列
                     if not already_in_queue:
@@ -763,16 +1220,18 @@ class QueueService:
                             'type': task.get('type'),
                             'data': task.get('data'),
                             'status': 'pending',
+                            'priority': task.get('priority'),
                             'enter_queue_time': task.get('enter_queue_time', time.time())  # 保留原始进入队列时间
                         }
                         if self.is_redis_available:
                             # 对于长时间等待的任务，放到队列头部，优先处理
                             if wait_time > 600:  # 10分钟以上
-                                self.redis.lpush('comfyui_queue', json.dumps(task_item))  # 放到队列头部
+                                self._enqueue(task_item, score=0)  # 分值0排在所有任务之前
                                 logger.info(f"已将长时间等待的任务 {task_id} 放入队列头部，等待优先处理")
                             else:
-                                self.redis.rpush('comfyui_queue', json.dumps(task_item))  # 放到队列尾部
-                                logger.info(f"已将任务 {task_id} 放入队列尾部，等待后续处理")
+                                # 保留原始进入队列时间，按优先级回到原来的位置
+                                self._enqueue(task_item)
+                                logger.info(f"已将任务 {task_id} 按优先级放回队列，等待后续处理")
                         else:
                             self.local_queue.put(task_item)
                     return
@@ -787,14 +1246,6 @@ class QueueService:
                 stop_event = Event()
                 self.active_tasks[task_id] = stop_event
 
-                # 更新任务状态为处理中
-                self._update_task_status(
-                    task_id, 
-                    'processing',
-                    started_at=timezone.now()
-                )
-                logger.info(f"任务 {task_id} 已进入处理阶段")
-
                 # 立即处理任务
                 try:
                     # 确保任务数据完整
@@ -817,8 +1268,8 @@ class QueueService:
                     task_info = f"任务类型: {task.get('type')}, 数据大小: {len(str(task.get('data'))) if task.get('data') else 'None'}"
                     logger.info(f"处理任务 {task_id} - {consumer_info} - {task_info}")
                     
-                    # 实际调用consumer处理任务
-                    result = self.consumer.process_task(task, stop_event)
+                    # 由调度器分配后端后调用consumer处理任务
+                    result = self._process_on_backend(task, stop_event)
                     if result:
                         logger.info(f"任务 {task_id} 处理完成: {result.get('status')}")
                 except Exception as e:
@@ -839,6 +1290,53 @@ class QueueService:
         except Exception as e:
             logger.error(f"处理任务 {task_id} 时发生错误: {str(e)}", exc_info=True)
 
+    def _process_on_backend(self, task: Dict, stop_event: Event) -> Optional[Dict]:
+        """
+        通过调度器获取后端名额，在分配的后端上执行任务，结束后释放名额（与TaskUtils._process_task_async一致）
+        执行期间订阅本任务的取消信号，任意进程取消时立即中断ComfyUI中的prompt并释放后端名额
+        :param task: 任务数据，data中的server_address会替换为分配的后端
+        :param stop_event: 停止事件
+        :return: consumer.process_task的结果
+        """
+        task_id = task['task_id']
+        data = dict(task.get('data') or {})
+
+        # 不经过cancel_task：本方法在持有self.lock时执行
+        def on_cancel(cancelled_task_id):
+            stop_event.set()
+            self.consumer.cancel_task(cancelled_task_id)
+            comfyui_dispatcher.release(cancelled_task_id)
+
+        task_cancellation_bus.register(task_id, on_cancel)
+        try:
+            backend = comfyui_dispatcher.acquire(
+                task_id,
+                data.get('server_address'),
+                cancel_check=lambda: stop_event.is_set() or cache.get(f"task:{task_id}:cancelled") == "true"
+            )
+            if not backend:
+                logger.info(f"任务 {task_id} 在等待后端时被取消，停止处理")
+                return {'status': 'cancelled'}
+
+            try:
+                data['server_address'] = backend
+                task['data'] = data
+
+                # 分配到后端后再更新任务状态为处理中
+                self._update_task_status(
+                    task_id,
+                    'processing',
+                    started_at=timezone.now()
+                )
+                logger.info(f"任务 {task_id} 已进入处理阶段，后端: {backend}")
+
+                return self.consumer.process_task(task, stop_event)
+            finally:
+                # ComfyUI执行结束即释放后端，结果上传不占用GPU名额
+                comfyui_dispatcher.release(task_id)
+        finally:
+            task_cancellation_bus.unregister(task_id)
+
     def cancel_task(self, task_id: str) -> bool:
         """取消正在执行的任务"""
         with self.lock:
@@ -859,6 +1357,12 @@ class QueueService:
         try:
             # 1. 获取任务对象
             task = ComfyUITask.objects.get(task_id=task_id)
+
+            # 增量维护排名索引：进入pending时加入，离开pending时移除
+            if status == 'pending':
+                self.track_pending_rank(task_id, task.priority, task.created_at)
+            else:
+                self.untrack_pending_rank(task_id)
             
             # 2. 更新Redis中的任务状态
             if force_redis_update:
@@ -869,6 +1373,8 @@ class QueueService:
                     'timestamp': time.time(),
                     'from_source': 'redis',
                     'input_data': task.input_data,  # 添加input_data
+                    'priority': task.priority,
+                    'created_at': task.created_at.isoformat() if task.created_at else None,
                 }
                 
                 # 如果任务完成或失败，确保更新processing_time
@@ -876,9 +1382,11 @@ class QueueService:
                     # 优先使用传入的processing_time
                     if 'processing_time' in kwargs:
                         redis_data['processing_time'] = float(kwargs['processing_time'])
-                        # 同时更新数据库中的processing_time
-                        task.processing_time = float(kwargs['processing_time'])
-                        task.save(update_fields=['processing_time'])
+                        # 同时更新数据库中的processing_time（终态立即写入，中间状态合并后批量写回）
+                        if status in ['completed', 'failed']:
+                            task_status_buffer.write_through(task_id, processing_time=float(kwargs['processing_time']))
+                        else:
+                            task_status_buffer.record(task_id, processing_time=float(kwargs['processing_time']))
                     elif task.processing_time:
                         redis_data['processing_time'] = float(task.processing_time)
                 
@@ -893,6 +1401,11 @@ class QueueService:
                 # 保存到Redis - 使用统一的key格式
                 self.redis.hset('comfyui_task_status', task_id, json.dumps(redis_data))
                 logger.info(f"已更新Redis中任务 {task_id} 的状态为: {status}")
+
+            # 通知等待中的任务重新检查，并推送给订阅任务进度的客户端
+            task_event_bus.publish(task_id, status, user_id=task.user_id, **{
+                key: kwargs[key] for key in ('progress', 'queue_position', 'error_message') if key in kwargs
+            })
             
             # 3. 更新MySQL中的任务状态
             if not force_redis_update:
@@ -916,9 +1429,12 @@ class QueueService:
                         if key not in ['force_redis_update', 'force_mysql_update']:
                             mysql_data[key] = value
                     
-                    # 更新MySQL中的任务状态
-                    ComfyUITask.objects.filter(task_id=task_id).update(**mysql_data)
-                    logger.info(f"已更新MySQL中任务 {task_id} 的状态为: {status}")
+                    # 更新MySQL中的任务状态：终态立即写入，中间状态合并后批量写回
+                    if status in ['completed', 'failed', 'cancelled']:
+                        task_status_buffer.write_through(task_id, **mysql_data)
+                        logger.info(f"已更新MySQL中任务 {task_id} 的状态为: {status}")
+                    else:
+                        task_status_buffer.record(task_id, **mysql_data)
                 except Exception as e:
                     logger.error(f"更新MySQL状态失败: {str(e)}")
                     
@@ -949,19 +1465,22 @@ class QueueService:
                     
                     # 如果消费者线程未启动，启动它
                     if not self.consumer_thread or not self.consumer_thread.is_alive():
-                        self.consumer_thread = Thread(target=self._consume_tasks, daemon=True)
+                        self.consumer_thread = Thread(target=self._consumer_target(), daemon=True)
                         self.consumer_thread.start()
                         logger.info("已启动消费者线程")
                     else:
                         logger.info("消费者线程已在运行中")
+
+                    # Streams后端由消费组投递任务，直接出队会绕过待确认列表
+                    if self.use_streams:
+                        return
                         
                     # 尝试直接从队列中获取并处理一个任务，而不是等待消费者线程
                     try:
                         if self.is_redis_available:
-                            # 直接获取一个任务
-                            task_data = self.redis.lpop('comfyui_queue')
-                            if task_data:
-                                task = json.loads(task_data)
+                            # 直接获取优先级最高的任务
+                            task = self._pop_task()
+                            if task:
                                 task_id = task.get('task_id', '未知')
                                 logger.info(f"_trigger_task_processing 直接处理队列中的任务: {task_id}")
                                 # 启动一个新线程来处理任务，避免阻塞当前方法
@@ -992,18 +1511,12 @@ class QueueService:
 
             # 从Redis获取任务数据
             if self.is_redis_available:
-                # 遍历队列找到对应任务
-                queue_len = self.redis.llen('comfyui_queue')
-                for i in range(queue_len):
-                    task_data = self.redis.lindex('comfyui_queue', i)
-                    if task_data:
-                        task = json.loads(task_data)
-                        if task.get('task_id') == task_id:
-                            # 找到任务后，从队列中移除
-                            self.redis.lrem('comfyui_queue', 0, task_data)
-                            # 直接处理任务
-                            self._process_task(task)
-                            return
+                # 按任务ID直接从队列中取出
+                task = self._take_task(task_id)
+                if task:
+                    # 直接处理任务
+                    self._process_task(task)
+                    return
             else:
                 # 从本地队列中查找任务
                 for _ in range(self.local_queue.qsize()):
@@ -1032,7 +1545,7 @@ class QueueService:
         try:
             if self.consumer_thread is None or not self.consumer_thread.is_alive():
                 logger.info("启动消费者线程")
-                self.consumer_thread = Thread(target=self._consume_tasks, daemon=True)
+                self.consumer_thread = Thread(target=self._consumer_target(), daemon=True)
                 self.consumer_thread.start()
                 logger.info("消费者线程已启动")
                 
@@ -1041,7 +1554,7 @@ class QueueService:
                 if not self.consumer_thread.is_alive():
                     logger.error("消费者线程启动失败！")
                     # 尝试再次启动
-                    self.consumer_thread = Thread(target=self._consume_tasks, daemon=True)
+                    self.consumer_thread = Thread(target=self._consumer_target(), daemon=True)
                     self.consumer_thread.start()
                     logger.info("已重新尝试启动消费者线程")
             else:
@@ -1110,20 +1623,12 @@ class QueueService:
                 self.active_tasks[task_id] = stop_event
                 logger.info(f"已将任务 {task_id} 添加到活跃任务列表，当前活跃任务: {list(self.active_tasks.keys())}")
             
-            # 更新任务状态为处理中
-            self._update_task_status(
-                task_id, 
-                'processing',
-                started_at=timezone.now()
-            )
-            logger.info(f"已更新任务 {task_id} 状态为processing，准备调用consumer处理")
-            
             # 直接调用consumer处理任务 - 关键改进：不在锁内调用，避免长时间阻塞
             logger.info(f"开始调用{consumer_name}.process_task({task_id})...")
             
             try:
-                # 直接调用处理逻辑
-                result = self.consumer.process_task(task_item, stop_event)
+                # 由调度器分配后端后调用处理逻辑
+                result = self._process_on_backend(task_item, stop_event)
                 logger.info(f"处理完成，结果: {result}")
                 
                 # 更新任务状态标记为处理完成 - 这个逻辑正常应该在consumer中处理
@@ -1203,4 +1708,40 @@ class QueueService:
 
         except Exception as e:
             logger.error(f"获取任务 {task_id} 状态失败: {str(e)}")
-            return None
\ No newline at end of file
+            return None
+
+    def get_status_snapshots(self, task_ids: List[str]) -> Dict[str, Dict]:
+        """
+        批量读取comfyui_task_status中的任务状态快照（单次HMGET，只读）
+        :return: task_id -> 状态快照，不存在的任务不包含在结果中
+        """
+        if not task_ids or not self.is_redis_available:
+            return {}
+        snapshots = {}
+        try:
+            for task_id, raw in zip(task_ids, self.redis.hmget(self.STATUS_HASH_KEY, task_ids)):
+                if raw:
+                    try:
+                        snapshots[task_id] = json.loads(raw)
+                    except json.JSONDecodeError as e:
+                        logger.error(f"解析任务 {task_id} 的状态快照失败: {str(e)}")
+        except Exception as e:
+            logger.error(f"批量读取任务状态快照失败: {str(e)}")
+        return snapshots
+
+    def get_status_snapshot(self, task_id: str) -> Optional[Dict]:
+        """读取单个任务的状态快照（只读）"""
+        return self.get_status_snapshots([task_id]).get(task_id)
+
+    def cache_status_snapshot(self, task_id: str, snapshot: Dict) -> bool:
+        """
+        缓存未命中时回填任务状态快照，已有快照时不覆盖（避免覆盖并发写入的新状态）
+        :return: 是否写入
+        """
+        if not self.is_redis_available:
+            return False
+        try:
+            return bool(self.redis.hsetnx(self.STATUS_HASH_KEY, task_id, json.dumps(snapshot, default=str)))
+        except Exception as e:
+            logger.error(f"回填任务 {task_id} 的状态快照失败: {str(e)}")
+            return False
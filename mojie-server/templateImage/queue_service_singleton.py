@@ -46,6 +46,20 @@ def initialize_queue_service():
                     logger.error(f"启动队列服务消费者线程失败: {str(e)}")
                     return False
             
+            # 用数据库中的待处理任务重建队列排名索引
+            try:
+                from templateImage.task_utils import TaskUtils
+                TaskUtils._recalculate_queue_positions()
+            except Exception as e:
+                logger.warning(f"重建队列排名索引失败: {str(e)}")
+
+            # 启动任务状态写回线程
+            try:
+                from templateImage.task_status_buffer import task_status_buffer
+                task_status_buffer.start_flush_thread()
+            except Exception as e:
+                logger.warning(f"启动任务状态写回线程失败: {str(e)}")
+
             # 启动任务监控线程
             try:
                 from templateImage.task_status_monitor import start_monitoring_thread
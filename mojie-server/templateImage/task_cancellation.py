@@ -0,0 +1,134 @@
+"""
+任务取消信号模块
+通过Redis发布/订阅把取消请求直接送到正在执行该任务的进程，
+该进程立即中断ComfyUI中的prompt并释放后端名额，不再等待轮询取消标志
+"""
+import json
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+import redis
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+
+class TaskCancellationBus:
+    # 取消信号频道，消息为JSON: {"task_id", "reason", "timestamp"}
+    CHANNEL = 'comfyui_task_cancel'
+
+    def __init__(self, redis_host: str = 'localhost', redis_port: int = 6379):
+        self.redis = redis.StrictRedis(host=redis_host, port=redis_port, db=0, decode_responses=True)
+        self._handlers: Dict[str, Callable[[str], None]] = {}  # 本进程正在执行的任务 -> 取消处理函数
+        self._lock = threading.Lock()
+        self._listener_thread = None
+
+    @staticmethod
+    def cancel_flag_key(task_id: str) -> str:
+        return f"task:{task_id}:cancelled"
+
+    def publish(self, task_id: str, reason: Optional[str] = None) -> int:
+        """
+        发布取消信号
+        :return: 收到信号的订阅进程数
+        """
+        message = {'task_id': task_id, 'reason': reason, 'timestamp': time.time()}
+        try:
+            receivers = self.redis.publish(self.CHANNEL, json.dumps(message))
+            logger.info(f"已发布任务 {task_id} 的取消信号，{receivers} 个进程收到")
+            return receivers
+        except Exception as e:
+            logger.error(f"发布任务 {task_id} 的取消信号失败: {str(e)}")
+            return 0
+
+    def register(self, task_id: str, handler: Callable[[str], None]):
+        """
+        注册本进程正在执行的任务，收到该任务的取消信号时调用handler(task_id)
+        注册前已经设置了取消标志的任务立即触发handler
+        """
+        self._ensure_listener()
+        with self._lock:
+            self._handlers[task_id] = handler
+        if cache.get(self.cancel_flag_key(task_id)) == "true":
+            self._dispatch(task_id)
+
+    def unregister(self, task_id: str):
+        with self._lock:
+            self._handlers.pop(task_id, None)
+
+    def _dispatch(self, task_id: str):
+        """在独立线程中执行取消处理，避免阻塞订阅线程；每个任务只处理一次"""
+        with self._lock:
+            handler = self._handlers.pop(task_id, None)
+        if handler is None:
+            return
+
+        def run():
+            try:
+                handler(task_id)
+            except Exception as e:
+                logger.error(f"处理任务 {task_id} 的取消信号失败: {str(e)}")
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _ensure_listener(self):
+        """首次注册任务时启动订阅线程，每个进程只订阅一次"""
+        if self._listener_thread and self._listener_thread.is_alive():
+            return
+        with self._lock:
+            if self._listener_thread and self._listener_thread.is_alive():
+                return
+            self._listener_thread = threading.Thread(target=self._listen, daemon=True)
+            self._listener_thread.start()
+
+    def _recheck_flags(self):
+        """订阅（重连）成功后检查已注册任务的取消标志，弥补断线期间错过的信号"""
+        with self._lock:
+            task_ids = list(self._handlers)
+        for task_id in task_ids:
+            try:
+                if cache.get(self.cancel_flag_key(task_id)) == "true":
+                    self._dispatch(task_id)
+            except Exception as e:
+                logger.error(f"检查任务 {task_id} 的取消标志失败: {str(e)}")
+
+    def _listen(self):
+        """订阅取消信号频道，断线后以指数退避重连"""
+        retry_delay = 1
+        while True:
+            pubsub = None
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.CHANNEL)
+                logger.info(f"已订阅任务取消频道: {self.CHANNEL}")
+                retry_delay = 1
+                self._recheck_flags()
+                for message in pubsub.listen():
+                    if message.get('type') != 'message':
+                        continue
+                    try:
+                        task_id = json.loads(message['data']).get('task_id')
+                    except (TypeError, ValueError, AttributeError):
+                        continue
+                    if task_id and task_id in self._handlers:
+                        self._dispatch(task_id)
+            except Exception as e:
+                logger.error(f"任务取消订阅中断，{retry_delay} 秒后重连: {str(e)}")
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 30)
+            finally:
+                if pubsub:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+
+
+# 创建全局任务取消信号实例
+task_cancellation_bus = TaskCancellationBus(
+    redis_host=settings.REDIS_HOST,
+    redis_port=settings.REDIS_PORT
+)
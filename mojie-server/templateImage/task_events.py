@@ -0,0 +1,157 @@
+"""
+任务事件模块
+通过Redis发布/订阅广播任务状态变化，等待方只在有事件时才重新检查，替代定时轮询数据库；
+进度更新走单独的频道，只唤醒推送接口，不唤醒等待状态变化的调度和长轮询
+"""
+import json
+import logging
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class TaskEventBus:
+    # 任务事件频道，消息为JSON: {"task_id", "status", "timestamp", ...}
+    CHANNEL = 'comfyui_task_events'
+    # 任务进度频道，消息为JSON: {"task_id", "status", "progress", "timestamp"}
+    PROGRESS_CHANNEL = 'comfyui_task_progress'
+
+    def __init__(self, redis_host: str = 'localhost', redis_port: int = 6379, history_size: int = 1000):
+        self.redis = redis.StrictRedis(host=redis_host, port=redis_port, db=0, decode_responses=True)
+        lock = threading.Lock()
+        self._condition = threading.Condition(lock)  # 状态事件
+        self._update_condition = threading.Condition(lock)  # 状态事件和进度事件
+        self._version = 0  # 每收到一条状态事件加1，等待方据此判断是否有新事件
+        self._sequence = 0  # 每收到一条事件（含进度）加1，对应事件历史中的序号
+        self._history = deque(maxlen=history_size)  # 最近的事件 (序号, 事件)，供推送接口读取事件内容
+        self._listener_thread = None
+        self._listener_lock = threading.Lock()
+
+    @property
+    def version(self) -> int:
+        """当前事件版本号，应在检查状态之前获取，避免错过检查期间发生的事件"""
+        return self._version
+
+    @property
+    def sequence(self) -> int:
+        """当前事件序号（含进度事件），应在读取状态之前获取，用于events_since"""
+        return self._sequence
+
+    def publish(self, task_id: Optional[str], status: Optional[str] = None, **data):
+        """
+        发布任务事件
+        :param task_id: 任务ID
+        :param status: 任务状态
+        :param data: 其他事件数据
+        """
+        event = {'task_id': task_id, 'status': status, 'timestamp': time.time()}
+        event.update(data)
+        try:
+            self.redis.publish(self.CHANNEL, json.dumps(event, default=str))
+        except Exception as e:
+            logger.error(f"发布任务事件失败 ({task_id}, {status}): {str(e)}")
+
+    def publish_progress(self, task_id: str, progress: float):
+        """发布任务进度，只通知推送接口"""
+        event = {'task_id': task_id, 'status': 'processing', 'progress': progress, 'timestamp': time.time()}
+        try:
+            self.redis.publish(self.PROGRESS_CHANNEL, json.dumps(event))
+        except Exception as e:
+            logger.error(f"发布任务进度失败 ({task_id}, {progress}): {str(e)}")
+
+    def _notify(self, event: Optional[Dict] = None, progress: bool = False):
+        with self._condition:
+            self._sequence += 1
+            if event is not None:
+                self._history.append((self._sequence, event))
+            if not progress:
+                self._version += 1
+                self._condition.notify_all()
+            self._update_condition.notify_all()
+
+    def _ensure_listener(self):
+        """首次等待时启动订阅线程，每个进程只订阅一次"""
+        if self._listener_thread and self._listener_thread.is_alive():
+            return
+        with self._listener_lock:
+            if self._listener_thread and self._listener_thread.is_alive():
+                return
+            self._listener_thread = threading.Thread(target=self._listen, daemon=True)
+            self._listener_thread.start()
+
+    def _listen(self):
+        """订阅任务事件频道，断线后以指数退避重连"""
+        retry_delay = 1
+        while True:
+            pubsub = None
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.CHANNEL, self.PROGRESS_CHANNEL)
+                logger.info(f"已订阅任务事件频道: {self.CHANNEL}, {self.PROGRESS_CHANNEL}")
+                retry_delay = 1
+                # 重连期间可能错过事件，订阅成功后唤醒等待方重新检查一次
+                self._notify()
+                for message in pubsub.listen():
+                    if message.get('type') == 'message':
+                        try:
+                            event = json.loads(message['data'])
+                        except (TypeError, ValueError):
+                            event = None
+                        self._notify(event, progress=message.get('channel') == self.PROGRESS_CHANNEL)
+            except Exception as e:
+                logger.error(f"任务事件订阅中断，{retry_delay} 秒后重连: {str(e)}")
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 30)
+            finally:
+                if pubsub:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+
+    def wait_for_event(self, last_version: int, timeout: float) -> int:
+        """
+        阻塞等待，直到有新的任务状态事件或超时（进度事件不会唤醒）
+        :param last_version: 上次检查前获取的事件版本号
+        :param timeout: 最长等待时间（秒）
+        :return: 最新的事件版本号
+        """
+        self._ensure_listener()
+        with self._condition:
+            self._condition.wait_for(lambda: self._version != last_version, timeout=timeout)
+            return self._version
+
+    def wait_for_update(self, last_sequence: int, timeout: float) -> int:
+        """
+        阻塞等待，直到有新的任务事件（含进度事件）或超时，供推送接口使用
+        :param last_sequence: 上次读取时的事件序号
+        :param timeout: 最长等待时间（秒）
+        :return: 最新的事件序号
+        """
+        self._ensure_listener()
+        with self._update_condition:
+            self._update_condition.wait_for(lambda: self._sequence != last_sequence, timeout=timeout)
+            return self._sequence
+
+    def events_since(self, last_sequence: int) -> Tuple[List[Dict], bool, int]:
+        """
+        获取序号之后收到的事件
+        :param last_sequence: 上次读取时的事件序号
+        :return: (事件列表, 是否完整, 当前序号)；历史已被覆盖或订阅重连过时不完整，调用方应重新读取状态
+        """
+        with self._condition:
+            events = [event for sequence, event in self._history if sequence > last_sequence]
+            return events, len(events) == self._sequence - last_sequence, self._sequence
+
+
+# 创建全局任务事件总线实例
+task_event_bus = TaskEventBus(
+    redis_host=settings.REDIS_HOST,
+    redis_port=settings.REDIS_PORT
+)
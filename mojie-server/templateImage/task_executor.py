@@ -0,0 +1,198 @@
+"""
+任务执行器模块
+提供进程内共享的有界线程池，替代每个任务单独创建守护线程
+排队的任务按优先级由单个调度线程派发：任务可以附带准入检查（如后端有空闲名额、没有更高优先级的任务在等待），
+检查通过后才占用工作线程，工作线程从不阻塞等待其他排队的任务
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from django.conf import settings
+
+from templateImage.task_events import task_event_bus
+
+logger = logging.getLogger(__name__)
+
+
+class TaskExecutorSaturated(Exception):
+    """执行器已饱和（处理中和排队的任务均已达到上限）"""
+
+
+class _Job:
+    __slots__ = ('fn', 'args', 'kwargs', 'future', 'gate', 'gate_key', 'queued_at')
+
+    def __init__(self, fn, args, kwargs, gate, gate_key):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.gate = gate
+        self.gate_key = gate_key
+        self.queued_at = time.time()
+
+
+class BoundedTaskExecutor:
+    def __init__(self, max_workers: int = 8, max_queue: int = 200, name: str = 'comfyui-task',
+                 max_gate_wait: float = 3600, gate_recheck_interval: float = 30):
+        """
+        有界任务执行器：固定数量的工作线程加有界的优先级等待队列，饱和时拒绝新任务
+        :param max_workers: 工作线程数
+        :param max_queue: 等待队列容量（不含正在执行的任务）
+        :param name: 线程名前缀
+        :param max_gate_wait: 任务在队列中等待超过该时间（秒）后不再检查准入条件，直接派发
+        :param gate_recheck_interval: 没有任务事件时重新检查准入条件的间隔（秒）
+        """
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.max_gate_wait = max_gate_wait
+        self.gate_recheck_interval = gate_recheck_interval
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._name = name
+        self._condition = threading.Condition()
+        self._heap = []  # (优先级, 序号, _Job)，优先级数值越小越先派发
+        self._sequence = itertools.count()
+        self._changed = False  # 有新任务或工作线程空闲，调度线程需要重新检查
+        self._dispatcher_thread = None
+        self._submitted = 0
+        self._active = 0
+        self._completed = 0
+        self._rejected = 0
+
+    def has_capacity(self) -> bool:
+        """是否还能接收新任务"""
+        with self._condition:
+            return self._submitted - self._completed < self.max_workers + self.max_queue
+
+    def submit(self, fn: Callable, *args, priority: int = 0, gate: Optional[Callable[[], bool]] = None,
+               gate_key: Optional[Hashable] = None, **kwargs) -> Future:
+        """
+        提交任务，执行器饱和时抛出TaskExecutorSaturated
+        :param priority: 优先级，数值越小越先派发，相同优先级按提交顺序
+        :param gate: 准入检查函数，返回True时才派发到工作线程
+        :param gate_key: 准入检查结果的缓存键，同一轮调度中键相同的任务只检查一次
+        """
+        job = _Job(fn, args, kwargs, gate, gate_key)
+        with self._condition:
+            if self._submitted - self._completed >= self.max_workers + self.max_queue:
+                self._rejected += 1
+                raise TaskExecutorSaturated(
+                    f"任务执行器已饱和 (工作线程: {self.max_workers}, 队列容量: {self.max_queue})"
+                )
+            self._submitted += 1
+            heapq.heappush(self._heap, (priority, next(self._sequence), job))
+            self._changed = True
+            self._condition.notify_all()
+        self._ensure_dispatcher()
+        return job.future
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher_thread and self._dispatcher_thread.is_alive():
+            return
+        with self._condition:
+            if self._dispatcher_thread and self._dispatcher_thread.is_alive():
+                return
+            self._dispatcher_thread = threading.Thread(target=self._dispatch_loop, daemon=True,
+                                                       name=f"{self._name}-dispatcher")
+            self._dispatcher_thread.start()
+
+    def _select(self, entries) -> Optional[Any]:
+        """按优先级顺序找到第一个通过准入检查的任务"""
+        gate_results = {}
+        now = time.time()
+        for entry in entries:
+            job = entry[2]
+            if job.future.cancelled():
+                return entry
+            if job.gate is None or now - job.queued_at >= self.max_gate_wait:
+                if job.gate is not None:
+                    logger.warning(f"执行器任务等待准入超过 {self.max_gate_wait} 秒，强制派发")
+                return entry
+            key = job.gate_key if job.gate_key is not None else id(job)
+            if key not in gate_results:
+                try:
+                    gate_results[key] = job.gate()
+                except Exception as e:
+                    logger.error(f"执行器任务准入检查失败: {str(e)}")
+                    gate_results[key] = False
+            if gate_results[key]:
+                return entry
+        return None
+
+    def _wait_for_change(self, event_version: int):
+        """等待任务事件、本地提交或工作线程空闲，最长gate_recheck_interval秒"""
+        deadline = time.time() + self.gate_recheck_interval
+        while time.time() < deadline:
+            if task_event_bus.wait_for_event(event_version, timeout=0.2) != event_version:
+                return
+            with self._condition:
+                if self._changed:
+                    return
+
+    def _dispatch_loop(self):
+        while True:
+            try:
+                with self._condition:
+                    while not self._heap or self._active >= self.max_workers:
+                        self._condition.wait()
+                    self._changed = False
+                    entries = sorted(self._heap)
+
+                event_version = task_event_bus.version
+                entry = self._select(entries)
+                if entry is None:
+                    self._wait_for_change(event_version)
+                    continue
+
+                with self._condition:
+                    self._heap.remove(entry)
+                    heapq.heapify(self._heap)
+                    job = entry[2]
+                    if job.future.cancelled():
+                        self._completed += 1
+                        continue
+                    self._active += 1
+                self._executor.submit(self._run, job)
+            except Exception as e:
+                logger.error(f"执行器调度线程异常: {str(e)}")
+                time.sleep(1)
+
+    def _run(self, job: _Job):
+        try:
+            if job.future.set_running_or_notify_cancel():
+                try:
+                    job.future.set_result(job.fn(*job.args, **job.kwargs))
+                except BaseException as e:
+                    logger.error(f"执行器任务 {getattr(job.fn, '__name__', job.fn)} 异常: {str(e)}")
+                    job.future.set_exception(e)
+        finally:
+            with self._condition:
+                self._active -= 1
+                self._completed += 1
+                self._changed = True
+                self._condition.notify_all()
+
+    def get_stats(self) -> Dict[str, int]:
+        """获取执行器指标：活跃工作线程数、排队深度等"""
+        with self._condition:
+            return {
+                'max_workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'active_workers': self._active,
+                'queue_depth': len(self._heap),
+                'submitted': self._submitted,
+                'completed': self._completed,
+                'rejected': self._rejected,
+            }
+
+
+# 创建全局任务执行器实例
+task_executor = BoundedTaskExecutor(
+    max_workers=getattr(settings, 'COMFYUI_TASK_EXECUTOR_WORKERS', 8),
+    max_queue=getattr(settings, 'COMFYUI_TASK_EXECUTOR_QUEUE', 200),
+    gate_recheck_interval=getattr(settings, 'COMFYUI_TASK_WAIT_FALLBACK_INTERVAL', 30)
+)
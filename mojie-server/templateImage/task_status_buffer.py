@@ -0,0 +1,188 @@
+"""
+任务状态写回缓冲模块
+非终态的任务字段变化（进度、队列位置等）先合并暂存在Redis中，定期批量写回MySQL；终态立即写穿
+"""
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List
+
+import redis
+from django.conf import settings
+from django.db.models import Case, Value, When
+
+from templateImage.models import ComfyUITask
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = ['completed', 'failed', 'cancelled']
+
+
+class TaskStatusBuffer:
+    # 每个任务一个哈希，字段 -> JSON编码的最新值
+    BUFFER_KEY_PREFIX = 'comfyui_status_buffer'
+    # 有待写回数据的任务ID集合
+    DIRTY_KEY = 'comfyui_status_buffer:dirty'
+
+    def __init__(self, redis_host: str = 'localhost', redis_port: int = 6379):
+        self.redis = redis.StrictRedis(host=redis_host, port=redis_port, db=0, decode_responses=True)
+        self._flush_thread = None
+        self._flush_lock = threading.Lock()
+        self._model_fields = {field.name for field in ComfyUITask._meta.concrete_fields} - {'task_id'}
+
+    def _key(self, task_id: str) -> str:
+        return f"{self.BUFFER_KEY_PREFIX}:{task_id}"
+
+    @staticmethod
+    def _encode(value) -> str:
+        if isinstance(value, datetime):
+            return json.dumps({'__datetime__': value.isoformat()})
+        return json.dumps(value, default=str)
+
+    @staticmethod
+    def _decode(raw: str):
+        value = json.loads(raw)
+        if isinstance(value, dict) and '__datetime__' in value:
+            return datetime.fromisoformat(value['__datetime__'])
+        return value
+
+    def _model_updates(self, fields: Dict) -> Dict:
+        """只保留ComfyUITask上存在的字段"""
+        return {key: value for key, value in fields.items() if key in self._model_fields}
+
+    def record(self, task_id: str, **fields):
+        """
+        记录任务字段变化，同一任务的多次变化会合并为最新值，等待批量写回
+        终态变化会立即写穿
+        """
+        if fields.get('status') in TERMINAL_STATUSES:
+            self.write_through(task_id, **fields)
+            return
+        updates = self._model_updates(fields)
+        if not updates:
+            return
+        try:
+            pipe = self.redis.pipeline()
+            pipe.hset(self._key(task_id), mapping={key: self._encode(value) for key, value in updates.items()})
+            pipe.sadd(self.DIRTY_KEY, task_id)
+            pipe.execute()
+        except Exception as e:
+            # Redis不可用时直接写库，保证数据不丢失
+            logger.error(f"缓冲任务 {task_id} 的状态变化失败，直接写入MySQL: {str(e)}")
+            ComfyUITask.objects.filter(task_id=task_id).update(**updates)
+
+    def _take(self, task_id: str) -> Dict:
+        """原子地取出并清空任务的缓冲数据"""
+        pipe = self.redis.pipeline()
+        pipe.hgetall(self._key(task_id))
+        pipe.delete(self._key(task_id))
+        pipe.srem(self.DIRTY_KEY, task_id)
+        raw = pipe.execute()[0]
+        return {key: self._decode(value) for key, value in raw.items()}
+
+    def write_through(self, task_id: str, **fields) -> int:
+        """
+        立即写入MySQL（用于终态），同时带上该任务尚未写回的缓冲数据
+        :return: 更新的行数
+        """
+        updates = {}
+        try:
+            updates.update(self._take(task_id))
+        except Exception as e:
+            logger.error(f"读取任务 {task_id} 的缓冲数据失败: {str(e)}")
+        updates.update(self._model_updates(fields))
+        if not updates:
+            return 0
+        return ComfyUITask.objects.filter(task_id=task_id).update(**updates)
+
+    def flush(self, batch_size: int = 500) -> int:
+        """
+        将缓冲的变化批量写回MySQL
+        :return: 写回的任务数
+        """
+        flushed = 0
+        with self._flush_lock:
+            while True:
+                task_ids = self.redis.spop(self.DIRTY_KEY, batch_size)
+                if not task_ids:
+                    break
+
+                pipe = self.redis.pipeline()
+                for task_id in task_ids:
+                    pipe.hgetall(self._key(task_id))
+                    pipe.delete(self._key(task_id))
+                results = pipe.execute()
+                pending = {}
+                for task_id, raw in zip(task_ids, results[0::2]):
+                    if raw:
+                        pending[task_id] = {key: self._decode(value) for key, value in raw.items()}
+                if not pending:
+                    continue
+
+                try:
+                    flushed += self._apply(pending)
+                except Exception as e:
+                    logger.error(f"批量写回任务状态失败，重新放回缓冲区: {str(e)}")
+                    for task_id, updates in pending.items():
+                        self.record(task_id, **updates)
+                    break
+        return flushed
+
+    def _apply(self, pending: Dict[str, Dict]) -> int:
+        """将一批合并后的变化写入MySQL"""
+        # 包含状态变化的任务逐条有条件更新，避免覆盖期间已写入的终态
+        bulk = {}
+        for task_id, updates in pending.items():
+            if 'status' in updates:
+                ComfyUITask.objects.filter(task_id=task_id).exclude(status__in=TERMINAL_STATUSES).update(**updates)
+            else:
+                bulk[task_id] = updates
+
+        # 其余任务按字段组合分组，每组一条UPDATE … CASE语句；同样排除已结束的任务，
+        # 避免任务结束后才写回的进度覆盖终态时写入的值
+        groups: Dict[tuple, List[tuple]] = {}
+        for task_id, updates in bulk.items():
+            groups.setdefault(tuple(sorted(updates.keys())), []).append((task_id, updates))
+        for fields, items in groups.items():
+            for start in range(0, len(items), 500):
+                chunk = items[start:start + 500]
+                values = {}
+                for field in fields:
+                    output_field = ComfyUITask._meta.get_field(field)
+                    values[field] = Case(
+                        *[When(task_id=task_id, then=Value(updates[field], output_field=output_field))
+                          for task_id, updates in chunk],
+                        output_field=output_field
+                    )
+                ComfyUITask.objects.filter(task_id__in=[task_id for task_id, _ in chunk]).exclude(
+                    status__in=TERMINAL_STATUSES
+                ).update(**values)
+
+        logger.debug(f"已批量写回 {len(pending)} 个任务的状态变化")
+        return len(pending)
+
+    def _flush_loop(self):
+        interval = getattr(settings, 'COMFYUI_STATUS_FLUSH_INTERVAL', 5)
+        while True:
+            time.sleep(interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"定期写回任务状态失败: {str(e)}")
+
+    def start_flush_thread(self):
+        """启动定期写回线程"""
+        if self._flush_thread and self._flush_thread.is_alive():
+            return
+        self._flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flush_thread.start()
+        logger.info("任务状态写回线程已启动")
+
+
+# 创建全局任务状态缓冲实例
+task_status_buffer = TaskStatusBuffer(
+    redis_host=settings.REDIS_HOST,
+    redis_port=settings.REDIS_PORT
+)
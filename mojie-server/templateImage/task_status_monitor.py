@@ -2,7 +2,6 @@ import logging
 import time
 import json
 from datetime import timedelta
-import redis
 from threading import Thread
 from django.utils import timezone
 from celery import shared_task
@@ -11,6 +10,8 @@ from django.conf import settings
 from templateImage.models import ComfyUITask
 from templateImage.task_utils import TaskUtils
 from templateImage.queue_service_singleton import queue_service
+from templateImage.comfyui_dispatcher import comfyui_dispatcher
+from templateImage.task_events import task_event_bus
 
 logger = logging.getLogger(__name__)
 
@@ -54,66 +55,89 @@ def monitor_processing_tasks():
 
 @shared_task
 def full_task_status_sync():
-    """全量扫描所有任务，确保状态一致性"""
+    """全量扫描所有任务，确保状态一致性（按批读取Redis和数据库，批量写回）"""
     logger.info("开始全量扫描任务状态...")
     
     try:
-        redis_client = redis.StrictRedis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=0)
-        
+        terminal_statuses = ['completed', 'failed', 'cancelled']
+        chunk_size = getattr(settings, 'COMFYUI_RECOVERY_CHUNK_SIZE', 500)
+        timeout_threshold = timezone.now() - timedelta(hours=24)
+
         # 获取所有未完成的任务
-        pending_and_processing_tasks = ComfyUITask.objects.filter(
+        task_ids = list(ComfyUITask.objects.filter(
             status__in=['pending', 'processing']
-        ).order_by('created_at')
+        ).order_by('created_at').values_list('task_id', flat=True))
         
         processed_count = 0
         inconsistent_count = 0
         
-        for task in pending_and_processing_tasks:
-            # 检查任务创建时间，如果太久远（例如超过24小时），标记为失败
-            if (timezone.now() - task.created_at).total_seconds() > 86400:  # 24小时
-                logger.warning(f"任务 {task.task_id} 创建时间超过24小时，自动标记为失败")
-                TaskUtils._update_task_status(
-                    task.task_id,
-                    'failed',
-                    error_message='任务处理超时，系统自动取消',
-                    completed_at=timezone.now(),
-                    force_redis_update=True
-                )
-                processed_count += 1
-                continue
-                
-            # 检查Redis与数据库的状态一致性
+        for start in range(0, len(task_ids), chunk_size):
+            chunk = task_ids[start:start + chunk_size]
+            tasks = list(ComfyUITask.objects.filter(task_id__in=chunk, status__in=['pending', 'processing']))
+            redis_statuses = queue_service.get_status_snapshots([task.task_id for task in tasks])
+
+            terminal_tasks = []
+            timeout_tasks = []
+            db_snapshots = {}
+            for task in tasks:
+                # 检查任务创建时间，如果太久远（超过24小时），标记为失败
+                if task.created_at < timeout_threshold:
+                    logger.warning(f"任务 {task.task_id} 创建时间超过24小时，自动标记为失败")
+                    task.status = 'failed'
+                    task.error_message = '任务处理超时，系统自动取消'
+                    task.completed_at = timezone.now()
+                    timeout_tasks.append(task)
+                    db_snapshots[task.task_id] = json.dumps({
+                        'task_id': task.task_id,
+                        'status': task.status,
+                        'error_message': task.error_message,
+                        'completed_at': task.completed_at.isoformat(),
+                        'timestamp': time.time(),
+                        'from_source': 'full_sync',
+                        'priority': task.priority,
+                        'created_at': task.created_at.isoformat() if task.created_at else None,
+                    })
+                    continue
+
+                # 检查Redis与数据库的状态一致性
+                redis_status = redis_statuses.get(task.task_id)
+                if not redis_status or redis_status.get('status') == task.status:
+                    continue
+                logger.warning(f"任务 {task.task_id} 状态不一致: Redis={redis_status.get('status')}, DB={task.status}")
+                inconsistent_count += 1
+                # 优先以Redis中的终态为准
+                if redis_status.get('status') in terminal_statuses:
+                    queue_service._apply_redis_terminal_status(task, redis_status)
+                    if redis_status.get('error_message'):
+                        task.error_message = redis_status['error_message']
+                    terminal_tasks.append(task)
+                else:
+                    # 如果Redis不是终态，以数据库为准
+                    db_snapshots[task.task_id] = json.dumps({
+                        'task_id': task.task_id,
+                        'status': task.status,
+                        'timestamp': time.time(),
+                        'from_source': 'full_sync',
+                        'priority': task.priority,
+                        'created_at': task.created_at.isoformat() if task.created_at else None,
+                    })
+
             try:
-                redis_status_data = redis_client.hget('comfyui_task_status', task.task_id)
-                if redis_status_data:
-                    redis_status = json.loads(redis_status_data)
-                    db_status = task.status
-                    
-                    # 如果状态不一致，进行同步
-                    if redis_status.get('status') != db_status:
-                        logger.warning(f"任务 {task.task_id} 状态不一致: Redis={redis_status.get('status')}, DB={db_status}")
-                        inconsistent_count += 1
-                        # 优先以Redis中的终态为准
-                        if redis_status.get('status') in ['completed', 'failed', 'cancelled']:
-                            TaskUtils._update_task_status(
-                                task.task_id,
-                                redis_status.get('status'),
-                                output_data=redis_status.get('output_data'),
-                                error_message=redis_status.get('error_message'),
-                                completed_at=timezone.now() if not task.completed_at else task.completed_at,
-                                force_redis_update=False  # 不更新Redis
-                            )
-                        else:
-                            # 如果Redis不是终态，以数据库为准
-                            status_data = {
-                                'task_id': task.task_id,
-                                'status': task.status,
-                                'timestamp': time.time(),
-                                'from_source': 'full_sync'
-                            }
-                            redis_client.hset('comfyui_task_status', task.task_id, json.dumps(status_data))
+                if terminal_tasks or timeout_tasks:
+                    queue_service._bulk_save_terminal_statuses(terminal_tasks + timeout_tasks,
+                                                               extra_fields=['error_message'])
+                    for task in terminal_tasks + timeout_tasks:
+                        comfyui_dispatcher.release(task.task_id)
+                        TaskUtils.sync_record_status(task.task_id, force=True)
+                    processed_count += len(timeout_tasks)
+                if db_snapshots:
+                    queue_service.redis.hset(queue_service.STATUS_HASH_KEY, mapping=db_snapshots)
+                # 超时任务的终态由此处写入，需通知等待方和推送接口
+                for task in timeout_tasks:
+                    task_event_bus.publish(task.task_id, task.status, user_id=task.user_id,
+                                           error_message=task.error_message)
             except Exception as e:
-                logger.error(f"检查任务 {task.task_id} 状态一致性失败: {str(e)}", exc_info=True)
+                logger.error(f"批量修复任务状态失败 ({len(chunk)} 个任务): {str(e)}", exc_info=True)
         
         logger.info(f"全量扫描任务状态完成，已处理 {processed_count} 个超时任务，修复 {inconsistent_count} 个状态不一致任务")
         return f"已处理 {processed_count} 个超时任务，修复 {inconsistent_count} 个状态不一致任务"
@@ -121,6 +145,14 @@ def full_task_status_sync():
         logger.error(f"全量扫描任务状态失败: {str(e)}", exc_info=True)
         return f"全量扫描任务状态失败: {str(e)}"
 
+@shared_task
+def reconcile_task_statuses():
+    """修正任务状态（状态查询接口只读，写回由此任务完成）"""
+    result = TaskUtils.reconcile_task_statuses()
+    if result['completed'] or result['synced']:
+        logger.info(f"任务状态修正完成: 转为completed {result['completed']} 个，同步Redis状态 {result['synced']} 个")
+    return result
+
 def start_monitoring_thread():
     """启动一个后台线程，定期检查活跃任务状态"""
     def _check_active_tasks_loop():
@@ -135,10 +167,23 @@ def start_monitoring_thread():
                 logger.error(f"检查活跃任务状态失败: {str(e)}", exc_info=True)
                 time.sleep(10)  # 出错后稍等一会再继续
     
+    def _reconcile_loop():
+        interval = getattr(settings, 'COMFYUI_STATUS_RECONCILE_INTERVAL', 10)
+        while True:
+            time.sleep(interval)
+            try:
+                reconcile_task_statuses()
+            except Exception as e:
+                logger.error(f"修正任务状态失败: {str(e)}", exc_info=True)
+
     monitor_thread = Thread(target=_check_active_tasks_loop, daemon=True)
     monitor_thread.start()
     logger.info("活跃任务监控线程已启动")
 
+    reconcile_thread = Thread(target=_reconcile_loop, daemon=True)
+    reconcile_thread.start()
+    logger.info("任务状态修正线程已启动")
+
 def _check_active_tasks_status():
     """检查所有活跃任务的状态，处理可能卡住的任务"""
     if not queue_service:
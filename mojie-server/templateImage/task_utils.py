@@ -1,3 +1,4 @@
+import hashlib
 import logging
 import time
 import uuid
@@ -10,6 +11,7 @@ import urllib.request
 import json
 import os
 from django.db import transaction
+from django.db.models import Case, When, Value, IntegerField, Q
 from common.ErrorCode import ErrorCode
 from common.volcengine_tos_utils import VolcengineTOSUtils
 from exception.business_exception import BusinessException
@@ -17,13 +19,16 @@ from order.models import UserVIP
 from templateImage.queue_service import QueueService
 from templateImage.models import templateImage, ComfyUITask, ImageUploadRecord, ConversationList
 from django.conf import settings
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone as dt_timezone
 
 from templateImage.workflowUtils import ComfyUIHelper
 from user.models import SysUser
 
 # 导入单例模块中的queue_service实例
 from templateImage.queue_service_singleton import queue_service
+from templateImage.comfyui_dispatcher import comfyui_dispatcher
+from templateImage.task_executor import task_executor, TaskExecutorSaturated
+from templateImage.task_cancellation import task_cancellation_bus
 
 # 获取logger
 logger = logging.getLogger(__name__)
@@ -126,6 +131,15 @@ class TaskUtils:
                     errors="您在队列中的任务已满！"
                 )
 
+            # 1.1 检查任务执行器是否饱和，饱和时直接拒绝，避免无限制地堆积任务
+            if not task_executor.has_capacity():
+                logger.warning(f"任务执行器已饱和，拒绝新任务: {task_executor.get_stats()}")
+                raise BusinessException(
+                    error_code=ErrorCode.SYSTEM_ERROR,
+                    data=None,
+                    errors="当前排队任务过多，请稍后再试！"
+                )
+
             # 2. 验证优先级
             if priority not in [TaskUtils.PRIORITY_LOW, TaskUtils.PRIORITY_MEDIUM, TaskUtils.PRIORITY_HIGH]:
                 priority = TaskUtils.PRIORITY_MEDIUM
@@ -173,15 +187,12 @@ class TaskUtils:
             queue_service.add_task(
                 task_id=task_id,
                 task_type=task_type,
-                task_data=task_data
+                task_data=task_data,
+                priority=priority
             )
 
-            # 8. 启动异步处理
-            threading.Thread(
-                target=TaskUtils._process_task_async,
-                args=(task_id, task_type, task_data),
-                daemon=True
-            ).start()
+            # 8. 提交到共享任务执行器异步处理
+            TaskUtils._submit_task_processing(task_id, task_type, task_data, priority)
 
             # 9. 返回任务信息
             return {
@@ -203,6 +214,25 @@ class TaskUtils:
                 errors=str(e)
             )
 
+    @staticmethod
+    def _submit_task_processing(task_id: str, task_type: str, task_data: Dict, priority: Optional[str] = None):
+        """
+        将任务提交到共享的有界执行器处理
+        执行器按优先级排队，后端有空闲名额且没有更高优先级的任务等待时才派发到工作线程
+        执行器饱和时任务仍保留在队列服务中，由队列消费者后续处理
+        """
+        priority = priority or TaskUtils.PRIORITY_MEDIUM
+        server_address = task_data.get('server_address')
+        try:
+            task_executor.submit(
+                TaskUtils._process_task_async, task_id, task_type, task_data,
+                priority=TaskUtils.PRIORITY_MAP.get(priority, 999),
+                gate=lambda: TaskUtils._ready_to_dispatch(priority, server_address),
+                gate_key=(priority, server_address)
+            )
+        except TaskExecutorSaturated as e:
+            logger.warning(f"任务 {task_id} 未能提交到执行器，保留在队列中等待队列消费者处理: {str(e)}")
+
     @staticmethod
     def _get_queue_position(task_id: str, priority: str) -> int:
         """
@@ -212,132 +242,109 @@ class TaskUtils:
         :return: 队列位置 (从1开始)
         """
         try:
-            # 获取所有待处理任务
-            pending_tasks = ComfyUITask.objects.filter(status='pending')
-
-            # 按优先级和创建时间排序
-            sorted_tasks = sorted(
-                pending_tasks,
-                key=lambda t: (TaskUtils.PRIORITY_MAP.get(t.priority, 999), t.created_at)
-            )
-
-            # 查找当前任务位置
-            for i, task in enumerate(sorted_tasks):
-                if task.task_id == task_id:
-                    return i + 1  # 返回1-based索引
-
-            # 如果找不到任务，返回队列末尾
-            return len(sorted_tasks)
+            # 优先从Redis排名索引读取，O(log n)
+            position = queue_service.get_pending_rank(task_id)
+            if position is None:
+                # 索引中没有该任务（如刚创建或索引丢失），补录后再读取
+                task = ComfyUITask.objects.filter(task_id=task_id, status='pending').only('task_id', 'created_at').first()
+                if task:
+                    queue_service.track_pending_rank(task_id, priority, task.created_at)
+                    position = queue_service.get_pending_rank(task_id)
+            if position is None:
+                # Redis不可用时退化为一次计数查询
+                position = ComfyUITask.objects.filter(status='pending').count()
+            return position
         except Exception as e:
             logger.error(f"计算队列位置失败: {str(e)}")
             return 0  # 出错时返回0
 
-    @staticmethod
-    def _wait_for_higher_priority_tasks(task_id: str, priority: str):
-        """
-        等待当前正在处理的任务完成，并确保高优先级任务在队列前面
-        :param task_id: 当前任务ID
-        :param priority: 当前任务优先级
-        """
-        try:
-            # 获取当前任务优先级值
-            current_priority_value = TaskUtils.PRIORITY_MAP.get(priority, 999)
-            logger.info(f"任务 {task_id} 正在检查其他任务状态，当前任务优先级: {priority}({current_priority_value})")
-
-            # 循环检查是否有任务正在处理中
-            wait_count = 0
-            max_wait_attempts = 3600  # 最多等待30分钟 (1800次, 每次1秒)
-            while wait_count < max_wait_attempts:
-                # 获取所有处理中的任务，不包括当前任务
-                processing_tasks = ComfyUITask.objects.filter(status='processing').exclude(task_id=task_id)
-
-                # 如果有任务正在处理，检查它们是否真的在处理中
-                if processing_tasks.exists():
-                    processing_task_ids = [t.task_id for t in processing_tasks]
-                    if wait_count % 10 == 0:  # 每10秒记录一次日志
-                        logger.info(f"任务 {task_id} 等待中: 有 {processing_tasks.count()} 个任务正在处理中: {processing_task_ids}")
-
-                    # 检查每个处理中的任务是否真的在处理中
-                    for task in processing_tasks:
-                        try:
-                            # 获取任务的最新状态
-                            task_status = TaskUtils.get_task_status(task.task_id)
-                            
-                            # 检查任务是否有结果
-                            has_results = False
-                            if task_status:
-                                if 'image_urls' in task_status and task_status['image_urls']:
-                                    has_results = True
-                                elif 'output_data' in task_status and task_status['output_data']:
-                                    output_data = task_status['output_data']
-                                    if isinstance(output_data, dict) and 'image_urls' in output_data and output_data['image_urls']:
-                                        has_results = True
-
-                            # 如果任务有结果但状态不是completed，更新状态
-                            if has_results:
-                                logger.info(f"发现任务 {task.task_id} 有结果但状态为 {task.status}，立即修复")
-                                TaskUtils._update_task_status(
-                                    task.task_id,
-                                    'completed',
-                                    force_redis_update=True,
-                                    output_data=task_status.get('output_data'),
-                                    completed_at=timezone.now()
-                                )
-                                continue
-
-                            # 如果任务处理时间超过10分钟还没有结果，标记为失败
-                            if task.started_at and (timezone.now() - task.started_at).total_seconds() > 600:
-                                logger.warning(f"任务 {task.task_id} 处理超过10分钟无结果，标记为失败")
-                                TaskUtils._update_task_status(
-                                    task.task_id,
-                                    'failed',
-                                    force_redis_update=True,
-                                    error_message='任务处理超时，系统自动取消',
-                                    completed_at=timezone.now()
-                                )
-                                continue
-
-                        except Exception as e:
-                            logger.error(f"检查任务 {task.task_id} 时出错: {str(e)}")
+    # 上次修复卡住的处理中任务的时间
+    _last_repair_time = 0
 
-                    # 重新获取处理中的任务数量
-                    processing_tasks = ComfyUITask.objects.filter(status='processing').exclude(task_id=task_id)
-                    if processing_tasks.exists():
-                        time.sleep(1)
-                        wait_count += 1
-                        continue
+    @staticmethod
+    def _repair_stuck_processing_tasks():
+        """检查处理中的任务是否真的在处理中：有结果的标记为完成，超过10分钟无结果的标记为失败"""
+        processing_tasks = ComfyUITask.objects.filter(status='processing')
+        logger.info(f"后端已满载: 有 {len(processing_tasks)} 个任务正在处理中: "
+                    f"{[t.task_id for t in processing_tasks]}")
+
+        # 检查每个处理中的任务是否真的在处理中
+        for task in processing_tasks:
+            try:
+                # 获取任务的最新状态
+                task_status = TaskUtils.get_task_status(task.task_id)
 
-                # 如果没有正在处理的任务，检查队列中的任务优先级
-                pending_tasks = ComfyUITask.objects.filter(status='pending').exclude(task_id=task_id).order_by(
-                    'priority', 'created_at'
-                )
+                # 检查任务是否有结果
+                has_results = False
+                if task_status:
+                    if 'image_urls' in task_status and task_status['image_urls']:
+                        has_results = True
+                    elif 'output_data' in task_status and task_status['output_data']:
+                        output_data = task_status['output_data']
+                        if isinstance(output_data, dict) and 'image_urls' in output_data and output_data['image_urls']:
+                            has_results = True
 
-                # 检查是否有更高优先级的任务在等待
-                has_higher_priority = False
-                for task in pending_tasks:
-                    task_priority_value = TaskUtils.PRIORITY_MAP.get(task.priority, 999)
-                    if task_priority_value < current_priority_value:
-                        has_higher_priority = True
-                        if wait_count % 10 == 0:  # 每10秒记录一次日志
-                            logger.info(f"任务 {task_id} 等待中: 有优先级更高的任务 {task.task_id} (优先级: {task.priority}({task_priority_value}))")
-                        break
-
-                # 如果有更高优先级的任务，继续等待
-                if has_higher_priority:
-                    time.sleep(1)
-                    wait_count += 1
+                # 如果任务有结果但状态不是completed，更新状态
+                if has_results:
+                    logger.info(f"发现任务 {task.task_id} 有结果但状态为 {task.status}，立即修复")
+                    TaskUtils._update_task_status(
+                        task.task_id,
+                        'completed',
+                        force_redis_update=True,
+                        output_data=task_status.get('output_data'),
+                        completed_at=timezone.now()
+                    )
                     continue
 
-                # 如果没有正在处理的任务，也没有更高优先级的任务，可以开始处理当前任务
-                logger.info(f"任务 {task_id} 检查完成: 没有正在处理的任务或更高优先级的任务，开始处理")
-                break
+                # 如果任务处理时间超过10分钟还没有结果，标记为失败
+                if task.started_at and (timezone.now() - task.started_at).total_seconds() > 600:
+                    logger.warning(f"任务 {task.task_id} 处理超过10分钟无结果，标记为失败")
+                    TaskUtils._update_task_status(
+                        task.task_id,
+                        'failed',
+                        force_redis_update=True,
+                        error_message='任务处理超时，系统自动取消',
+                        completed_at=timezone.now()
+                    )
+                    continue
 
-            # 如果达到最大等待次数，记录警告但仍继续执行
-            if wait_count >= max_wait_attempts:
-                logger.warning(f"任务 {task_id} 等待超时，强制开始处理")
+            except Exception as e:
+                logger.error(f"检查任务 {task.task_id} 时出错: {str(e)}")
 
+    @staticmethod
+    def _ready_to_dispatch(priority: str, server_address: Optional[str] = None) -> bool:
+        """
+        任务执行器的准入检查：可用的ComfyUI后端有空闲名额，且没有更高优先级的任务在等待
+        由执行器的调度线程按优先级顺序调用，工作线程不再阻塞等待
+        :param priority: 任务优先级
+        :param server_address: 任务配置的ComfyUI服务器地址
+        """
+        try:
+            # 后端都已满载时，定期检查处理中的任务是否真的在处理中
+            if not comfyui_dispatcher.has_capacity(server_address):
+                fallback_interval = getattr(settings, 'COMFYUI_TASK_WAIT_FALLBACK_INTERVAL', 30)
+                if time.time() - TaskUtils._last_repair_time < fallback_interval:
+                    return False
+                TaskUtils._last_repair_time = time.time()
+                TaskUtils._repair_stuck_processing_tasks()
+                # 修复卡住的任务会释放后端名额，重新检查是否有空闲名额
+                if not comfyui_dispatcher.has_capacity(server_address):
+                    return False
+
+            # 有空闲名额时，检查是否有更高优先级的任务在等待（单次查询）
+            current_priority_value = TaskUtils.PRIORITY_MAP.get(priority, 999)
+            higher_priorities = [p for p, value in TaskUtils.PRIORITY_MAP.items() if value < current_priority_value]
+            if higher_priorities:
+                higher_task = ComfyUITask.objects.filter(
+                    status='pending', priority__in=higher_priorities
+                ).only('task_id', 'priority').first()
+                if higher_task:
+                    logger.info(f"优先级 {priority} 的任务等待中: 有优先级更高的任务 {higher_task.task_id} (优先级: {higher_task.priority})")
+                    return False
+            return True
         except Exception as e:
-            logger.error(f"等待其他任务完成时出错: {str(e)}")
+            logger.error(f"检查任务准入条件时出错: {str(e)}")
+            return True
 
     @staticmethod
     def _process_task_async(task_id: str, task_type: str, task_data: Dict):
@@ -381,9 +388,7 @@ class TaskUtils:
             )
             logger.info(f"任务 {task_id} 已更新状态为等待中，正在等待其他任务完成")
 
-            # 2. 等待其他任务完成
-            TaskUtils._wait_for_higher_priority_tasks(task_id, task.priority)
-
+            # 2. 执行器已在后端有空闲名额且没有更高优先级的任务等待时才派发本任务
             # 3. 再次检查任务状态，确保任务仍然存在且未被取消
             task = ComfyUITask.objects.filter(task_id=task_id).first()
             if not task:
@@ -400,82 +405,21 @@ class TaskUtils:
                 logger.info(f"任务 {task_id} 状态已改变为 {task.status}，停止处理")
                 return
 
-            # 在更新状态为处理中之前，添加一个额外的检查点
-            def ensure_single_processing_task():
-                # 获取所有处理中的任务
-                processing_tasks = ComfyUITask.objects.filter(status='processing')
-                
-                # 如果当前任务已经在处理中，直接返回
-                if task.status == 'processing':
-                    return True
-                    
-                # 如果有其他任务正在处理
-                if processing_tasks.exists():
-                    for other_task in processing_tasks:
-                        if other_task.task_id != task_id:
-                            try:
-                                # 获取任务的最新状态
-                                task_status = TaskUtils.get_task_status(other_task.task_id)
-                                
-                                # 检查任务是否真的在处理中
-                                if task_status and task_status.get('status') == 'processing':
-                                    # 检查任务是否有结果
-                                    has_results = False
-                                    if 'image_urls' in task_status and task_status['image_urls']:
-                                        has_results = True
-                                    elif 'output_data' in task_status and task_status['output_data']:
-                                        output_data = task_status['output_data']
-                                        if isinstance(output_data, dict) and 'image_urls' in output_data and output_data['image_urls']:
-                                            has_results = True
-                                
-                                    # 如果任务有结果，更新状态为completed
-                                    if has_results:
-                                        logger.info(f"发现任务 {other_task.task_id} 有结果但状态为processing，立即修复")
-                                        TaskUtils._update_task_status(
-                                            other_task.task_id,
-                                            'completed',
-                                            force_redis_update=True,
-                                            output_data=task_status.get('output_data'),
-                                            completed_at=timezone.now()
-                                        )
-                                        continue
-                                
-                                    # 如果任务处理时间超过10分钟，标记为失败
-                                    if other_task.started_at and (timezone.now() - other_task.started_at).total_seconds() > 600:
-                                        logger.warning(f"任务 {other_task.task_id} 处理超过10分钟，标记为失败")
-                                        TaskUtils._update_task_status(
-                                            other_task.task_id,
-                                            'failed',
-                                            force_redis_update=True,
-                                            error_message='任务处理超时，系统自动取消',
-                                            completed_at=timezone.now()
-                                        )
-                                        continue
-                                
-                                    # 如果任务确实在处理中，返回False
-                                    return False
-                            except Exception as e:
-                                logger.error(f"检查任务 {other_task.task_id} 时出错: {str(e)}")
-                                continue
-                return True
-
-            # 在更新状态为处理中之前，确保没有其他任务在处理中
-            max_retries = 3
-            retry_count = 0
-            while retry_count < max_retries:
-                if ensure_single_processing_task():
-                    break
-                retry_count += 1
-                if retry_count < max_retries:
-                    logger.info(f"等待其他任务完成，重试 {retry_count}/{max_retries}")
-                    time.sleep(2)  # 等待2秒后重试
-            
-            if retry_count >= max_retries:
-                logger.warning(f"任务 {task_id} 等待其他任务完成超时，强制开始处理")
+            # 在更新状态为处理中之前，由调度器分配一个空闲的ComfyUI后端（所有后端已满时等待）
+            backend = comfyui_dispatcher.acquire(
+                task_id,
+                task_data.get('server_address'),
+                cancel_check=lambda: cache.get(cache_key) == "true"
+            )
+            if not backend:
+                logger.info(f"任务 {task_id} 已被取消，停止处理")
+                return
+            task_data['server_address'] = backend
 
             # 再次检查任务是否已被取消
             if cache.get(cache_key) == "true":
                 logger.info(f"任务 {task_id} 已被取消，停止处理")
+                comfyui_dispatcher.release(task_id)
                 return
 
             # 4. 更新任务状态为处理中 
@@ -506,6 +450,14 @@ class TaskUtils:
                 # 添加优先级到任务数据中
                 task_data['priority'] = task.priority
 
+                # 订阅本任务的取消信号：在任意进程取消时立即中断ComfyUI中的prompt并释放后端名额
+                def on_cancel(cancelled_task_id):
+                    stop_event.set()
+                    consumer.cancel_task(cancelled_task_id)
+                    comfyui_dispatcher.release(cancelled_task_id)
+
+                task_cancellation_bus.register(task_id, on_cancel)
+
                 # 执行任务
                 result = consumer.process_task(
                     {'task_id': task_id, 'data': task_data},
@@ -575,6 +527,10 @@ class TaskUtils:
                     completed_at=timezone.now()
                 )
                 raise
+            finally:
+                task_cancellation_bus.unregister(task_id)
+                # ComfyUI执行结束即释放后端，结果上传不占用GPU名额
+                comfyui_dispatcher.release(task_id)
 
         except Exception as e:
             # 检查任务是否已被取消
@@ -597,8 +553,6 @@ class TaskUtils:
                 error_message=str(e),
                 completed_at=timezone.now()
             )
-            # 任务失败后，重新计算其他任务的队列位置
-            TaskUtils._recalculate_queue_positions()
             raise BusinessException(
                 error_code=ErrorCode.SYSTEM_ERROR,
                 data=None,
@@ -607,86 +561,32 @@ class TaskUtils:
 
     @staticmethod
     def _recalculate_queue_positions():
-        """重新计算所有待处理任务的队列位置，考虑任务等待时间因素"""
+        """
+        全量重建队列位置：用数据库中的待处理任务重建Redis排名索引，并用一条UPDATE … CASE语句写回queue_position
+        日常的位置变化由排名索引在入队/出队时增量维护，此方法仅用于启动或索引修复
+        """
         try:
-            # 获取所有待处理任务
-            pending_tasks = ComfyUITask.objects.filter(status='pending')
-            
-            if not pending_tasks.exists():
-                return
+            pending_tasks = list(ComfyUITask.objects.filter(status='pending').values('task_id', 'priority', 'created_at'))
 
-            # 计算等待时间 - 当前时间减去创建时间
-            now = timezone.now()
-            
-            # 找出等待时间最长的任务
-            max_waiting_time = 0
-            for task in pending_tasks:
-                if task.created_at:
-                    waiting_time = (now - task.created_at).total_seconds()
-                    max_waiting_time = max(max_waiting_time, waiting_time)
-            
-            # 设置等待时间阈值（10分钟）- 超过这个时间的任务开始获得优先级提升
-            waiting_threshold = 10 * 60  # 10分钟，单位为秒
-            
-            # 计算每个任务的有效优先级
-            tasks_with_priority = []
-            for task in pending_tasks:
-                # 原始优先级值（数字越小优先级越高）
-                base_priority = TaskUtils.PRIORITY_MAP.get(task.priority, 999)
-                
-                # 计算等待时间
-                waiting_time = 0
-                if task.created_at:
-                    waiting_time = (now - task.created_at).total_seconds()
-                
-                # 计算等待因子 - 任务等待时间超过阈值后，根据等待时间提升优先级
-                waiting_factor = 0
-                if waiting_time > waiting_threshold:
-                    # 计算等待时间与最长等待时间的比例，最大提升到最高优先级
-                    if max_waiting_time > waiting_threshold:
-                        waiting_factor = min(3, (waiting_time - waiting_threshold) / 
-                                           (max_waiting_time - waiting_threshold) * 3)
-                    else:
-                        waiting_factor = 1  # 至少提供一些优先级提升
-                
-                # 综合优先级 - 原始优先级减去等待因子（数值越小优先级越高）
-                effective_priority = base_priority - waiting_factor
-                
-                tasks_with_priority.append({
-                    'task': task,
-                    'base_priority': base_priority,
-                    'waiting_time': waiting_time,
-                    'waiting_factor': waiting_factor,
-                    'effective_priority': effective_priority
-                })
-            
-            # 按有效优先级和创建时间排序
-            sorted_tasks = sorted(
-                tasks_with_priority,
-                key=lambda t: (t['effective_priority'], t['task'].created_at)
-            )
+            # 重建排名索引
+            queue_service.rebuild_pending_rank(pending_tasks)
 
-            # 记录任务优先级变化并更新队列位置
-            for i, task_info in enumerate(sorted_tasks):
-                task = task_info['task']
-                queue_position = i + 1
-                
-                # 更新队列位置
-                TaskUtils._update_task_queue_position(task.task_id, queue_position)
-                
-                # 如果有优先级提升，记录日志
-                if task_info['waiting_factor'] > 0:
-                    waiting_minutes = task_info['waiting_time'] / 60
-                    logger.info(f"任务 {task.task_id} 等待时间 {waiting_minutes:.1f} 分钟，"
-                                f"原始优先级: {task.priority}({task_info['base_priority']}), "
-                                f"等待因子: {task_info['waiting_factor']:.2f}, "
-                                f"有效优先级: {task_info['effective_priority']:.2f}, "
-                                f"新队列位置: {queue_position}")
+            # 按与索引相同的分值计算位置，一次性写回数据库
+            if pending_tasks:
+                sorted_tasks = sorted(
+                    pending_tasks,
+                    key=lambda t: queue_service._rank_score(t['priority'], t['created_at'])
+                )
+                ComfyUITask.objects.filter(task_id__in=[t['task_id'] for t in sorted_tasks]).update(
+                    queue_position=Case(
+                        *[When(task_id=t['task_id'], then=Value(i + 1)) for i, t in enumerate(sorted_tasks)],
+                        output_field=IntegerField()
+                    )
+                )
 
             # 设置处理中任务的队列位置为0
-            processing_tasks = ComfyUITask.objects.filter(status='processing')
-            for task in processing_tasks:
-                TaskUtils._update_task_queue_position(task.task_id, 0)
+            ComfyUITask.objects.filter(status='processing').exclude(queue_position=0).update(queue_position=0)
+            logger.info(f"已重建队列位置，待处理任务数: {len(pending_tasks)}")
 
         except Exception as e:
             logger.error(f"重新计算队列位置失败: {str(e)}", exc_info=True)
@@ -754,9 +654,9 @@ class TaskUtils:
                 task.save()
                 logger.info(f"任务 {task_id} 状态已直接更新为: {status}")
 
-            # 重新计算队列位置
+            # 释放后端名额（队列位置由排名索引增量维护，无需重新计算）
             if status in ['completed', 'failed', 'cancelled']:
-                TaskUtils._recalculate_queue_positions()
+                comfyui_dispatcher.release(task_id)
 
             # 如果任务完成或失败，同步更新相关记录
             if status in ['completed', 'failed', 'cancelled']:
@@ -905,7 +805,10 @@ class TaskUtils:
                     status_info['status'] = 'completed'
 
             # 5. 添加其他字段
-            if task.queue_position is not None:
+            if task.status == 'pending':
+                # 待处理任务的位置实时从排名索引读取
+                status_info['queue_position'] = TaskUtils._get_queue_position(task_id, task.priority)
+            elif task.queue_position is not None:
                 status_info['queue_position'] = task.queue_position
             if task.progress is not None:
                 status_info['progress'] = task.progress
@@ -957,6 +860,166 @@ class TaskUtils:
                 'error': str(e)
             }
 
+    # 状态快照中需要从数据库读取的字段
+    SNAPSHOT_DB_FIELDS = [
+        'status', 'priority', 'created_at', 'updated_at', 'started_at', 'completed_at', 'queue_position',
+        'progress', 'processing_time', 'error_message', 'input_data', 'output_data'
+    ]
+
+    @staticmethod
+    def get_task_status_snapshot(task_id: str) -> Dict:
+        """
+        只读获取任务状态快照，供高频轮询的状态查询使用
+        优先读取Redis中的状态快照，未命中时单次按task_id读取MySQL并回填Redis；不会写入MySQL
+        状态修正（Redis终态同步到MySQL、有结果的任务转为completed等）由后台的reconcile_task_statuses完成
+        :param task_id: 任务ID
+        :return: 状态快照，包含用于ETag的version字段；任务不存在时status为not_found
+        """
+        snapshot = queue_service.get_status_snapshot(task_id)
+        if snapshot:
+            snapshot['from_source'] = snapshot.get('from_source') or 'redis'
+            # 旧快照缺少创建时间等字段时从MySQL补充（只读）
+            missing_fields = [field for field in ('priority', 'created_at') if field not in snapshot]
+            if missing_fields:
+                row = ComfyUITask.objects.filter(task_id=task_id).values(*missing_fields).first()
+                for field, value in (row or {}).items():
+                    snapshot[field] = value.isoformat() if isinstance(value, datetime) else value
+        else:
+            row = ComfyUITask.objects.filter(task_id=task_id).values(*TaskUtils.SNAPSHOT_DB_FIELDS).first()
+            if not row:
+                return {'task_id': task_id, 'status': 'not_found', 'error': 'Task not found'}
+
+            snapshot = {'task_id': task_id, 'from_source': 'mysql'}
+            for field, value in row.items():
+                if value is None:
+                    continue
+                snapshot[field] = value.isoformat() if isinstance(value, datetime) else value
+            if isinstance(row['output_data'], dict) and row['output_data'].get('image_urls'):
+                snapshot['image_urls'] = row['output_data']['image_urls']
+            # 以数据库更新时间作为快照时间戳，保证同一数据的版本号稳定
+            snapshot['timestamp'] = row['updated_at'].timestamp() if row['updated_at'] else time.time()
+            queue_service.cache_status_snapshot(task_id, snapshot)
+
+        # 待处理任务的位置实时从排名索引读取
+        if snapshot.get('status') == 'pending':
+            queue_position = queue_service.get_pending_rank(task_id)
+            if queue_position is not None:
+                snapshot['queue_position'] = queue_position
+
+        snapshot['version'] = TaskUtils._snapshot_version(snapshot)
+        return snapshot
+
+    @staticmethod
+    def _snapshot_version(snapshot: Dict) -> str:
+        """根据快照中会变化的字段计算版本号，用作ETag"""
+        version_source = '|'.join(str(snapshot.get(field)) for field in
+                                  ('status', 'timestamp', 'queue_position', 'progress'))
+        return hashlib.md5(version_source.encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def _snapshot_image_urls(snapshot: Optional[Dict], task: Optional[ComfyUITask] = None) -> List[str]:
+        """从状态快照或任务输出中提取结果图片URL"""
+        snapshot = snapshot or {}
+        if snapshot.get('image_urls'):
+            return snapshot['image_urls']
+        output_data = snapshot.get('output_data')
+        if isinstance(output_data, dict) and output_data.get('image_urls'):
+            return output_data['image_urls']
+        if task and isinstance(task.output_data, dict) and task.output_data.get('image_urls'):
+            return task.output_data['image_urls']
+        return []
+
+    @staticmethod
+    def reconcile_task_statuses(batch_size: int = 500) -> Dict[str, int]:
+        """
+        后台修正任务状态，替代状态查询时的写回
+        1. 已有结果但仍处于processing/processing_completed的任务转为completed（扣除积分）
+        2. Redis中比MySQL更新的状态同步到MySQL
+        按(created_at, task_id)游标分页扫描所有未结束的任务；修正任务在每个进程和Celery中都会运行，
+        状态用条件更新写入（只有状态仍为读取时的值才更新），同一任务只会被一个进程修正、只扣一次积分
+        :return: 修正的任务数统计
+        """
+        result = {'completed': 0, 'synced': 0}
+        cursor = None
+        while True:
+            queryset = ComfyUITask.objects.filter(status__in=['pending', 'processing', 'processing_completed'])
+            if cursor:
+                queryset = queryset.filter(
+                    Q(created_at__gt=cursor[0]) | Q(created_at=cursor[0], task_id__gt=cursor[1])
+                )
+            tasks = list(queryset.order_by('created_at', 'task_id')[:batch_size])
+            if not tasks:
+                break
+            TaskUtils._reconcile_batch(tasks, result)
+            if len(tasks) < batch_size:
+                break
+            cursor = (tasks[-1].created_at, tasks[-1].task_id)
+        return result
+
+    @staticmethod
+    def _reconcile_batch(tasks: List[ComfyUITask], result: Dict[str, int]):
+        """修正一批任务的状态"""
+        snapshots = queue_service.get_status_snapshots([task.task_id for task in tasks])
+        for task in tasks:
+            snapshot = snapshots.get(task.task_id)
+            redis_status = snapshot.get('status') if snapshot else None
+            try:
+                image_urls = TaskUtils._snapshot_image_urls(snapshot, task)
+                if image_urls and (task.status != 'pending' or redis_status in ['processing_completed', 'completed']):
+                    # 已有结果，转为completed
+                    if not isinstance(task.output_data, dict) or not task.output_data.get('image_urls'):
+                        task.output_data = {'image_urls': image_urls}
+                    task.completed_at = task.completed_at or timezone.now()
+                    updated = ComfyUITask.objects.filter(task_id=task.task_id, status=task.status).update(
+                        status='completed', output_data=task.output_data, completed_at=task.completed_at,
+                        updated_at=timezone.now()
+                    )
+                    if not updated:
+                        # 其他进程已经修正过该任务
+                        continue
+                    task.status = 'completed'
+                    # 条件更新不经过save，显式扣除积分
+                    task.handle_completion()
+                    # 更新Redis快照、释放后端名额并同步关联记录
+                    TaskUtils._update_task_status(
+                        task.task_id,
+                        'completed',
+                        force_redis_update=True,
+                        output_data=task.output_data,
+                        completed_at=task.completed_at
+                    )
+                    result['completed'] += 1
+                    logger.info(f"状态修正: 任务 {task.task_id} 已有结果，已从 {redis_status or 'processing'} 转为completed")
+                    continue
+
+                if not redis_status or redis_status == task.status or redis_status == 'processing_completed':
+                    continue
+                # 只同步比MySQL更新的Redis状态
+                redis_time = float(snapshot.get('timestamp') or 0)
+                if task.updated_at and redis_time <= task.updated_at.timestamp():
+                    continue
+
+                changes = {'status': redis_status, 'updated_at': timezone.now()}
+                if redis_status == 'processing' and not task.started_at:
+                    changes['started_at'] = datetime.fromtimestamp(redis_time, tz=dt_timezone.utc)
+                elif redis_status in ['completed', 'failed', 'cancelled']:
+                    changes['completed_at'] = task.completed_at or timezone.now()
+                    if snapshot.get('error_message'):
+                        changes['error_message'] = snapshot['error_message']
+                if not ComfyUITask.objects.filter(task_id=task.task_id, status=task.status).update(**changes):
+                    continue
+                for field, value in changes.items():
+                    setattr(task, field, value)
+                if redis_status == 'completed':
+                    task.handle_completion()
+                if redis_status in ['completed', 'failed', 'cancelled']:
+                    comfyui_dispatcher.release(task.task_id)
+                    TaskUtils.sync_record_status(task.task_id, force=True)
+                result['synced'] += 1
+                logger.info(f"状态修正: 已同步Redis状态到MySQL: {task.task_id} -> {redis_status}")
+            except Exception as e:
+                logger.error(f"修正任务 {task.task_id} 状态失败: {str(e)}")
+
     @staticmethod
     def cancel_task(task_id: str) -> Dict:
         """
@@ -1032,13 +1095,8 @@ class TaskUtils:
                     except Exception as e:
                         logger.error(f"更新关联记录状态失败: {str(e)}")
 
-                    # 通知消费者取消任务并断开连接
-                    if 'queue_service' in globals() and hasattr(queue_service, 'disconnect_task'):
-                        try:
-                            queue_service.disconnect_task(task_id)
-                            logger.info(f"已断开任务 {task_id} 的消费者连接")
-                        except Exception as e:
-                            logger.error(f"断开消费者连接失败: {str(e)}")
+                    # 通知执行该任务的进程（可能不是当前进程）立即中断ComfyUI中的prompt并释放后端
+                    task_cancellation_bus.publish(task_id, reason='user_cancel')
                     
                     logger.info(f"已发送取消信号给任务 {task_id} 的消费者")
                 except Exception as e:
@@ -1242,29 +1300,6 @@ class TaskUtils:
 
         return saved_urls
 
-    @staticmethod
-    def _update_task_progress(task_id: str, progress: float):
-        """
-        更新任务进度
-        :param task_id: 任务ID
-        :param progress: 进度值 (0-100)
-        """
-        try:
-            task = ComfyUITask.objects.get(task_id=task_id)
-            task.progress = progress
-            task.save()
-
-            # 同时更新任务状态
-            TaskUtils._update_task_status(
-                task_id,
-                task.status,
-                progress=progress
-            )
-        except ComfyUITask.DoesNotExist:
-            logger.error(f"更新任务进度失败: 任务 {task_id} 不存在")
-        except Exception as e:
-            logger.error(f"更新任务进度失败: {str(e)}")
-
     @staticmethod
     def _save_failed_task_data(task_id: str, task_type: str, description: str, user, metadata: Dict) -> None:
         """
@@ -1560,15 +1595,12 @@ class TaskUtils:
             queue_service.add_task(
                 task_id=task_id,
                 task_type=task_type,
-                task_data=task_data
+                task_data=task_data,
+                priority=priority
             )
 
-            # 8. 启动异步处理
-            threading.Thread(
-                target=TaskUtils._process_task_async,
-                args=(task_id, task_type, task_data),
-                daemon=True
-            ).start()
+            # 8. 提交到共享任务执行器异步处理
+            TaskUtils._submit_task_processing(task_id, task_type, task_data, priority)
 
             # 9. 更新关联记录状态为pending
             try:
@@ -1772,12 +1804,7 @@ class TaskUtils:
                     logger.warning(f"任务 {task_id} 已完成，不允许更改为取消状态")
                     return {'success': False, 'message': '任务已完成，不允许更改为取消状态', 'updated_count': 0}
                     
-                updated_count = 0
-                for record in records:
-                    if record.status != 'cancelled':
-                        record.status = 'cancelled'
-                        record.save()
-                        updated_count += 1
+                updated_count = records.exclude(status='cancelled').update(status='cancelled')
                 return {'success': True, 'message': '已同步取消状态', 'updated_count': updated_count}
 
             # 如果是失败状态，检查是否为取消
@@ -1804,8 +1831,8 @@ class TaskUtils:
             # 获取图片URL
             image_urls = TaskUtils._extract_image_urls(task_status, task)
             
-            # 更新记录状态和图片URL
-            updated_count = 0
+            # 更新记录状态和图片URL，一次批量写入
+            changed_records = []
             for record in records:
                 needs_update = False
                 
@@ -1825,8 +1852,11 @@ class TaskUtils:
                     needs_update = True
                 
                 if needs_update:
-                    record.save()
-                    updated_count += 1
+                    changed_records.append(record)
+
+            if changed_records:
+                ImageUploadRecord.objects.bulk_update(changed_records, ['status', 'image_url'])
+            updated_count = len(changed_records)
             
             return {
                 'success': True,
@@ -8,7 +8,7 @@ from templateImage.comfyui_views import ImagesImageAPIView, TextImageAPIView, Pr
     TextToGenerateImagesAPIView, WhiteBackgroundAPIView, ImagesClueImageAPIView, ProductReplacementWorkflowAPIView, \
     FineDetailWorkflowAPIView, WidePictureWorkflowAPIView, InternalSupplementationWorkflowAPIView, \
     InternalSupplementationAndRemovalWorkflowAPIView, CompleteRedrawingWorkflowAPIView, ImagesTextImagesImageAPIView, \
-    QueueInfoAPIView, TaskStatusAPIView, TaskCancelAPIView, MultiImageToImageView, CombinedImageGenerationView, \
+    QueueInfoAPIView, TaskStatusAPIView, TaskEventStreamAPIView, TaskCancelAPIView, MultiImageToImageView, CombinedImageGenerationView, \
     TextToGenerateImagesModelAPIView, \
     UserTaskListAPIView, RetryTaskAPIView, TaskTypeManagementAPIView
 
@@ -68,6 +68,8 @@ urlpatterns=[
     path('user-requests', UserRequestListView.as_view(), name='user-requests-list'),
     path('requests-input', UserInputAutoSaveView.as_view(), name='user-requests-list'),
     path('tasks/<str:task_id>/status', TaskStatusAPIView.as_view(), name='task_status'),
+    path('tasks/<str:task_id>/events', TaskEventStreamAPIView.as_view(), name='task_events'),
+    path('tasks/events', TaskEventStreamAPIView.as_view(), name='user_task_events'),
     path('tasks/<str:task_id>/cancel', TaskCancelAPIView.as_view(), name='task_cancel'),
     path('queue/comfyui/info', QueueInfoAPIView.as_view(), name='comfyui_queue_info'),
     path('queue/info/', QueueInfoAPIView.as_view(), name='queue_info'),
@@ -0,0 +1,159 @@
+"""
+工作流模板缓存模块
+按路径和修改时间缓存解析后的工作流模板，并为每种参数更新预编译节点补丁计划，
+构建提示词时只复制被修改的节点，无需读取和解析工作流文件
+"""
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class PatchPlan:
+    """
+    预编译的节点补丁计划：记录需要修改的 (节点ID, 输入名列表)，应用时只做O(k)次赋值
+    """
+    __slots__ = ('targets', 'missing_nodes')
+
+    def __init__(self, workflow: Dict, signature: Tuple):
+        self.targets = tuple((node_id, keys) for node_id, keys in signature if node_id in workflow)
+        self.missing_nodes = tuple(node_id for node_id, _ in signature if node_id not in workflow)
+
+    def apply(self, workflow: Dict, prompt_updates: Dict) -> Dict:
+        """
+        按计划生成提示词：顶层浅复制，被修改的节点及其inputs复制后再赋值，其余节点与模板共享
+        """
+        prompt = dict(workflow)
+        for node_id, keys in self.targets:
+            node = dict(workflow[node_id])
+            inputs = dict(node.get('inputs') or {})
+            source = prompt_updates[node_id]['inputs']
+            for key in keys:
+                inputs[key] = source[key]
+            node['inputs'] = inputs
+            prompt[node_id] = node
+        return prompt
+
+
+class WorkflowTemplate:
+    """解析后的工作流模板"""
+    __slots__ = ('path', 'mtime', 'raw', 'workflow', 'plans', 'checked_at')
+
+    def __init__(self, path: str, mtime: float, raw: str):
+        self.path = path
+        self.mtime = mtime
+        self.raw = raw
+        self.workflow = json.loads(raw)
+        self.plans: Dict[Tuple, PatchPlan] = {}  # 参数更新签名 -> 补丁计划
+        self.checked_at = time.time()
+
+
+class WorkflowTemplateCache:
+    def __init__(self, check_interval: float = 5):
+        """
+        工作流模板缓存
+        :param check_interval: 检查文件修改时间的最小间隔（秒），间隔内直接使用缓存，不访问文件系统
+        """
+        self.check_interval = check_interval
+        self._templates: Dict[str, WorkflowTemplate] = {}  # 文件路径 -> 模板
+        self._resolved_paths: Dict[str, str] = {}  # 配置的工作流文件 -> 实际找到的路径
+        self._lock = threading.Lock()
+
+    def resolve_path(self, workflow_file: str, candidates: Callable[[], Iterable[str]]) -> str:
+        """
+        解析工作流文件的实际路径，候选路径只在首次使用（或文件被删除）时探测
+        :param workflow_file: 配置的工作流文件
+        :param candidates: 返回候选路径的函数
+        """
+        path = self._resolved_paths.get(workflow_file)
+        if path and (path in self._templates or os.path.exists(path)):
+            return path
+        for candidate in candidates():
+            if os.path.exists(candidate):
+                logger.info(f"找到工作流文件: {candidate}")
+                self._resolved_paths[workflow_file] = candidate
+                return candidate
+        raise FileNotFoundError(f"找不到工作流文件: {workflow_file}")
+
+    def get_template(self, path: str) -> WorkflowTemplate:
+        """获取工作流模板，文件修改时间变化后重新加载"""
+        template = self._templates.get(path)
+        now = time.time()
+        if template and now - template.checked_at < self.check_interval:
+            return template
+
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            self.invalidate(path)
+            raise
+        if template and template.mtime == mtime:
+            template.checked_at = now
+            return template
+
+        with self._lock:
+            template = self._templates.get(path)
+            if template and template.mtime == mtime:
+                return template
+            with open(path, encoding="utf-8") as f:
+                template = WorkflowTemplate(path, mtime, f.read())
+            self._templates[path] = template
+            logger.info(f"已加载工作流模板: {path} ({len(template.workflow)} 个节点)")
+            return template
+
+    def load(self, path: str) -> Dict:
+        """获取工作流模板的独立副本，调用方可以原地修改"""
+        return json.loads(self.get_template(path).raw)
+
+    @staticmethod
+    def _signature(prompt_updates: Dict) -> Tuple:
+        """参数更新的签名：节点ID及其要修改的输入名，值不同但结构相同的更新共用补丁计划"""
+        return tuple(sorted(
+            (node_id, tuple(sorted(updates.get('inputs', {}))))
+            for node_id, updates in prompt_updates.items()
+        ))
+
+    def get_patch_plan(self, template: WorkflowTemplate, prompt_updates: Dict) -> PatchPlan:
+        """获取（首次使用时编译）补丁计划"""
+        signature = self._signature(prompt_updates)
+        plan = template.plans.get(signature)
+        if plan is None:
+            plan = PatchPlan(template.workflow, signature)
+            template.plans[signature] = plan
+            for node_id in plan.missing_nodes:
+                logger.warning(f"节点 {node_id} 不在工作流 {template.path} 中，无法更新")
+        return plan
+
+    def build_prompt(self, path: str, prompt_updates: Optional[Dict] = None) -> Dict:
+        """
+        构建提交给ComfyUI的提示词
+        返回值与模板共享未修改的节点，只能用于序列化提交，不能原地修改
+        """
+        template = self.get_template(path)
+        if not prompt_updates:
+            return dict(template.workflow)
+        return self.get_patch_plan(template, prompt_updates).apply(template.workflow, prompt_updates)
+
+    def invalidate(self, path: Optional[str] = None):
+        """清除指定路径（或全部）的缓存"""
+        with self._lock:
+            if path is None:
+                self._templates.clear()
+                self._resolved_paths.clear()
+                return
+            self._templates.pop(path, None)
+            for workflow_file, resolved in list(self._resolved_paths.items()):
+                if resolved == path:
+                    del self._resolved_paths[workflow_file]
+
+
+# 创建全局工作流模板缓存实例
+workflow_template_cache = WorkflowTemplateCache(
+    check_interval=getattr(settings, 'COMFYUI_WORKFLOW_CACHE_CHECK_INTERVAL', 5)
+)